@@ -0,0 +1,184 @@
+import io
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import threading
+import tempfile
+import subprocess
+
+from .config import VOICE_FORMAT, VOICE_OPUS_BITRATE, FFMPEG_PATH, VOICE_STAGE_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+def is_ogg_opus(data):
+    # OGG 首页以 OggS 开头，Opus 流的第一个包是 OpusHead
+    return bool(data) and data[:4] == b"OggS" and b"OpusHead" in data[:128]
+
+class _Tee:
+    """写入 ffmpeg stdin 的同时保留一份原始音频，编码失败时可以直接发送原始输出。"""
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.buf = io.BytesIO()
+        self.broken = pipe is None
+
+    def write(self, data):
+        self.buf.write(data)
+        if not self.broken:
+            try:
+                self.pipe.write(data)
+            except (OSError, ValueError):
+                self.broken = True
+        return len(data)
+
+    def flush(self):
+        pass
+
+class OpusEncoder:
+    """
+    通过 ffmpeg 子进程把 TTS 输出（WAV/MP3）编码为 OGG/Opus，即 Telegram 语音消息的原生格式。
+    源音频边产生边写入 stdin，编码结果从 stdout 读取，不落临时文件。
+    记录编码次数、输入/输出字节数和耗时；ffmpeg 不可用或编码失败时返回 None，由调用方发送原始音频。
+    """
+
+    def __init__(self, ffmpeg=FFMPEG_PATH, bitrate=VOICE_OPUS_BITRATE, timeout=VOICE_STAGE_TIMEOUT, enabled=True):
+        self.ffmpeg = ffmpeg
+        self.bitrate = bitrate
+        self.timeout = timeout
+        self.enabled = enabled
+        self._path = None
+        self._lock = threading.Lock()
+        self.encoded = 0
+        self.failed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    def available(self):
+        if not self.enabled:
+            return False
+        if self._path is None:
+            self._path = shutil.which(self.ffmpeg) or ""
+            if not self._path:
+                logger.warning(f"{self.ffmpeg} not found, voice replies are sent in the engine's original format")
+        return bool(self._path)
+
+    def command(self):
+        return [
+            self._path, "-hide_banner", "-loglevel", "error", "-i", "pipe:0", "-vn", "-ac", "1",
+            "-c:a", "libopus", "-b:a", self.bitrate, "-application", "voip", "-f", "ogg", "pipe:1",
+        ]
+
+    def encode_stream(self, produce):
+        """
+        produce(fp) 把源音频写入 fp（如 gTTS.write_to_fp）。返回 (OGG 字节或 None, 原始音频字节)；
+        produce 自身的异常直接抛出。
+        """
+        if not self.available():
+            tee = _Tee(None)
+            produce(tee)
+            return None, tee.buf.getvalue()
+        start = time.perf_counter()
+        proc = subprocess.Popen(self.command(), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # 从启动起计时：ffmpeg 卡住时写入 stdin 也会阻塞，只有结束进程才能让写入方退出
+        watchdog = threading.Timer(self.timeout, proc.kill)
+        watchdog.daemon = True
+        watchdog.start()
+        out, err = [], []
+        readers = [
+            threading.Thread(target=lambda: out.append(proc.stdout.read()), daemon=True),
+            threading.Thread(target=lambda: err.append(proc.stderr.read()), daemon=True),
+        ]
+        for t in readers:
+            t.start()
+        tee = _Tee(proc.stdin)
+        try:
+            produce(tee)
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+            if proc.poll() is None and tee.broken:
+                proc.kill()
+            proc.wait()
+            watchdog.cancel()
+            for t in readers:
+                t.join()
+        source = tee.buf.getvalue()
+        data = out[0] if out else b""
+        elapsed = time.perf_counter() - start
+        if proc.returncode != 0 or not is_ogg_opus(data):
+            message = (err[0] if err else b"").decode("utf-8", "replace").strip()
+            logger.warning(f"Opus encoding failed (exit {proc.returncode}): {message[:200]}")
+            with self._lock:
+                self.failed += 1
+            return None, source
+        with self._lock:
+            self.encoded += 1
+            self.bytes_in += len(source)
+            self.bytes_out += len(data)
+            self.seconds += elapsed
+        logger.info(f"Encoded voice to OGG/Opus: {len(source)} -> {len(data)} bytes in {elapsed * 1000:.0f} ms")
+        return data, source
+
+    def encode(self, data):
+        """把完整的音频字节编码为 OGG/Opus；失败返回 None。"""
+        return self.encode_stream(lambda fp: fp.write(data))[0]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "encoded": self.encoded,
+                "failed": self.failed,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "ratio": round(self.bytes_out / self.bytes_in, 4) if self.bytes_in else 0.0,
+                "avg_ms": round(self.seconds * 1000 / self.encoded, 1) if self.encoded else 0.0,
+            }
+
+voice_encoder = OpusEncoder(enabled=VOICE_FORMAT == "ogg")
+
+def check(text, lang="ru"):
+    """离线自检：用 pyttsx3/espeak 合成一段回复并编码，校验 OGG/Opus 输出并返回大小与耗时。"""
+    from .tts import Pyttsx3Worker
+    fd, path = tempfile.mkstemp(suffix=".wav")
+    os.close(fd)
+    worker = Pyttsx3Worker()
+    try:
+        start = time.perf_counter()
+        worker.synthesize(text, lang, path)
+        synth_ms = (time.perf_counter() - start) * 1000
+        with open(path, "rb") as f:
+            wav = f.read()
+    finally:
+        worker.stop(wait=True)
+        os.remove(path)
+    encoder = OpusEncoder(enabled=True)
+    if not encoder.available():
+        raise RuntimeError(f"{encoder.ffmpeg} is not installed")
+    start = time.perf_counter()
+    ogg = encoder.encode(wav)
+    encode_ms = (time.perf_counter() - start) * 1000
+    if not is_ogg_opus(ogg):
+        raise RuntimeError("encoder did not produce a valid OGG/Opus stream")
+    return {"wav_bytes": len(wav), "ogg_bytes": len(ogg), "ratio": round(len(ogg) / len(wav), 4), "synth_ms": round(synth_ms), "encode_ms": round(encode_ms)}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline check of the OGG/Opus voice encoder (pyttsx3/espeak + ffmpeg)")
+    parser.add_argument("--text", default="Город: Москва\nРегион: Москва\nКоды региона: 177, 197, 199, 77, 777, 97, 99")
+    parser.add_argument("--lang", default="ru", choices=["ru", "zh"])
+    parser.add_argument("--max-ratio", type=float, default=0.25, help="fail if the OGG is larger than this fraction of the WAV")
+    args = parser.parse_args()
+    try:
+        result = check(args.text, args.lang)
+    except Exception as e:
+        sys.exit(f"FAIL: {e}")
+    print(f"WAV {result['wav_bytes']} B -> OGG/Opus {result['ogg_bytes']} B (x{result['ratio']}), synth {result['synth_ms']} ms, encode {result['encode_ms']} ms")
+    sys.exit(0 if result["ratio"] <= args.max_ratio else 1)
@@ -0,0 +1,90 @@
+import os
+import argparse
+import threading
+from PIL import Image
+
+from .config import MAP_BASE_LAYER_PATH, MAP_TILE_URL
+from .fetch import fetch_all
+from .tiles import TILE_SIZE, BACKGROUND, pixel_xy, draw_marker, decode_image, get_tile_store
+
+# z=3 的全球底图只有 8x8 块瓦片（2048x2048），整张预渲染后按城市位置裁剪即可得到左侧全国面板
+BASE_ZOOM = 3
+
+_base = None
+_base_lock = threading.Lock()
+
+def build_base_layer(tile_url=MAP_TILE_URL):
+    # 优先使用本地瓦片库，缺失的瓦片再从 tile_url 下载；写入 get_base_layer 读取的 MAP_BASE_LAYER_PATH
+    path = MAP_BASE_LAYER_PATH
+    n = 2 ** BASE_ZOOM
+    canvas = Image.new("RGB", (n * TILE_SIZE, n * TILE_SIZE), BACKGROUND[:3])
+    store = get_tile_store()
+    missing = []
+    for ty in range(n):
+        for tx in range(n):
+            img = store.tile(BASE_ZOOM, tx, ty) if store is not None else None
+            if img is not None:
+                canvas.paste(img.convert("RGB"), (tx * TILE_SIZE, ty * TILE_SIZE))
+            else:
+                missing.append((tx, ty))
+    if missing:
+        urls = [[tile_url.format(z=BASE_ZOOM, x=tx, y=ty)] for tx, ty in missing]
+        for (tx, ty), data in zip(missing, fetch_all(urls, deadline=120)):
+            img = decode_image(data)
+            if img is None:
+                raise RuntimeError(f"Failed to fetch base tile {BASE_ZOOM}/{tx}/{ty}")
+            canvas.paste(img.convert("RGB"), (tx * TILE_SIZE, ty * TILE_SIZE))
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    canvas.save(tmp, format="PNG", optimize=True)
+    os.replace(tmp, path)
+    invalidate_base_layer()
+    return len(missing)
+
+def get_base_layer():
+    global _base
+    if _base is None:
+        if not os.path.exists(MAP_BASE_LAYER_PATH):
+            return None
+        with _base_lock:
+            if _base is None:
+                img = Image.open(MAP_BASE_LAYER_PATH)
+                img.load()
+                _base = img.convert("RGBA")
+    return _base
+
+def invalidate_base_layer():
+    global _base
+    with _base_lock:
+        _base = None
+
+def render_context_panel(lat, lon, size):
+    """
+    从预渲染的 z=3 底图裁剪出以 (lat, lon) 为中心的面板，并在本地绘制位置标记。
+    底图不存在时返回 None。经度方向按世界宽度环绕，便于显示楚科奇等跨 180° 的地区。
+    """
+    base = get_base_layer()
+    if base is None:
+        return None
+    w, h = size
+    world = base.size[0]
+    cx, cy = pixel_xy(lat, lon, BASE_ZOOM)
+    left = int(round(cx - w / 2.0))
+    top = int(round(cy - h / 2.0))
+    out = Image.new("RGBA", (w, h), BACKGROUND)
+    for shift in (-world, 0, world):
+        x0 = max(0, left + shift)
+        x1 = min(world, left + shift + w)
+        y0 = max(0, top)
+        y1 = min(base.size[1], top + h)
+        if x0 < x1 and y0 < y1:
+            out.paste(base.crop((x0, y0, x1, y1)), (x0 - left - shift, y0 - top))
+    draw_marker(out, cx - left, cy - top)
+    return out
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the precomputed z=3 context base layer at MAP_BASE_LAYER_PATH")
+    parser.add_argument("--tile-url", default=MAP_TILE_URL)
+    args = parser.parse_args()
+    fetched = build_base_layer(args.tile_url)
+    print(f"Wrote {MAP_BASE_LAYER_PATH} ({fetched} tiles downloaded)")
@@ -0,0 +1,124 @@
+import sys
+import json
+import time
+import argparse
+
+from .nlp import parse_intent
+from .db import (
+    init_schema, seed_reference_data, find_city_by_name, find_city_by_name_fuzzy, get_regions_by_ids,
+    find_regions_by_auto_codes, list_auto_codes_by_regions, find_cities_by_phone_codes, list_phone_codes_by_cities,
+    get_cities_by_regions,
+)
+
+# 每批解析的条数；SQL 后端每批每类查询只发一条 IN (...) 语句
+BATCH_CHUNK_SIZE = 500
+
+def _region(row):
+    return {"id": row[0], "name_ru": row[1], "name_zh": row[2]}
+
+def _city(cid, name_ru, name_zh, lat, lon):
+    return {"id": cid, "name_ru": name_ru, "name_zh": name_zh, "lat": lat, "lon": lon}
+
+def resolve_intents(intents):
+    """
+    批量解析一组 parse_intent 结果，返回同序的结果字典列表。
+    同类查询合并为一次批量查询；不生成地图和语音，也不调用地理编码。
+    """
+    auto_codes, phone_codes, names = set(), set(), {}
+    for it in intents:
+        kind = it.get("intent")
+        if kind == "license_plate":
+            auto_codes.add(it.get("region_code", ""))
+        elif kind == "auto_code_to_region":
+            auto_codes.add(it.get("code", ""))
+        elif kind == "phone_code_to_city":
+            phone_codes.add(it.get("code", ""))
+        elif kind in ("city_to_auto_code", "city_to_phone_code"):
+            names[it.get("city", "").strip()] = None
+    regions_by_code = find_regions_by_auto_codes(auto_codes)
+    cities_by_phone = find_cities_by_phone_codes(phone_codes)
+    # 城市名走内存索引/模糊匹配，同一批内相同名称只查一次
+    for name in names:
+        names[name] = (find_city_by_name(name) or find_city_by_name_fuzzy(name)) if name else None
+    region_ids = {r[0] for r in regions_by_code.values()} | {c[3] for c in names.values() if c}
+    regions = get_regions_by_ids(region_ids)
+    auto_by_region = list_auto_codes_by_regions(region_ids)
+    capitals = get_cities_by_regions(r[0] for r in regions_by_code.values())
+    phone_by_city = list_phone_codes_by_cities([c[0] for c in cities_by_phone.values()] + [c[0] for c in names.values() if c])
+
+    results = []
+    for it in intents:
+        kind = it.get("intent")
+        out = dict(it)
+        if kind in ("license_plate", "auto_code_to_region"):
+            region = regions_by_code.get(it.get("region_code" if kind == "license_plate" else "code", ""))
+            out["found"] = region is not None
+            if region:
+                out["region"] = _region(region)
+                out["auto_codes"] = auto_by_region.get(region[0], [])
+                capital = capitals.get(region[0])
+                if capital:
+                    out["city"] = _city(*capital)
+        elif kind == "phone_code_to_city":
+            row = cities_by_phone.get(it.get("code", ""))
+            out["found"] = row is not None
+            if row:
+                cid, city_ru, city_zh, rid, region_ru, region_zh, lat, lon = row
+                out["city"] = _city(cid, city_ru, city_zh, lat, lon)
+                out["region"] = _region((rid, region_ru, region_zh))
+                out["phone_codes"] = phone_by_city.get(cid, [])
+        else:
+            city = names.get(it.get("city", "").strip())
+            out["found"] = city is not None
+            if city:
+                cid, city_ru, city_zh, rid, lat, lon = city
+                out["city"] = _city(cid, city_ru, city_zh, lat, lon)
+                region = regions.get(rid)
+                if region:
+                    out["region"] = _region(region)
+                if kind == "city_to_phone_code":
+                    out["phone_codes"] = phone_by_city.get(cid, [])
+                else:
+                    out["auto_codes"] = auto_by_region.get(rid, [])
+        results.append(out)
+    return results
+
+def resolve_batch(texts, chunk_size=BATCH_CHUNK_SIZE):
+    """逐批解析原始文本并流式产出结果字典（含原文 input 字段），适合处理大文件。"""
+    chunk = []
+    for text in texts:
+        chunk.append(text)
+        if len(chunk) >= chunk_size:
+            yield from _resolve_chunk(chunk)
+            chunk = []
+    if chunk:
+        yield from _resolve_chunk(chunk)
+
+def _resolve_chunk(texts):
+    for text, result in zip(texts, resolve_intents([parse_intent(t) for t in texts])):
+        yield {"input": text, **result}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resolve plates, region codes, area codes and city names in bulk (JSONL output)")
+    parser.add_argument("input", nargs="?", default="-", help="text file with one query per line, - for stdin")
+    parser.add_argument("-o", "--output", default="-", help="JSONL output file, - for stdout")
+    parser.add_argument("--chunk-size", type=int, default=BATCH_CHUNK_SIZE)
+    args = parser.parse_args()
+    init_schema()
+    seed_reference_data()
+    src = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    dst = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    start = time.perf_counter()
+    total = found = 0
+    try:
+        lines = (line.strip() for line in src)
+        for result in resolve_batch((line for line in lines if line), args.chunk_size):
+            dst.write(json.dumps(result, ensure_ascii=False) + "\n")
+            total += 1
+            found += result["found"]
+    finally:
+        if src is not sys.stdin:
+            src.close()
+        if dst is not sys.stdout:
+            dst.close()
+    print(f"Resolved {found}/{total} queries in {time.perf_counter() - start:.2f}s", file=sys.stderr)
@@ -5,6 +5,85 @@ DEFAULT_LANG = os.getenv("DEFAULT_LANG", "ru")
 DATA_DB_PATH = os.getenv("DATA_DB_PATH", os.path.join(os.path.dirname(__file__), "data.db"))
 MAP_IMG_DIR = os.getenv("MAP_IMG_DIR", os.path.join(os.path.dirname(__file__), "maps"))
 TTS_AUDIO_DIR = os.getenv("TTS_AUDIO_DIR", os.path.join(os.path.dirname(__file__), "tts"))
+# 预构建的只读参考库（python -m bot.db build-ref 生成）；不存在时启动时灌入 DATA_DB_PATH
+REF_DB_PATH = os.getenv("REF_DB_PATH", os.path.join(os.path.dirname(__file__), "ref.db"))
+# memory: 启动时构建只读内存索引；sql: 每次查询直接访问 SQLite
+LOOKUP_BACKEND = os.getenv("LOOKUP_BACKEND", "memory")
+DB_CACHE_KB = int(os.getenv("DB_CACHE_KB", "8192"))
+DB_MMAP_BYTES = int(os.getenv("DB_MMAP_BYTES", str(64 * 1024 * 1024)))
+# 城市模糊匹配（三元组 Jaccard 相似度）：最低分、领先第二名的最小分差、查询与匹配名称的最小长度比；
+# 任一条件不满足视为未找到，交给 Nominatim（避免 "Саранск" 这类未收录的城市被纠正成 "Саратов"）
+CITY_FUZZY_THRESHOLD = float(os.getenv("CITY_FUZZY_THRESHOLD", "0.5"))
+CITY_FUZZY_MARGIN = float(os.getenv("CITY_FUZZY_MARGIN", "0.1"))
+CITY_FUZZY_LENGTH_RATIO = float(os.getenv("CITY_FUZZY_LENGTH_RATIO", "0.8"))
+# 一条消息包含多个车牌/代码时，最多发送的地图数（按地区去重）
+MULTI_QUERY_MAX_MAPS = int(os.getenv("MULTI_QUERY_MAX_MAPS", "3"))
+# 阻塞任务的专用执行器：并发数与排队上限（在途任务达到 并发数+排队上限 时直接回复“繁忙”）；
+# kind 为 thread 或 process（process 适合 CPU 密集的渲染/离线语音，各进程的内存缓存互不共享）
+MAP_POOL_KIND = os.getenv("MAP_POOL_KIND", "thread")
+MAP_POOL_WORKERS = int(os.getenv("MAP_POOL_WORKERS", "4"))
+MAP_POOL_QUEUE = int(os.getenv("MAP_POOL_QUEUE", "16"))
+GEOCODE_POOL_WORKERS = int(os.getenv("GEOCODE_POOL_WORKERS", "2"))
+GEOCODE_POOL_QUEUE = int(os.getenv("GEOCODE_POOL_QUEUE", "32"))
+TTS_POOL_KIND = os.getenv("TTS_POOL_KIND", "thread")
+TTS_POOL_WORKERS = int(os.getenv("TTS_POOL_WORKERS", "2"))
+TTS_POOL_QUEUE = int(os.getenv("TTS_POOL_QUEUE", "16"))
+# 每个用户的令牌桶限流：每秒补充的消息数与突发上限（USER_RATE=0 关闭），最多跟踪的用户数
+USER_RATE = float(os.getenv("USER_RATE", "0.5"))
+USER_BURST = int(os.getenv("USER_BURST", "5"))
+USER_LIMITER_MAX_USERS = int(os.getenv("USER_LIMITER_MAX_USERS", "10000"))
+# 回复阶段超时（秒）：地图渲染与语音合成并行执行，超时只跳过该阶段
+MAP_STAGE_TIMEOUT = float(os.getenv("MAP_STAGE_TIMEOUT", "20"))
+VOICE_STAGE_TIMEOUT = float(os.getenv("VOICE_STAGE_TIMEOUT", "20"))
+# 查询日志批量写入：每 N 条或每 T 毫秒落盘一次；队列满时 drop 丢弃或 block 等待
+QUERY_LOG_BATCH_SIZE = int(os.getenv("QUERY_LOG_BATCH_SIZE", "100"))
+QUERY_LOG_FLUSH_MS = int(os.getenv("QUERY_LOG_FLUSH_MS", "500"))
+QUERY_LOG_QUEUE_SIZE = int(os.getenv("QUERY_LOG_QUEUE_SIZE", "10000"))
+QUERY_LOG_POLICY = os.getenv("QUERY_LOG_POLICY", "drop")
+# 地图渲染缓存：内存 LRU + MAP_IMG_DIR/cache 磁盘目录
+MAP_CACHE_MEM_ITEMS = int(os.getenv("MAP_CACHE_MEM_ITEMS", "256"))
+MAP_CACHE_MEM_MB = int(os.getenv("MAP_CACHE_MEM_MB", "64"))
+MAP_CACHE_DISK_MB = int(os.getenv("MAP_CACHE_DISK_MB", "512"))
+MAP_CACHE_MAX_AGE_DAYS = float(os.getenv("MAP_CACHE_MAX_AGE_DAYS", "30"))
+# 语音缓存：TTS_AUDIO_DIR/cache 下按 (引擎, 语言, 文本) 保存合成结果，内存 LRU + 磁盘容量/年龄淘汰
+TTS_CACHE_MEM_ITEMS = int(os.getenv("TTS_CACHE_MEM_ITEMS", "128"))
+TTS_CACHE_MEM_MB = int(os.getenv("TTS_CACHE_MEM_MB", "16"))
+TTS_CACHE_DISK_MB = int(os.getenv("TTS_CACHE_DISK_MB", "256"))
+TTS_CACHE_MAX_AGE_DAYS = float(os.getenv("TTS_CACHE_MAX_AGE_DAYS", "30"))
+# 语音片段库（python -m bot.voicebank build 生成）：auto 时整条回复都能由片段拼接则不再调用 TTS；off 关闭
+TTS_FRAGMENT_DIR = os.getenv("TTS_FRAGMENT_DIR", os.path.join(TTS_AUDIO_DIR, "fragments"))
+TTS_FRAGMENTS = os.getenv("TTS_FRAGMENTS", "auto")
+# 语音消息编码：ogg 时经 ffmpeg 管道转为 OGG/Opus（Telegram 语音的原生格式）；original 或找不到 ffmpeg 时发送引擎原始输出
+VOICE_FORMAT = os.getenv("VOICE_FORMAT", "ogg")
+VOICE_OPUS_BITRATE = os.getenv("VOICE_OPUS_BITRATE", "24k")
+FFMPEG_PATH = os.getenv("FFMPEG_PATH", "ffmpeg")
+# 地图输出编码：png / jpeg / webp（python -m bot.imageenc 对比各格式耗时与体积）；质量用于 jpeg/webp，
+# MAP_PNG_COLORS>0 时 PNG 先量化为调色板（2-256 色）。格式与参数计入缓存键，切换后已有的地图缓存不再命中
+MAP_IMAGE_FORMAT = os.getenv("MAP_IMAGE_FORMAT", "png")
+MAP_IMAGE_QUALITY = int(os.getenv("MAP_IMAGE_QUALITY", "85"))
+MAP_PNG_COLORS = int(os.getenv("MAP_PNG_COLORS", "0"))
+MAP_PNG_COMPRESS_LEVEL = int(os.getenv("MAP_PNG_COMPRESS_LEVEL", "6"))
+MAP_WEBP_METHOD = int(os.getenv("MAP_WEBP_METHOD", "4"))
+# 本地瓦片库（MBTiles）；auto: 瓦片库存在且覆盖时离线渲染，否则请求 Yandex
+MAP_RENDERER = os.getenv("MAP_RENDERER", "auto")
+MAP_TILES_PATH = os.getenv("MAP_TILES_PATH", os.path.join(MAP_IMG_DIR, "tiles.mbtiles"))
+MAP_TILE_CACHE = int(os.getenv("MAP_TILE_CACHE", "256"))
+# 预渲染的 z=3 全国底图（python -m bot.basemap 生成），用于双窗地图左侧面板
+MAP_BASE_LAYER_PATH = os.getenv("MAP_BASE_LAYER_PATH", os.path.join(MAP_IMG_DIR, "base_z3.png"))
+MAP_TILE_URL = os.getenv("MAP_TILE_URL", "https://tile.openstreetmap.org/{z}/{x}/{y}.png")
+# 地理编码缓存：内存 LRU 条数，命中结果与“未找到”的有效期（秒）
+GEOCODE_CACHE_ITEMS = int(os.getenv("GEOCODE_CACHE_ITEMS", "1024"))
+GEOCODE_CACHE_TTL = int(os.getenv("GEOCODE_CACHE_TTL", str(30 * 86400)))
+GEOCODE_NEGATIVE_TTL = int(os.getenv("GEOCODE_NEGATIVE_TTL", str(86400)))
+# Nominatim 客户端：每秒请求数、排队最长等待（秒）、429/5xx 重试次数
+NOMINATIM_URL = os.getenv("NOMINATIM_URL", "https://nominatim.openstreetmap.org")
+NOMINATIM_RATE = float(os.getenv("NOMINATIM_RATE", "1.0"))
+NOMINATIM_MAX_WAIT = float(os.getenv("NOMINATIM_MAX_WAIT", "10"))
+NOMINATIM_RETRIES = int(os.getenv("NOMINATIM_RETRIES", "3"))
+NOMINATIM_TIMEOUT = float(os.getenv("NOMINATIM_TIMEOUT", "10"))
+# 地图下载：共享连接池大小与单张地图的总下载时限（秒）
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "16"))
+MAP_FETCH_DEADLINE = float(os.getenv("MAP_FETCH_DEADLINE", "10"))
 
 def ensure_dirs():
     for d in [MAP_IMG_DIR, TTS_AUDIO_DIR]:
@@ -1,624 +1,1093 @@
 import sqlite3
 import os
-from .config import DATA_DB_PATH
+import threading
+from contextlib import contextmanager
+import argparse
+from .config import DATA_DB_PATH, REF_DB_PATH, LOOKUP_BACKEND, DB_CACHE_KB, DB_MMAP_BYTES
 
 def get_conn():
     return sqlite3.connect(DATA_DB_PATH)
 
-def init_schema():
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("CREATE TABLE IF NOT EXISTS regions (id INTEGER PRIMARY KEY, name_ru TEXT, name_zh TEXT)")
-    c.execute("CREATE TABLE IF NOT EXISTS cities (id INTEGER PRIMARY KEY, name_ru TEXT, name_zh TEXT, region_id INTEGER, aliases TEXT, lat REAL, lon REAL)")
+def _norm(s):
+    return (s or "").strip().casefold().replace("ё", "е")
+
+def _prefix_range(key):
+    # 前缀查询改写为 [key, key+U+10FFFF) 区间，可直接使用 BINARY 索引
+    return key, key + "\U0010ffff"
+
+def has_ref_db():
+    # 存在预构建的参考库时，参考数据只从该文件读取，DATA_DB_PATH 只保存可变数据
+    return bool(REF_DB_PATH) and os.path.exists(REF_DB_PATH)
+
+def _apply_pragmas(conn):
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute(f"PRAGMA cache_size=-{int(DB_CACHE_KB)}")
+    conn.execute(f"PRAGMA mmap_size={int(DB_MMAP_BYTES)}")
+    return conn
+
+# 读连接按线程复用（asyncio.to_thread 的工作线程长期存在），写连接全局唯一并由锁串行化。
+# WAL 模式下读者不会被写者阻塞，查询日志写入也不再每次 fsync 主库。
+_local = threading.local()
+_write_conn = None
+_write_lock = threading.Lock()
+_all_conns = []
+_all_conns_lock = threading.Lock()
+
+def _track(conn):
+    with _all_conns_lock:
+        _all_conns.append(conn)
+    return conn
+
+def _open_read_conn():
+    if has_ref_db():
+        # 参考库以 immutable 方式映射为主库（多进程共享页缓存），可变数据库挂载为 data
+        conn = sqlite3.connect(f"file:{REF_DB_PATH}?mode=ro&immutable=1", uri=True, check_same_thread=False)
+        conn.execute("ATTACH DATABASE ? AS data", (f"file:{DATA_DB_PATH}?mode=ro",))
+    else:
+        conn = sqlite3.connect(f"file:{DATA_DB_PATH}?mode=ro", uri=True, check_same_thread=False)
+    _apply_pragmas(conn)
+    conn.execute("PRAGMA query_only=ON")
+    return conn
+
+def get_read_conn():
+    conn = getattr(_local, "read_conn", None)
+    if conn is None:
+        conn = _local.read_conn = _track(_open_read_conn())
+    return conn
+
+@contextmanager
+def write_conn():
+    global _write_conn
+    with _write_lock:
+        if _write_conn is None:
+            _write_conn = _track(_apply_pragmas(sqlite3.connect(DATA_DB_PATH, check_same_thread=False)))
+        try:
+            yield _write_conn
+            _write_conn.commit()
+        except Exception:
+            _write_conn.rollback()
+            raise
+
+def close_conns():
+    global _write_conn
+    with _all_conns_lock:
+        conns = list(_all_conns)
+        _all_conns.clear()
+    for conn in conns:
+        try:
+            conn.close()
+        except Exception:
+            pass
+    _write_conn = None
+    _local.__dict__.clear()
+
+def _add_column(c, table, column, decl):
+    if column not in [r[1] for r in c.execute(f"PRAGMA table_info({table})").fetchall()]:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+def _create_reference_schema(c):
+    c.execute("CREATE TABLE IF NOT EXISTS regions (id INTEGER PRIMARY KEY, name_ru TEXT, name_zh TEXT, name_norm TEXT, name_zh_norm TEXT)")
+    c.execute("CREATE TABLE IF NOT EXISTS cities (id INTEGER PRIMARY KEY, name_ru TEXT, name_zh TEXT, region_id INTEGER, aliases TEXT, lat REAL, lon REAL, name_norm TEXT, name_zh_norm TEXT)")
+    c.execute("CREATE TABLE IF NOT EXISTS city_aliases (alias_norm TEXT, city_id INTEGER, PRIMARY KEY (alias_norm, city_id)) WITHOUT ROWID")
     c.execute("CREATE TABLE IF NOT EXISTS auto_codes (id INTEGER PRIMARY KEY, code TEXT, region_id INTEGER)")
     c.execute("CREATE TABLE IF NOT EXISTS phone_codes (id INTEGER PRIMARY KEY, area_code TEXT, city_id INTEGER, region_id INTEGER)")
-    c.execute("CREATE TABLE IF NOT EXISTS queries (id INTEGER PRIMARY KEY, user_id TEXT, language TEXT, intent TEXT, raw_text TEXT, parsed_entities TEXT, result TEXT, created_at TEXT)")
-    conn.commit()
-    conn.close()
+    c.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    # 旧库补充规范化名称列，由灌库（SEED_DATA_VERSION 变化）回填
+    for table in ("regions", "cities"):
+        _add_column(c, table, "name_norm", "TEXT")
+        _add_column(c, table, "name_zh_norm", "TEXT")
+    _ensure_unique_indexes(c)
+    c.execute("CREATE INDEX IF NOT EXISTS ix_regions_name_norm ON regions(name_norm)")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_regions_name_zh_norm ON regions(name_zh_norm)")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_cities_name_norm ON cities(name_norm)")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_cities_name_zh_norm ON cities(name_zh_norm)")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_cities_region ON cities(region_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_auto_codes_region ON auto_codes(region_id, code)")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_phone_codes_city ON phone_codes(city_id, area_code)")
 
-def seed_minimal():
+def init_schema():
     conn = get_conn()
     c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM cities")
-    cities_count = c.fetchone()[0]
-    if cities_count == 0:
-        names = [
-            ("Москва", "莫斯科", "Мск, Moscow", 55.7558, 37.6173),
-            ("Санкт-Петербург", "圣彼得堡", "Питер, SPb", 59.9343, 30.3351),
-            ("Новосибирск", "新西伯利亚", "", 55.0302, 82.9206),
-            ("Екатеринбург", "叶卡捷琳堡", "", 56.8389, 60.6057),
-            ("Нижний Новгород", "下诺夫哥罗德", "", 56.2965, 43.9361),
-            ("Казань", "喀山", "", 55.8304, 49.0661),
-        ]
-        rows = []
-        for name_ru, name_zh, aliases, lat, lon in names:
-            c.execute("SELECT id FROM regions WHERE name_ru=?", (name_ru,))
-            r = c.fetchone()
-            region_id = r[0] if r else None
-            rows.append((name_ru, name_zh, region_id, aliases, lat, lon))
-        c.executemany("INSERT INTO cities(name_ru,name_zh,region_id,aliases,lat,lon) VALUES(?,?,?,?,?,?)", rows)
-    c.execute("SELECT COUNT(*) FROM auto_codes")
-    ac_count = c.fetchone()[0]
-    if ac_count == 0:
-        pairs = {
-            "Москва": ["77","97","99","177","197","199","777"],
-            "Санкт-Петербург": ["78","98","178"],
-            "Новосибирская область": ["54"],
-            "Свердловская область": ["66","96","196"],
-            "Нижегородская область": ["52","152"],
-            "Республика Татарстан": ["16","116"],
-        }
-        to_ac = []
-        for region_name, codes in pairs.items():
-            c.execute("SELECT id FROM regions WHERE name_ru=?", (region_name,))
-            r = c.fetchone()
-            if not r:
-                continue
-            region_id = r[0]
-            for code in codes:
-                to_ac.append((code, region_id))
-        c.executemany("INSERT INTO auto_codes(code,region_id) VALUES(?,?)", to_ac)
-    c.execute("SELECT COUNT(*) FROM phone_codes")
-    pc_count = c.fetchone()[0]
-    if pc_count == 0:
-        pairs = {
-            "Москва": ["495","499"],
-            "Санкт-Петербург": ["812"],
-            "Новосибирск": ["383"],
-            "Екатеринбург": ["343"],
-            "Нижний Новгород": ["831"],
-            "Казань": ["843"],
-        }
-        to_pc = []
-        for city_name, codes in pairs.items():
-            c.execute("SELECT id,region_id FROM cities WHERE name_ru=?", (city_name,))
-            r = c.fetchone()
-            if not r:
-                continue
-            city_id, region_id = r
-            for code in codes:
-                to_pc.append((code, city_id, region_id))
-        c.executemany("INSERT INTO phone_codes(area_code,city_id,region_id) VALUES(?,?,?)", to_pc)
+    if not has_ref_db():
+        _create_reference_schema(c)
+    c.execute("CREATE TABLE IF NOT EXISTS queries (id INTEGER PRIMARY KEY, user_id TEXT, language TEXT, intent TEXT, raw_text TEXT, parsed_entities TEXT, result TEXT, created_at TEXT)")
+    c.execute("CREATE TABLE IF NOT EXISTS tg_files (content_key TEXT PRIMARY KEY, kind TEXT, file_id TEXT, created_at TEXT)")
+    c.execute("CREATE TABLE IF NOT EXISTS geocode_cache (kind TEXT, lang TEXT, query TEXT, result TEXT, expires_at REAL, PRIMARY KEY (kind, lang, query))")
     conn.commit()
+    # WAL 设置持久保存在库文件中，只需设置一次
+    c.execute("PRAGMA journal_mode=WAL")
     conn.close()
 
-def seed_full_regions():
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT name_ru FROM regions")
-    existing = set(r[0] for r in c.fetchall())
-    regions_full = [
-        "Москва",
-        "Санкт-Петербург",
-        "Республика Адыгея",
-        "Республика Башкортостан",
-        "Республика Бурятия",
-        "Республика Алтай",
-        "Республика Дагестан",
-        "Республика Ингушетия",
-        "Кабардино-Балкарская Республика",
-        "Республика Калмыкия",
-        "Карачаево-Черкесская Республика",
-        "Республика Карелия",
-        "Республика Коми",
-        "Республика Марий Эл",
-        "Республика Мордовия",
-        "Республика Саха (Якутия)",
-        "Республика Северная Осетия — Алания",
-        "Республика Татарстан",
-        "Республика Тыва",
-        "Удмуртская Республика",
-        "Республика Хакасия",
-        "Чеченская Республика",
-        "Чувашская Республика",
-        "Алтайский край",
-        "Краснодарский край",
-        "Красноярский край",
-        "Приморский край",
-        "Ставропольский край",
-        "Хабаровский край",
-        "Амурская область",
-        "Архангельская область",
-        "Астраханская область",
-        "Белгородская область",
-        "Брянская область",
-        "Владимирская область",
-        "Волгоградская область",
-        "Вологодская область",
-        "Воронежская область",
-        "Ивановская область",
-        "Иркутская область",
-        "Калининградская область",
-        "Калужская область",
-        "Камчатский край",
-        "Кемеровская область — Кузбасс",
-        "Кировская область",
-        "Костромская область",
-        "Курганская область",
-        "Курская область",
-        "Ленинградская область",
-        "Липецкая область",
-        "Магаданская область",
-        "Московская область",
-        "Мурманская область",
-        "Нижегородская область",
-        "Новгородская область",
-        "Новосибирская область",
-        "Омская область",
-        "Оренбургская область",
-        "Орловская область",
-        "Пензенская область",
-        "Пермский край",
-        "Псковская область",
-        "Ростовская область",
-        "Рязанская область",
-        "Самарская область",
-        "Саратовская область",
-        "Сахалинская область",
-        "Свердловская область",
-        "Смоленская область",
-        "Тамбовская область",
-        "Тверская область",
-        "Томская область",
-        "Тульская область",
-        "Тюменская область",
-        "Ульяновская область",
-        "Челябинская область",
-        "Ярославская область",
-        "Забайкальский край",
-        "Еврейская автономная область",
-        "Ненецкий автономный округ",
-        "Ханты-Мансийский автономный округ — Югра",
-        "Чукотский автономный округ",
-        "Ямало-Ненецкий автономный округ",
-        "Севастополь",
-        "Республика Крым",
-    ]
-    to_insert = [(name, None) for name in regions_full if name not in existing]
-    if to_insert:
-        c.executemany("INSERT INTO regions(name_ru,name_zh) VALUES(?,?)", to_insert)
-    conn.commit()
-    conn.close()
+# 参考数据版本：修改下列任何数据后必须递增，启动时据此判断是否需要重新灌库
+SEED_DATA_VERSION = 4
 
-def seed_auto_codes_full():
-    conn = get_conn()
-    c = conn.cursor()
-    mapping = {
-        "Москва": ["77","97","99","177","197","199","777"],
-        "Санкт-Петербург": ["78","98","178"],
-        "Московская область": ["50","90","150"],
-        "Ленинградская область": ["47","147"],
-        "Республика Татарстан": ["16","116"],
-        "Республика Башкортостан": ["02","102","702"],
-        "Республика Адыгея": ["01","101"],
-        "Республика Алтай": ["04","104"],
-        "Республика Бурятия": ["03","103"],
-        "Республика Дагестан": ["05","105"],
-        "Республика Ингушетия": ["06","106"],
-        "Кабардино-Балкарская Республика": ["07","107"],
-        "Республика Калмыкия": ["08","108"],
-        "Карачаево-Черкесская Республика": ["09","109"],
-        "Республика Карелия": ["10","110"],
-        "Республика Коми": ["11","111"],
-        "Республика Марий Эл": ["12","112"],
-        "Республика Мордовия": ["13","113"],
-        "Республика Саха (Якутия)": ["14","114"],
-        "Республика Северная Осетия — Алания": ["15","115"],
-        "Республика Тыва": ["17","117"],
-        "Республика Хакасия": ["19","119"],
-        "Удмуртская Республика": ["18","118"],
-        "Чеченская Республика": ["95"],
-        "Чувашская Республика": ["21","121"],
-        "Алтайский край": ["22"],
-        "Краснодарский край": ["23","93","123"],
-        "Красноярский край": ["24","84","124"],
-        "Приморский край": ["25","125"],
-        "Ставропольский край": ["26","126"],
-        "Хабаровский край": ["27"],
-        "Амурская область": ["28"],
-        "Архангельская область": ["29"],
-        "Астраханская область": ["30"],
-        "Белгородская область": ["31"],
-        "Брянская область": ["32"],
-        "Владимирская область": ["33"],
-        "Волгоградская область": ["34","134"],
-        "Вологодская область": ["35"],
-        "Воронежская область": ["36","136"],
-        "Ивановская область": ["37"],
-        "Иркутская область": ["38","138"],
-        "Калининградская область": ["39"],
-        "Калужская область": ["40"],
-        "Камчатский край": ["41"],
-        "Кемеровская область — Кузбасс": ["42","142"],
-        "Кировская область": ["43"],
-        "Костромская область": ["44"],
-        "Курганская область": ["45"],
-        "Курская область": ["46"],
-        "Липецкая область": ["48"],
-        "Магаданская область": ["49"],
-        "Нижегородская область": ["52","152"],
-        "Новгородская область": ["53"],
-        "Новосибирская область": ["54"],
-        "Омская область": ["55"],
-        "Оренбургская область": ["56"],
-        "Орловская область": ["57"],
-        "Пензенская область": ["58"],
-        "Пермский край": ["59","81","159"],
-        "Псковская область": ["60"],
-        "Ростовская область": ["61","161"],
-        "Рязанская область": ["62"],
-        "Самарская область": ["63","163"],
-        "Саратовская область": ["64","164"],
-        "Сахалинская область": ["65"],
-        "Свердловская область": ["66","96","196"],
-        "Смоленская область": ["67"],
-        "Тамбовская область": ["68"],
-        "Тверская область": ["69"],
-        "Томская область": ["70"],
-        "Тульская область": ["71"],
-        "Тюменская область": ["72"],
-        "Ульяновская область": ["73"],
-        "Челябинская область": ["74","174"],
-        "Забайкальский край": ["75"],
-        "Еврейская автономная область": ["79"],
-        "Ненецкий автономный округ": ["83"],
-        "Ханты-Мансийский автономный округ — Югра": ["86","186"],
-        "Чукотский автономный округ": ["87"],
-        "Ямало-Ненецкий автономный округ": ["89"],
-        "Севастополь": ["92"],
-        "Республика Крым": ["82"],
-    }
-    for region_name, codes in mapping.items():
-        c.execute("SELECT id FROM regions WHERE name_ru=?", (region_name,))
-        r = c.fetchone()
-        if not r:
-            continue
-        region_id = r[0]
-        for code in codes:
-            c.execute("SELECT 1 FROM auto_codes WHERE code=? AND region_id=?", (code, region_id))
-            exists = c.fetchone()
-            if not exists:
-                c.execute("INSERT INTO auto_codes(code,region_id) VALUES(?,?)", (code, region_id))
-    conn.commit()
-    conn.close()
+REGIONS_FULL = [
+    "Москва",
+    "Санкт-Петербург",
+    "Республика Адыгея",
+    "Республика Башкортостан",
+    "Республика Бурятия",
+    "Республика Алтай",
+    "Республика Дагестан",
+    "Республика Ингушетия",
+    "Кабардино-Балкарская Республика",
+    "Республика Калмыкия",
+    "Карачаево-Черкесская Республика",
+    "Республика Карелия",
+    "Республика Коми",
+    "Республика Марий Эл",
+    "Республика Мордовия",
+    "Республика Саха (Якутия)",
+    "Республика Северная Осетия — Алания",
+    "Республика Татарстан",
+    "Республика Тыва",
+    "Удмуртская Республика",
+    "Республика Хакасия",
+    "Чеченская Республика",
+    "Чувашская Республика",
+    "Алтайский край",
+    "Краснодарский край",
+    "Красноярский край",
+    "Приморский край",
+    "Ставропольский край",
+    "Хабаровский край",
+    "Амурская область",
+    "Архангельская область",
+    "Астраханская область",
+    "Белгородская область",
+    "Брянская область",
+    "Владимирская область",
+    "Волгоградская область",
+    "Вологодская область",
+    "Воронежская область",
+    "Ивановская область",
+    "Иркутская область",
+    "Калининградская область",
+    "Калужская область",
+    "Камчатский край",
+    "Кемеровская область — Кузбасс",
+    "Кировская область",
+    "Костромская область",
+    "Курганская область",
+    "Курская область",
+    "Ленинградская область",
+    "Липецкая область",
+    "Магаданская область",
+    "Московская область",
+    "Мурманская область",
+    "Нижегородская область",
+    "Новгородская область",
+    "Новосибирская область",
+    "Омская область",
+    "Оренбургская область",
+    "Орловская область",
+    "Пензенская область",
+    "Пермский край",
+    "Псковская область",
+    "Ростовская область",
+    "Рязанская область",
+    "Самарская область",
+    "Саратовская область",
+    "Сахалинская область",
+    "Свердловская область",
+    "Смоленская область",
+    "Тамбовская область",
+    "Тверская область",
+    "Томская область",
+    "Тульская область",
+    "Тюменская область",
+    "Ульяновская область",
+    "Челябинская область",
+    "Ярославская область",
+    "Забайкальский край",
+    "Еврейская автономная область",
+    "Ненецкий автономный округ",
+    "Ханты-Мансийский автономный округ — Югра",
+    "Чукотский автономный округ",
+    "Ямало-Ненецкий автономный округ",
+    "Севастополь",
+    "Республика Крым",
+]
 
-def seed_cities_full():
-    conn = get_conn()
+AUTO_CODES_FULL = {
+    "Москва": ["77","97","99","177","197","199","777"],
+    "Санкт-Петербург": ["78","98","178"],
+    "Московская область": ["50","90","150"],
+    "Ленинградская область": ["47","147"],
+    "Республика Татарстан": ["16","116"],
+    "Республика Башкортостан": ["02","102","702"],
+    "Республика Адыгея": ["01","101"],
+    "Республика Алтай": ["04","104"],
+    "Республика Бурятия": ["03","103"],
+    "Республика Дагестан": ["05","105"],
+    "Республика Ингушетия": ["06","106"],
+    "Кабардино-Балкарская Республика": ["07","107"],
+    "Республика Калмыкия": ["08","108"],
+    "Карачаево-Черкесская Республика": ["09","109"],
+    "Республика Карелия": ["10","110"],
+    "Республика Коми": ["11","111"],
+    "Республика Марий Эл": ["12","112"],
+    "Республика Мордовия": ["13","113"],
+    "Республика Саха (Якутия)": ["14","114"],
+    "Республика Северная Осетия — Алания": ["15","115"],
+    "Республика Тыва": ["17","117"],
+    "Республика Хакасия": ["19","119"],
+    "Удмуртская Республика": ["18","118"],
+    "Чеченская Республика": ["95"],
+    "Чувашская Республика": ["21","121"],
+    "Алтайский край": ["22"],
+    "Краснодарский край": ["23","93","123"],
+    "Красноярский край": ["24","84","124"],
+    "Приморский край": ["25","125"],
+    "Ставропольский край": ["26","126"],
+    "Хабаровский край": ["27"],
+    "Амурская область": ["28"],
+    "Архангельская область": ["29"],
+    "Астраханская область": ["30"],
+    "Белгородская область": ["31"],
+    "Брянская область": ["32"],
+    "Владимирская область": ["33"],
+    "Волгоградская область": ["34","134"],
+    "Вологодская область": ["35"],
+    "Воронежская область": ["36","136"],
+    "Ивановская область": ["37"],
+    "Иркутская область": ["38","138"],
+    "Калининградская область": ["39"],
+    "Калужская область": ["40"],
+    "Камчатский край": ["41"],
+    "Кемеровская область — Кузбасс": ["42","142"],
+    "Кировская область": ["43"],
+    "Костромская область": ["44"],
+    "Курганская область": ["45"],
+    "Курская область": ["46"],
+    "Липецкая область": ["48"],
+    "Магаданская область": ["49"],
+    "Нижегородская область": ["52","152"],
+    "Новгородская область": ["53"],
+    "Новосибирская область": ["54"],
+    "Омская область": ["55"],
+    "Оренбургская область": ["56"],
+    "Орловская область": ["57"],
+    "Пензенская область": ["58"],
+    "Пермский край": ["59","81","159"],
+    "Псковская область": ["60"],
+    "Ростовская область": ["61","161"],
+    "Рязанская область": ["62"],
+    "Самарская область": ["63","163"],
+    "Саратовская область": ["64","164"],
+    "Сахалинская область": ["65"],
+    "Свердловская область": ["66","96","196"],
+    "Смоленская область": ["67"],
+    "Тамбовская область": ["68"],
+    "Тверская область": ["69"],
+    "Томская область": ["70"],
+    "Тульская область": ["71"],
+    "Тюменская область": ["72"],
+    "Ульяновская область": ["73"],
+    "Челябинская область": ["74","174"],
+    "Забайкальский край": ["75"],
+    "Еврейская автономная область": ["79"],
+    "Ненецкий автономный округ": ["83"],
+    "Ханты-Мансийский автономный округ — Югра": ["86","186"],
+    "Чукотский автономный округ": ["87"],
+    "Ямало-Ненецкий автономный округ": ["89"],
+    "Севастополь": ["92"],
+    "Республика Крым": ["82"],
+}
+
+CITIES_FULL = [
+    ("Москва", "Москва"),
+    ("Санкт-Петербург", "Санкт-Петербург"),
+    ("Новосибирск", "Новосибирская область"),
+    ("Екатеринбург", "Свердловская область"),
+    ("Нижний Новгород", "Нижегородская область"),
+    ("Казань", "Республика Татарстан"),
+    ("Челябинск", "Челябинская область"),
+    ("Самара", "Самарская область"),
+    ("Омск", "Омская область"),
+    ("Ростов-на-Дону", "Ростовская область"),
+    ("Уфа", "Республика Башкортостан"),
+    ("Красноярск", "Красноярский край"),
+    ("Пермь", "Пермский край"),
+    ("Воронеж", "Воронежская область"),
+    ("Волгоград", "Волгоградская область"),
+    ("Краснодар", "Краснодарский край"),
+    ("Саратов", "Саратовская область"),
+    ("Тюмень", "Тюменская область"),
+    ("Тольятти", "Самарская область"),
+    ("Ижевск", "Удмуртская Республика"),
+    ("Барнаул", "Алтайский край"),
+    ("Ульяновск", "Ульяновская область"),
+    ("Иркутск", "Иркутская область"),
+    ("Хабаровск", "Хабаровский край"),
+    ("Ярославль", "Ярославская область"),
+    ("Владивосток", "Приморский край"),
+    ("Махачкала", "Республика Дагестан"),
+    ("Томск", "Томская область"),
+    ("Оренбург", "Оренбургская область"),
+    ("Кемерово", "Кемеровская область — Кузбасс"),
+    ("Новокузнецк", "Кемеровская область — Кузбасс"),
+    ("Рязань", "Рязанская область"),
+    ("Астрахань", "Астраханская область"),
+    ("Набережные Челны", "Республика Татарстан"),
+    ("Пенза", "Пензенская область"),
+    ("Липецк", "Липецкая область"),
+    ("Тула", "Тульская область"),
+    ("Калининград", "Калининградская область"),
+    ("Чебоксары", "Чувашская Республика"),
+    ("Брянск", "Брянская область"),
+    ("Курск", "Курская область"),
+    ("Киров", "Кировская область"),
+    ("Орёл", "Орловская область"),
+    ("Белгород", "Белгородская область"),
+    ("Владимир", "Владимирская область"),
+    ("Ставрополь", "Ставропольский край"),
+    ("Нижний Тагил", "Свердловская область"),
+    ("Тамбов", "Тамбовская область"),
+    ("Псков", "Псковская область"),
+    ("Тверь", "Тверская область"),
+    ("Сочи", "Краснодарский край"),
+    ("Калуга", "Калужская область"),
+    ("Смоленск", "Смоленская область"),
+    ("Якутск", "Республика Саха (Якутия)"),
+    ("Кемерово", "Кемеровская область — Кузбасс"),
+    ("Сургут", "Ханты-Мансийский автономный округ — Югра"),
+    ("Тобольск", "Тюменская область"),
+    ("Архангельск", "Архангельская область"),
+    ("Мурманск", "Мурманская область"),
+    ("Петрозаводск", "Республика Карелия"),
+    ("Сыктывкар", "Республика Коми"),
+    ("Владикавказ", "Республика Северная Осетия — Алания"),
+    ("Грозный", "Чеченская Республика"),
+    ("Нальчик", "Кабардино-Балкарская Республика"),
+    ("Элиста", "Республика Калмыкия"),
+    ("Черкесск", "Карачаево-Черкесская Республика"),
+    ("Улан-Удэ", "Республика Бурятия"),
+    ("Чита", "Забайкальский край"),
+    ("Биробиджан", "Еврейская автономная область"),
+    ("Ханты-Мансийск", "Ханты-Мансийский автономный округ — Югра"),
+    ("Нарьян-Мар", "Ненецкий автономный округ"),
+    ("Анадырь", "Чукотский автономный округ"),
+    ("Симферополь", "Республика Крым"),
+    ("Севастополь", "Севастополь"),
+    ("Майкоп", "Республика Адыгея"),
+    ("Саранск", "Республика Мордовия"),
+    ("Красногорск", "Московская область"),
+    ("Гатчина", "Ленинградская область"),
+    ("Салехард", "Ямало-Ненецкий автономный округ"),
+]
+
+PHONE_CODES_CAPITALS = [
+    ("Москва", "Москва", ["495","499"]),
+    ("Санкт-Петербург", "Санкт-Петербург", ["812"]),
+    ("Республика Татарстан", "Казань", ["843"]),
+    ("Республика Башкортостан", "Уфа", ["347"]),
+    ("Пермский край", "Пермь", ["342"]),
+    ("Самарская область", "Самара", ["846"]),
+    ("Саратовская область", "Саратов", ["8452"]),
+    ("Нижегородская область", "Нижний Новгород", ["831"]),
+    ("Ростовская область", "Ростов-на-Дону", ["863"]),
+    ("Краснодарский край", "Краснодар", ["861"]),
+    ("Ставропольский край", "Ставрополь", ["8652"]),
+    ("Воронежская область", "Воронеж", ["473"]),
+    ("Волгоградская область", "Волгоград", ["8442"]),
+    ("Белгородская область", "Белгород", ["4722"]),
+    ("Курская область", "Курск", ["4712"]),
+    ("Брянская область", "Брянск", ["4832"]),
+    ("Смоленская область", "Смоленск", ["4812"]),
+    ("Орловская область", "Орёл", ["4862"]),
+    ("Липецкая область", "Липецк", ["4742"]),
+    ("Тамбовская область", "Тамбов", ["4752"]),
+    ("Тверская область", "Тверь", ["4822"]),
+    ("Ярославская область", "Ярославль", ["4852"]),
+    ("Ивановская область", "Иваново", ["4932"]),
+    ("Владимирская область", "Владимир", ["4922"]),
+    ("Костромская область", "Кострома", ["4942"]),
+    ("Тульская область", "Тула", ["4872"]),
+    ("Рязанская область", "Рязань", ["4912"]),
+    ("Калужская область", "Калуга", ["4842"]),
+    ("Калининградская область", "Калининград", ["4012"]),
+    ("Псковская область", "Псков", ["8112"]),
+    ("Новгородская область", "Великий Новгород", ["8162"]),
+    ("Вологодская область", "Вологда", ["8172"]),
+    ("Архангельская область", "Архангельск", ["8182"]),
+    ("Мурманская область", "Мурманск", ["8152"]),
+    ("Республика Карелия", "Петрозаводск", ["8142"]),
+    ("Республика Коми", "Сыктывкар", ["8212"]),
+    ("Ненецкий автономный округ", "Нарьян-Мар", ["81853"]),
+    ("Севастополь", "Севастополь", ["8692"]),
+    ("Республика Крым", "Симферополь", ["3652"]),
+    ("Свердловская область", "Екатеринбург", ["343"]),
+    ("Челябинская область", "Челябинск", ["351"]),
+    ("Тюменская область", "Тюмень", ["3452"]),
+    ("Курганская область", "Курган", ["3522"]),
+    ("Оренбургская область", "Оренбург", ["3532"]),
+    ("Омская область", "Омск", ["3812"]),
+    ("Томская область", "Томск", ["3822"]),
+    ("Новосибирская область", "Новосибирск", ["383"]),
+    ("Кемеровская область — Кузбасс", "Кемерово", ["3842"]),
+    ("Алтайский край", "Барнаул", ["3852"]),
+    ("Республика Алтай", "Горно-Алтайск", ["38822"]),
+    ("Красноярский край", "Красноярск", ["391"]),
+    ("Иркутская область", "Иркутск", ["3952"]),
+    ("Забайкальский край", "Чита", ["3022"]),
+    ("Республика Бурятия", "Улан-Удэ", ["3012"]),
+    ("Республика Тыва", "Кызыл", ["39422"]),
+    ("Республика Хакасия", "Абакан", ["3902"]),
+    ("Республика Саха (Якутия)", "Якутск", ["4112"]),
+    ("Хабаровский край", "Хабаровск", ["4212"]),
+    ("Приморский край", "Владивосток", ["423"]),
+    ("Еврейская автономная область", "Биробиджан", ["42622"]),
+    ("Сахалинская область", "Южно-Сахалинск", ["4242"]),
+    ("Магаданская область", "Магадан", ["4132"]),
+    ("Камчатский край", "Петропавловск-Камчатский", ["4152"]),
+    ("Чукотский автономный округ", "Анадырь", ["42722"]),
+    ("Удмуртская Республика", "Ижевск", ["3412"]),
+    ("Кировская область", "Киров", ["8332"]),
+    ("Республика Калмыкия", "Элиста", ["84722"]),
+    ("Кабардино-Балкарская Республика", "Нальчик", ["8662"]),
+    ("Карачаево-Черкесская Республика", "Черкесск", ["8782"]),
+    ("Республика Дагестан", "Махачкала", ["8722"]),
+    ("Республика Ингушетия", "Магас", ["8734"]),
+    ("Чеченская Республика", "Грозный", ["8712"]),
+    ("Республика Северная Осетия — Алания", "Владикавказ", ["8672"]),
+    ("Чувашская Республика", "Чебоксары", ["8352"]),
+    ("Республика Марий Эл", "Йошкар-Ола", ["8362"]),
+    ("Пензенская область", "Пенза", ["8412"]),
+    ("Ульяновская область", "Ульяновск", ["8422"]),
+    ("Астраханская область", "Астрахань", ["8512"]),
+    ("Амурская область", "Благовещенск", ["4162"]),
+    ("Республика Татарстан", "Набережные Челны", ["8552"]),
+    ("Свердловская область", "Нижний Тагил", ["3435"]),
+]
+
+# 城市的中文名、别名与坐标
+CITY_DETAILS = [
+    ("Москва", "莫斯科", "Мск, Moscow", 55.7558, 37.6173),
+    ("Санкт-Петербург", "圣彼得堡", "Питер, SPb", 59.9343, 30.3351),
+    ("Новосибирск", "新西伯利亚", "", 55.0302, 82.9206),
+    ("Екатеринбург", "叶卡捷琳堡", "", 56.8389, 60.6057),
+    ("Нижний Новгород", "下诺夫哥罗德", "", 56.2965, 43.9361),
+    ("Казань", "喀山", "", 55.8304, 49.0661),
+]
+
+# 其余城市的市中心坐标：双窗地图与地图缓存键需要坐标，灌库时写入，不访问网络
+CITY_COORDS = {
+    "Уфа": (54.7388, 55.9721),
+    "Пермь": (58.0105, 56.2502),
+    "Самара": (53.1959, 50.1002),
+    "Саратов": (51.5331, 46.0342),
+    "Ростов-на-Дону": (47.2357, 39.7015),
+    "Краснодар": (45.0355, 38.9753),
+    "Ставрополь": (45.0428, 41.9734),
+    "Воронеж": (51.6755, 39.2089),
+    "Волгоград": (48.7080, 44.5133),
+    "Белгород": (50.5954, 36.5873),
+    "Курск": (51.7304, 36.1926),
+    "Брянск": (53.2436, 34.3634),
+    "Смоленск": (54.7826, 32.0453),
+    "Орёл": (52.9703, 36.0635),
+    "Липецк": (52.6088, 39.5992),
+    "Тамбов": (52.7212, 41.4523),
+    "Тверь": (56.8587, 35.9176),
+    "Ярославль": (57.6261, 39.8845),
+    "Иваново": (57.0004, 40.9739),
+    "Владимир": (56.1291, 40.4066),
+    "Кострома": (57.7679, 40.9269),
+    "Тула": (54.1931, 37.6173),
+    "Рязань": (54.6269, 39.6916),
+    "Калуга": (54.5293, 36.2754),
+    "Калининград": (54.7104, 20.4522),
+    "Псков": (57.8136, 28.3496),
+    "Великий Новгород": (58.5215, 31.2755),
+    "Вологда": (59.2181, 39.8886),
+    "Архангельск": (64.5393, 40.5187),
+    "Мурманск": (68.9585, 33.0827),
+    "Петрозаводск": (61.7849, 34.3469),
+    "Сыктывкар": (61.6688, 50.8364),
+    "Нарьян-Мар": (67.6381, 53.0069),
+    "Севастополь": (44.6167, 33.5254),
+    "Симферополь": (44.9521, 34.1024),
+    "Челябинск": (55.1644, 61.4368),
+    "Тюмень": (57.1522, 65.5272),
+    "Курган": (55.4410, 65.3411),
+    "Оренбург": (51.7682, 55.0970),
+    "Омск": (54.9885, 73.3242),
+    "Томск": (56.4846, 84.9476),
+    "Кемерово": (55.3547, 86.0873),
+    "Барнаул": (53.3548, 83.7698),
+    "Горно-Алтайск": (51.9581, 85.9603),
+    "Красноярск": (56.0153, 92.8932),
+    "Иркутск": (52.2870, 104.3050),
+    "Чита": (52.0340, 113.4994),
+    "Улан-Удэ": (51.8335, 107.5841),
+    "Кызыл": (51.7191, 94.4378),
+    "Абакан": (53.7156, 91.4292),
+    "Якутск": (62.0355, 129.6755),
+    "Хабаровск": (48.4802, 135.0719),
+    "Владивосток": (43.1155, 131.8855),
+    "Биробиджан": (48.7946, 132.9217),
+    "Южно-Сахалинск": (46.9591, 142.7380),
+    "Магадан": (59.5682, 150.8085),
+    "Петропавловск-Камчатский": (53.0452, 158.6483),
+    "Анадырь": (64.7337, 177.5089),
+    "Ижевск": (56.8526, 53.2045),
+    "Киров": (58.6036, 49.6680),
+    "Элиста": (46.3078, 44.2558),
+    "Нальчик": (43.4853, 43.6071),
+    "Черкесск": (44.2233, 42.0578),
+    "Махачкала": (42.9849, 47.5047),
+    "Магас": (43.1689, 44.8131),
+    "Грозный": (43.3178, 45.6949),
+    "Владикавказ": (43.0205, 44.6819),
+    "Чебоксары": (56.1439, 47.2489),
+    "Йошкар-Ола": (56.6344, 47.8999),
+    "Пенза": (53.1959, 45.0183),
+    "Ульяновск": (54.3142, 48.4031),
+    "Астрахань": (46.3479, 48.0336),
+    "Благовещенск": (50.2907, 127.5272),
+    "Набережные Челны": (55.7436, 52.3959),
+    "Нижний Тагил": (57.9101, 59.9813),
+    "Тольятти": (53.5303, 49.3461),
+    "Новокузнецк": (53.7557, 87.1099),
+    "Сочи": (43.5855, 39.7231),
+    "Сургут": (61.2540, 73.3962),
+    "Тобольск": (58.1981, 68.2538),
+    "Ханты-Мансийск": (61.0042, 69.0019),
+    "Майкоп": (44.6098, 40.1006),
+    "Саранск": (54.1838, 45.1749),
+    "Красногорск": (55.8204, 37.3302),
+    "Гатчина": (59.5764, 30.1283),
+    "Салехард": (66.5300, 66.6019),
+}
+
+def _ensure_unique_indexes(c):
+    c.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name='ux_phone_codes'")
+    if c.fetchone():
+        return
+    # 旧版本每次启动重复灌库留下的重复行：先把电话区号指向同名城市的最小 id，再删除重复行
+    c.execute("UPDATE phone_codes SET city_id=(SELECT MIN(c2.id) FROM cities c1 JOIN cities c2 ON c2.name_ru=c1.name_ru AND c2.region_id=c1.region_id WHERE c1.id=phone_codes.city_id) WHERE city_id IN (SELECT id FROM cities WHERE region_id IS NOT NULL)")
+    c.execute("DELETE FROM cities WHERE region_id IS NOT NULL AND id NOT IN (SELECT MIN(id) FROM cities WHERE region_id IS NOT NULL GROUP BY name_ru, region_id)")
+    c.execute("DELETE FROM auto_codes WHERE id NOT IN (SELECT MIN(id) FROM auto_codes GROUP BY code, region_id)")
+    c.execute("DELETE FROM phone_codes WHERE id NOT IN (SELECT MIN(id) FROM phone_codes GROUP BY area_code, city_id)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_regions_name ON regions(name_ru)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_cities_name_region ON cities(name_ru, region_id)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_auto_codes ON auto_codes(code, region_id)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_phone_codes ON phone_codes(area_code, city_id)")
+
+def get_seed_version(conn):
+    row = conn.execute("SELECT value FROM meta WHERE key='seed_version'").fetchone()
+    return int(row[0]) if row else None
+
+def _seed_into(conn):
     c = conn.cursor()
-    pairs = [
-        ("Москва", "Москва"),
-        ("Санкт-Петербург", "Санкт-Петербург"),
-        ("Новосибирск", "Новосибирская область"),
-        ("Екатеринбург", "Свердловская область"),
-        ("Нижний Новгород", "Нижегородская область"),
-        ("Казань", "Республика Татарстан"),
-        ("Челябинск", "Челябинская область"),
-        ("Самара", "Самарская область"),
-        ("Омск", "Омская область"),
-        ("Ростов-на-Дону", "Ростовская область"),
-        ("Уфа", "Республика Башкортостан"),
-        ("Красноярск", "Красноярский край"),
-        ("Пермь", "Пермский край"),
-        ("Воронеж", "Воронежская область"),
-        ("Волгоград", "Волгоградская область"),
-        ("Краснодар", "Краснодарский край"),
-        ("Саратов", "Саратовская область"),
-        ("Тюмень", "Тюменская область"),
-        ("Тольятти", "Самарская область"),
-        ("Ижевск", "Удмуртская Республика"),
-        ("Барнаул", "Алтайский край"),
-        ("Ульяновск", "Ульяновская область"),
-        ("Иркутск", "Иркутская область"),
-        ("Хабаровск", "Хабаровский край"),
-        ("Ярославль", "Ярославская область"),
-        ("Владивосток", "Приморский край"),
-        ("Махачкала", "Республика Дагестан"),
-        ("Томск", "Томская область"),
-        ("Оренбург", "Оренбургская область"),
-        ("Кемерово", "Кемеровская область — Кузбасс"),
-        ("Новокузнецк", "Кемеровская область — Кузбасс"),
-        ("Рязань", "Рязанская область"),
-        ("Астрахань", "Астраханская область"),
-        ("Набережные Челны", "Республика Татарстан"),
-        ("Пенза", "Пензенская область"),
-        ("Липецк", "Липецкая область"),
-        ("Тула", "Тульская область"),
-        ("Калининград", "Калининградская область"),
-        ("Чебоксары", "Чувашская Республика"),
-        ("Брянск", "Брянская область"),
-        ("Курск", "Курская область"),
-        ("Киров", "Кировская область"),
-        ("Орёл", "Орловская область"),
-        ("Белгород", "Белгородская область"),
-        ("Владимир", "Владимирская область"),
-        ("Ставрополь", "Ставропольский край"),
-        ("Нижний Тагил", "Свердловская область"),
-        ("Тамбов", "Тамбовская область"),
-        ("Псков", "Псковская область"),
-        ("Тверь", "Тверская область"),
-        ("Сочи", "Краснодарский край"),
-        ("Калуга", "Калужская область"),
-        ("Смоленск", "Смоленская область"),
-        ("Якутск", "Республика Саха (Якутия)"),
-        ("Кемерово", "Кемеровская область — Кузбасс"),
-        ("Сургут", "Ханты-Мансийский автономный округ — Югра"),
-        ("Тобольск", "Тюменская область"),
-        ("Архангельск", "Архангельская область"),
-        ("Мурманск", "Мурманская область"),
-        ("Петрозаводск", "Республика Карелия"),
-        ("Сыктывкар", "Республика Коми"),
-        ("Владикавказ", "Республика Северная Осетия — Алания"),
-        ("Грозный", "Чеченская Республика"),
-        ("Нальчик", "Кабардино-Балкарская Республика"),
-        ("Элиста", "Республика Калмыкия"),
-        ("Черкесск", "Карачаево-Черкесская Республика"),
-        ("Улан-Удэ", "Республика Бурятия"),
-        ("Чита", "Забайкальский край"),
-        ("Биробиджан", "Еврейская автономная область"),
-        ("Ханты-Мансийск", "Ханты-Мансийский автономный округ — Югра"),
-        ("Нарьян-Мар", "Ненецкий автономный округ"),
-        ("Анадырь", "Чукотский автономный округ"),
-        ("Симферополь", "Республика Крым"),
-        ("Севастополь", "Севастополь"),
-    ]
-    for city_name, region_name in pairs:
-        c.execute("SELECT id FROM regions WHERE name_ru=?", (region_name,))
-        rr = c.fetchone()
-        if not rr:
-            continue
-        region_id = rr[0]
-        c.execute("SELECT id FROM cities WHERE name_ru=? AND region_id=?", (city_name, region_id))
-        cr = c.fetchone()
-        if not cr:
-            c.execute("INSERT INTO cities(name_ru,name_zh,region_id,aliases,lat,lon) VALUES(?,?,?,?,?,?)", (city_name, None, region_id, "", None, None))
-    conn.commit()
-    conn.close()
+    with conn:
+        c.executemany("INSERT OR IGNORE INTO regions(name_ru,name_zh) VALUES(?,NULL)", [(name,) for name in REGIONS_FULL])
+        c.executemany(
+            "INSERT OR IGNORE INTO auto_codes(code,region_id) SELECT ?, id FROM regions WHERE name_ru=?",
+            [(code, region) for region, codes in AUTO_CODES_FULL.items() for code in codes],
+        )
+        # 先插入首府城市，使其成为所属地区 id 最小（即默认代表）的城市
+        cities = [(city, region) for region, city, _ in PHONE_CODES_CAPITALS] + list(CITIES_FULL)
+        c.executemany("INSERT OR IGNORE INTO cities(name_ru,name_zh,region_id,aliases,lat,lon) SELECT ?, NULL, id, '', NULL, NULL FROM regions WHERE name_ru=?", cities)
+        c.executemany("UPDATE cities SET name_zh=?, aliases=?, lat=?, lon=? WHERE name_ru=?", [(zh, aliases, lat, lon, name) for name, zh, aliases, lat, lon in CITY_DETAILS])
+        c.executemany("UPDATE cities SET lat=?, lon=? WHERE name_ru=? AND lat IS NULL", [(lat, lon, name) for name, (lat, lon) in CITY_COORDS.items()])
+        c.executemany(
+            "INSERT OR IGNORE INTO phone_codes(area_code,city_id,region_id) SELECT ?, c.id, r.id FROM regions r JOIN cities c ON c.region_id=r.id AND c.name_ru=? WHERE r.name_ru=?",
+            [(code, city, region) for region, city, codes in PHONE_CODES_CAPITALS for code in codes],
+        )
+        # SQLite 的 lower() 只处理 ASCII，规范化名称（casefold、ё→е）在 Python 中计算
+        c.execute("SELECT id,name_ru,name_zh FROM regions")
+        c.executemany("UPDATE regions SET name_norm=?, name_zh_norm=? WHERE id=?", [(_norm(ru) or None, _norm(zh) or None, rid) for rid, ru, zh in c.fetchall()])
+        c.execute("SELECT id,name_ru,name_zh,aliases FROM cities")
+        cities = c.fetchall()
+        c.executemany("UPDATE cities SET name_norm=?, name_zh_norm=? WHERE id=?", [(_norm(ru) or None, _norm(zh) or None, cid) for cid, ru, zh, _ in cities])
+        c.execute("DELETE FROM city_aliases")
+        c.executemany(
+            "INSERT OR IGNORE INTO city_aliases(alias_norm,city_id) VALUES(?,?)",
+            [(_norm(a), cid) for cid, _, _, aliases in cities for a in (aliases or "").split(",") if _norm(a)],
+        )
+        c.execute("INSERT OR REPLACE INTO meta(key,value) VALUES('seed_version',?)", (str(SEED_DATA_VERSION),))
 
-def seed_phone_codes_capitals(geocode_fn=None):
+def seed_reference_data(force=False):
+    """
+    灌入参考数据（地区、城市、车牌代码、电话区号）。
+    存在预构建参考库，或数据库中记录的版本与 SEED_DATA_VERSION 一致时直接返回；否则在单个事务内
+    用 executemany + INSERT OR IGNORE 批量写入（依赖唯一索引去重），不访问网络。
+    返回是否执行了灌库。
+    """
+    if has_ref_db():
+        return False
     conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM phone_codes")
-    existing_count = c.fetchone()[0]
-    mapping = [
-        ("Москва", "Москва", ["495","499"]),
-        ("Санкт-Петербург", "Санкт-Петербург", ["812"]),
-        ("Республика Татарстан", "Казань", ["843"]),
-        ("Республика Башкортостан", "Уфа", ["347"]),
-        ("Пермский край", "Пермь", ["342"]),
-        ("Самарская область", "Самара", ["846"]),
-        ("Саратовская область", "Саратов", ["8452"]),
-        ("Нижегородская область", "Нижний Новгород", ["831"]),
-        ("Ростовская область", "Ростов-на-Дону", ["863"]),
-        ("Краснодарский край", "Краснодар", ["861"]),
-        ("Ставропольский край", "Ставрополь", ["8652"]),
-        ("Воронежская область", "Воронеж", ["473"]),
-        ("Волгоградская область", "Волгоград", ["8442"]),
-        ("Белгородская область", "Белгород", ["4722"]),
-        ("Курская область", "Курск", ["4712"]),
-        ("Брянская область", "Брянск", ["4832"]),
-        ("Смоленская область", "Смоленск", ["4812"]),
-        ("Орловская область", "Орёл", ["4862"]),
-        ("Липецкая область", "Липецк", ["4742"]),
-        ("Тамбовская область", "Тамбов", ["4752"]),
-        ("Тверская область", "Тверь", ["4822"]),
-        ("Ярославская область", "Ярославль", ["4852"]),
-        ("Ивановская область", "Иваново", ["4932"]),
-        ("Владимирская область", "Владимир", ["4922"]),
-        ("Костромская область", "Кострома", ["4942"]),
-        ("Тульская область", "Тула", ["4872"]),
-        ("Рязанская область", "Рязань", ["4912"]),
-        ("Калужская область", "Калуга", ["4842"]),
-        ("Калининградская область", "Калининград", ["4012"]),
-        ("Псковская область", "Псков", ["8112"]),
-        ("Новгородская область", "Великий Новгород", ["8162"]),
-        ("Вологодская область", "Вологда", ["8172"]),
-        ("Архангельская область", "Архангельск", ["8182"]),
-        ("Мурманская область", "Мурманск", ["8152"]),
-        ("Республика Карелия", "Петрозаводск", ["8142"]),
-        ("Республика Коми", "Сыктывкар", ["8212"]),
-        ("Ненецкий автономный округ", "Нарьян-Мар", ["81853"]),
-        ("Севастополь", "Севастополь", ["8692"]),
-        ("Республика Крым", "Симферополь", ["3652"]),
-        ("Свердловская область", "Екатеринбург", ["343"]),
-        ("Челябинская область", "Челябинск", ["351"]),
-        ("Тюменская область", "Тюмень", ["3452"]),
-        ("Курганская область", "Курган", ["3522"]),
-        ("Оренбургская область", "Оренбург", ["3532"]),
-        ("Омская область", "Омск", ["3812"]),
-        ("Томская область", "Томск", ["3822"]),
-        ("Новосибирская область", "Новосибирск", ["383"]),
-        ("Кемеровская область — Кузбасс", "Кемерово", ["3842"]),
-        ("Алтайский край", "Барнаул", ["3852"]),
-        ("Республика Алтай", "Горно-Алтайск", ["38822"]),
-        ("Красноярский край", "Красноярск", ["391"]),
-        ("Иркутская область", "Иркутск", ["3952"]),
-        ("Забайкальский край", "Чита", ["3022"]),
-        ("Республика Бурятия", "Улан-Удэ", ["3012"]),
-        ("Республика Тыва", "Кызыл", ["39422"]),
-        ("Республика Хакасия", "Абакан", ["3902"]),
-        ("Республика Саха (Якутия)", "Якутск", ["4112"]),
-        ("Хабаровский край", "Хабаровск", ["4212"]),
-        ("Приморский край", "Владивосток", ["423"]),
-        ("Еврейская автономная область", "Биробиджан", ["42622"]),
-        ("Сахалинская область", "Южно-Сахалинск", ["4242"]),
-        ("Магаданская область", "Магадан", ["4132"]),
-        ("Камчатский край", "Петропавловск-Камчатский", ["4152"]),
-        ("Чукотский автономный округ", "Анадырь", ["42722"]),
-        ("Удмуртская Республика", "Ижевск", ["3412"]),
-        ("Кировская область", "Киров", ["8332"]),
-        ("Республика Калмыкия", "Элиста", ["84722"]),
-        ("Кабардино-Балкарская Республика", "Нальчик", ["8662"]),
-        ("Карачаево-Черкесская Республика", "Черкесск", ["8782"]),
-        ("Республика Дагестан", "Махачкала", ["8722"]),
-        ("Республика Ингушетия", "Магас", ["8734"]),
-        ("Чеченская Республика", "Грозный", ["8712"]),
-        ("Республика Северная Осетия — Алания", "Владикавказ", ["8672"]),
-        ("Чувашская Республика", "Чебоксары", ["8352"]),
-        ("Республика Марий Эл", "Йошкар-Ола", ["8362"]),
-        ("Пензенская область", "Пенза", ["8412"]),
-        ("Ульяновская область", "Ульяновск", ["8422"]),
-        ("Астраханская область", "Астрахань", ["8512"]),
-        ("Амурская область", "Благовещенск", ["4162"]),
-        ("Архангельская область", "Архангельск", ["8182"]),
-    ]
-    for region_name, city_name, codes in mapping:
-        c.execute("SELECT id FROM regions WHERE name_ru=?", (region_name,))
-        rr = c.fetchone()
-        if not rr:
-            continue
-        region_id = rr[0]
-        c.execute("SELECT id,lat,lon FROM cities WHERE name_ru=? AND region_id=?", (city_name, region_id))
-        cr = c.fetchone()
-        if not cr:
-            lat = None
-            lon = None
-            if geocode_fn:
-                g = geocode_fn(city_name)
-                if g:
-                    lat = g.get("lat")
-                    lon = g.get("lon")
-            c.execute("INSERT INTO cities(name_ru,name_zh,region_id,aliases,lat,lon) VALUES(?,?,?,?,?,?)", (city_name, None, region_id, "", lat, lon))
-            city_id = c.lastrowid
-        else:
-            city_id = cr[0]
-        for ac in codes:
-            c.execute("SELECT COUNT(*) FROM phone_codes WHERE area_code=? AND city_id=?", (ac, city_id))
-            if c.fetchone()[0] == 0:
-                c.execute("INSERT INTO phone_codes(area_code,city_id,region_id) VALUES(?,?,?)", (ac, city_id, region_id))
-    conn.commit()
-    conn.close()
+    try:
+        if not force and get_seed_version(conn) == SEED_DATA_VERSION:
+            return False
+        _seed_into(conn)
+    finally:
+        conn.close()
+    invalidate_index()
+    return True
 
-def seed_phone_codes_capitals():
+def build_reference_db(path=REF_DB_PATH):
+    """
+    生成只读参考库文件：建表、灌库、ANALYZE 并 VACUUM 压实，最后原子替换目标文件。
+    使用回滚日志模式，使生成的文件可以 immutable 方式打开。返回各表行数。
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = path + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    conn = sqlite3.connect(tmp)
     try:
-        from .geocode import geocode_city
-    except Exception:
-        geocode_city = None
-    conn = get_conn()
-    c = conn.cursor()
-    mapping = {
-        "Уфа": ["347"], "Пермь": ["342"], "Самара": ["846"], "Ростов-на-Дону": ["863"],
-        "Волгоград": ["8442"], "Воронеж": ["473"], "Омск": ["3812"], "Томск": ["3822"],
-        "Тула": ["4872"], "Тюмень": ["3452"], "Челябинск": ["351"], "Ярославль": ["4852"],
-        "Иркутск": ["3952"], "Кемерово": ["3842"], "Красноярск": ["391"], "Хабаровск": ["4212"],
-        "Владивосток": ["423"], "Якутск": ["4112"], "Улан-Удэ": ["3012"], "Барнаул": ["3852"],
-        "Астрахань": ["8512"], "Белгород": ["4722"], "Брянск": ["4832"], "Иваново": ["4932"],
-        "Калуга": ["4842"], "Кострома": ["4942"], "Курск": ["4712"], "Липецк": ["4742"],
-        "Псков": ["8112"], "Тверь": ["4822"], "Тамбов": ["4752"], "Смоленск": ["4812"],
-        "Орел": ["4862"], "Пенза": ["8412"], "Ульяновск": ["8422"], "Оренбург": ["3532"],
-        "Киров": ["8332"], "Курган": ["3522"], "Набережные Челны": ["8552"], "Нижний Тагил": ["3435"],
-    }
-    for city_name, codes in mapping.items():
-        c.execute("SELECT id,region_id FROM cities WHERE name_ru=?", (city_name,))
-        row = c.fetchone()
-        if not row and geocode_city:
-            geo = geocode_city(city_name)
-            if geo:
-                region = find_region_by_name(geo.get("region") or "")
-                region_id = region[0] if region else None
-                c.execute("INSERT INTO cities(name_ru,name_zh,region_id,aliases,lat,lon) VALUES(?,?,?,?,?,?)", (city_name, None, region_id, "", geo.get("lat"), geo.get("lon")))
-                city_id = c.lastrowid
-            else:
+        conn.execute("PRAGMA journal_mode=DELETE")
+        _create_reference_schema(conn.cursor())
+        _seed_into(conn)
+        conn.execute("ANALYZE")
+        conn.commit()
+        conn.execute("VACUUM")
+        counts = {t: conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in ("regions", "cities", "auto_codes", "phone_codes")}
+    finally:
+        conn.close()
+    os.replace(tmp, path)
+    invalidate_index()
+    return counts
+
+class ReferenceIndex:
+    """参考数据（地区/城市/车牌代码/电话区号）的只读内存索引，启动时从数据库一次性构建。"""
+
+    def __init__(self, regions, cities, auto_codes, phone_codes):
+        self.regions = {}
+        self.region_list = []
+        for rid, name_ru, name_zh in regions:
+            row = (rid, name_ru, name_zh)
+            self.regions[rid] = row
+            self.region_list.append((row, _norm(name_ru), _norm(name_zh)))
+        self.cities = {}
+        self.city_list = []
+        self.city_by_name = {}
+        self.city_by_alias = {}
+        self.city_by_region = {}
+        for cid, name_ru, name_zh, region_id, aliases, lat, lon in cities:
+            row = (cid, name_ru, name_zh, region_id, lat, lon)
+            self.cities[cid] = row
+            self.city_list.append((row, _norm(name_ru), _norm(aliases)))
+            for key in (_norm(name_ru), _norm(name_zh)):
+                if key:
+                    self.city_by_name.setdefault(key, row)
+            for alias in (aliases or "").split(","):
+                if _norm(alias):
+                    self.city_by_alias.setdefault(_norm(alias), row)
+            self.city_by_region.setdefault(region_id, (cid, name_ru, name_zh, lat, lon))
+        self.region_by_auto_code = {}
+        self.auto_codes_by_region = {}
+        for code, region_id in auto_codes:
+            region = self.regions.get(region_id)
+            if region is None:
                 continue
-        else:
-            if not row:
+            self.region_by_auto_code.setdefault(code, region)
+            self.auto_codes_by_region.setdefault(region_id, []).append(code)
+        self.city_by_phone_code = {}
+        self.phone_codes_by_city = {}
+        for area_code, city_id, region_id in phone_codes:
+            self.phone_codes_by_city.setdefault(city_id, []).append(area_code)
+            city = self.cities.get(city_id)
+            region = self.regions.get(region_id)
+            if city is None or region is None:
                 continue
-            city_id, region_id = row
-        for code in codes:
-            c.execute("INSERT INTO phone_codes(area_code,city_id,region_id) VALUES(?,?,?)", (code, city_id, region_id))
-    conn.commit()
-    conn.close()
+            self.city_by_phone_code.setdefault(area_code, (city[0], city[1], city[2], region[0], region[1], region[2], city[4], city[5]))
+        for codes in self.auto_codes_by_region.values():
+            codes.sort()
+        for codes in self.phone_codes_by_city.values():
+            codes.sort()
+
+    @classmethod
+    def from_db(cls, conn):
+        c = conn.cursor()
+        c.execute("SELECT id,name_ru,name_zh FROM regions ORDER BY id")
+        regions = c.fetchall()
+        c.execute("SELECT id,name_ru,name_zh,region_id,aliases,lat,lon FROM cities ORDER BY id")
+        cities = c.fetchall()
+        c.execute("SELECT code,region_id FROM auto_codes ORDER BY id")
+        auto_codes = c.fetchall()
+        c.execute("SELECT area_code,city_id,region_id FROM phone_codes ORDER BY id")
+        phone_codes = c.fetchall()
+        return cls(regions, cities, auto_codes, phone_codes)
+
+    def find_city_by_name(self, name):
+        key = _norm(name)
+        row = self.city_by_name.get(key) or self.city_by_alias.get(key)
+        if row:
+            return row
+        for row, name_norm, _ in self.city_list:
+            if key in name_norm:
+                return row
+        for row, _, aliases_norm in self.city_list:
+            if key in aliases_norm:
+                return row
+        return None
+
+    def find_city_by_name_fuzzy(self, text):
+        q = _norm(text)
+        tokens = [t for t in q.replace(',', ' ').split() if t]
+        if tokens:
+            key = tokens[0]
+            hits = [row for row, name_norm, _ in self.city_list if key in name_norm]
+            if hits:
+                return min(hits, key=lambda r: len(r[1] or ""))
+        hits = [row for row, _, aliases_norm in self.city_list if q in aliases_norm]
+        if hits:
+            return min(hits, key=lambda r: len(r[1] or ""))
+        return None
+
+    def find_region_by_name(self, name):
+        key = _norm(name)
+        for row, ru, zh in self.region_list:
+            if key in ru or key in zh:
+                return row
+        return None
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_index():
+    global _index
+    if LOOKUP_BACKEND != "memory":
+        return None
+    idx = _index
+    if idx is not None:
+        return idx
+    with _index_lock:
+        if _index is None:
+            _index = ReferenceIndex.from_db(get_read_conn())
+        return _index
+
+def invalidate_index():
+    # 种子数据变化后丢弃旧索引（含模糊匹配索引），下次查询时重建
+    global _index
+    with _index_lock:
+        _index = None
+    from .fuzzy import invalidate_matcher
+    invalidate_matcher()
+
+# SQL 后端使用的查询语句。除标注为兜底的子串扫描外都应命中索引，由 explain_lookups() 检查
+_CITY_COLS = "id,name_ru,name_zh,region_id,lat,lon"
+LOOKUP_SQL = {
+    "city_exact": f"SELECT {_CITY_COLS} FROM cities WHERE name_norm=? ORDER BY id LIMIT 1",
+    "city_exact_zh": f"SELECT {_CITY_COLS} FROM cities WHERE name_zh_norm=? ORDER BY id LIMIT 1",
+    "city_alias": f"SELECT c.id,c.name_ru,c.name_zh,c.region_id,c.lat,c.lon FROM city_aliases a JOIN cities c ON c.id=a.city_id WHERE a.alias_norm=? ORDER BY c.id LIMIT 1",
+    "city_prefix": f"SELECT {_CITY_COLS} FROM cities WHERE name_norm>=? AND name_norm<? ORDER BY id LIMIT 1",
+    "city_prefix_shortest": f"SELECT {_CITY_COLS} FROM cities WHERE name_norm>=? AND name_norm<? ORDER BY length(name_ru), id LIMIT 1",
+    "city_alias_prefix": f"SELECT c.id,c.name_ru,c.name_zh,c.region_id,c.lat,c.lon FROM city_aliases a JOIN cities c ON c.id=a.city_id WHERE a.alias_norm>=? AND a.alias_norm<? ORDER BY length(c.name_ru), c.id LIMIT 1",
+    "region_by_id": "SELECT id,name_ru,name_zh FROM regions WHERE id=?",
+    "region_exact": "SELECT id,name_ru,name_zh FROM regions WHERE name_norm=? ORDER BY id LIMIT 1",
+    "region_exact_zh": "SELECT id,name_ru,name_zh FROM regions WHERE name_zh_norm=? ORDER BY id LIMIT 1",
+    "region_prefix": "SELECT id,name_ru,name_zh FROM regions WHERE name_norm>=? AND name_norm<? ORDER BY id LIMIT 1",
+    "city_by_region": "SELECT id,name_ru,name_zh,lat,lon FROM cities WHERE region_id=? ORDER BY id ASC LIMIT 1",
+    "region_by_auto_code": "SELECT r.id,r.name_ru,r.name_zh FROM auto_codes a JOIN regions r ON a.region_id=r.id WHERE a.code=?",
+    "auto_codes_by_region": "SELECT code FROM auto_codes WHERE region_id=? ORDER BY code",
+    "city_by_phone_code": "SELECT c.id,c.name_ru,c.name_zh,r.id,r.name_ru,r.name_zh,c.lat,c.lon FROM phone_codes p JOIN cities c ON p.city_id=c.id JOIN regions r ON p.region_id=r.id WHERE p.area_code=?",
+    "phone_codes_by_city": "SELECT area_code FROM phone_codes WHERE city_id=? ORDER BY area_code",
+}
+# 兜底：前缀与别名都未命中时才做子串扫描（规范化列上比较，不再逐行调用 lower()）
+_CITY_SUBSTR_SQL = f"SELECT {_CITY_COLS} FROM cities WHERE instr(name_norm, ?) > 0 ORDER BY id LIMIT 1"
+_CITY_SUBSTR_SHORTEST_SQL = f"SELECT {_CITY_COLS} FROM cities WHERE instr(name_norm, ?) > 0 ORDER BY length(name_ru), id LIMIT 1"
+_REGION_SUBSTR_SQL = "SELECT id,name_ru,name_zh FROM regions WHERE instr(name_norm, ?) > 0 OR instr(name_zh_norm, ?) > 0 ORDER BY id LIMIT 1"
+
+def _fetchone(sql, params):
+    return get_read_conn().execute(sql, params).fetchone()
+
+def explain_lookups(conn=None):
+    """
+    对 LOOKUP_SQL 中的每条语句执行 EXPLAIN QUERY PLAN，返回 [(名称, 计划文本, 是否全部走索引)]。
+    计划中出现对表的 SCAN（全表扫描）即视为失败。
+    """
+    conn = conn or get_read_conn()
+    results = []
+    for name, sql in LOOKUP_SQL.items():
+        params = [""] * sql.count("?")
+        details = [r[3] for r in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()]
+        ok = not any(d.startswith("SCAN") for d in details)
+        results.append((name, "; ".join(details), ok))
+    return results
 
 def find_city_by_name(name):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT id,name_ru,name_zh,region_id,lat,lon FROM cities WHERE lower(name_ru)=lower(?) OR lower(name_zh)=lower(?)", (name, name))
-    row = c.fetchone()
-    if not row:
-        c.execute("SELECT id,name_ru,name_zh,region_id,lat,lon FROM cities WHERE lower(name_ru) LIKE lower(?)", (f"%{name}%",))
-        row = c.fetchone()
-    if not row:
-        c.execute("SELECT id,name_ru,name_zh,region_id,lat,lon FROM cities WHERE aliases LIKE ?", (f"%{name}%",))
-        row = c.fetchone()
-    conn.close()
-    return row
+    idx = get_index()
+    if idx is not None:
+        return idx.find_city_by_name(name)
+    key = _norm(name)
+    if not key:
+        return None
+    return (
+        _fetchone(LOOKUP_SQL["city_exact"], (key,))
+        or _fetchone(LOOKUP_SQL["city_exact_zh"], (key,))
+        or _fetchone(LOOKUP_SQL["city_alias"], (key,))
+        or _fetchone(LOOKUP_SQL["city_prefix"], _prefix_range(key))
+        or _fetchone(_CITY_SUBSTR_SQL, (key,))
+        or _fetchone(LOOKUP_SQL["city_alias_prefix"], _prefix_range(key))
+    )
 
-def find_city_by_name_fuzzy(text):
-    conn = get_conn()
-    c = conn.cursor()
-    q = text.lower().strip()
+def _find_city_by_substring(text):
+    idx = get_index()
+    if idx is not None:
+        return idx.find_city_by_name_fuzzy(text)
+    q = _norm(text)
     tokens = [t for t in q.replace(',', ' ').split() if t]
     if tokens:
         key = tokens[0]
-        c.execute("SELECT id,name_ru,name_zh,region_id,lat,lon FROM cities WHERE lower(name_ru) LIKE ? ORDER BY length(name_ru) ASC", (f"%{key}%",))
-        row = c.fetchone()
+        row = _fetchone(LOOKUP_SQL["city_prefix_shortest"], _prefix_range(key)) or _fetchone(_CITY_SUBSTR_SHORTEST_SQL, (key,))
         if row:
-            conn.close()
             return row
-    c.execute("SELECT id,name_ru,name_zh,region_id,lat,lon FROM cities WHERE aliases LIKE ? ORDER BY length(name_ru) ASC", (f"%{q}%",))
-    row = c.fetchone()
-    conn.close()
-    return row
+    if not q:
+        return None
+    return _fetchone(LOOKUP_SQL["city_alias"], (q,)) or _fetchone(LOOKUP_SQL["city_alias_prefix"], _prefix_range(q))
+
+def find_city_by_name_fuzzy(text):
+    # 先做子串/前缀匹配；未命中时用三元组相似度纠正拼写错误和拉丁转写，避免落到 Nominatim
+    row = _find_city_by_substring(text)
+    if row:
+        return row
+    from .fuzzy import get_matcher
+    return get_matcher().best(text)
 
 def get_region_by_id(region_id):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT id,name_ru,name_zh FROM regions WHERE id=?", (region_id,))
-    row = c.fetchone()
-    conn.close()
-    return row
+    idx = get_index()
+    if idx is not None:
+        return idx.regions.get(region_id)
+    return _fetchone(LOOKUP_SQL["region_by_id"], (region_id,))
 
 def find_region_by_name(name):
-    conn = get_conn()
-    c = conn.cursor()
-    like = f"%{name}%"
-    c.execute("SELECT id,name_ru,name_zh FROM regions WHERE lower(name_ru) LIKE lower(?) OR lower(name_zh) LIKE lower(?)", (like, like))
-    row = c.fetchone()
-    conn.close()
-    return row
+    idx = get_index()
+    if idx is not None:
+        return idx.find_region_by_name(name)
+    key = _norm(name)
+    return (
+        _fetchone(LOOKUP_SQL["region_exact"], (key,))
+        or _fetchone(LOOKUP_SQL["region_exact_zh"], (key,))
+        or _fetchone(LOOKUP_SQL["region_prefix"], _prefix_range(key))
+        or _fetchone(_REGION_SUBSTR_SQL, (key, key))
+    )
 
 def get_city_by_region(region_id):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT id,name_ru,name_zh,lat,lon FROM cities WHERE region_id=? ORDER BY id ASC", (region_id,))
-    row = c.fetchone()
-    conn.close()
-    return row
+    idx = get_index()
+    if idx is not None:
+        return idx.city_by_region.get(region_id)
+    return _fetchone(LOOKUP_SQL["city_by_region"], (region_id,))
 
 def find_region_by_auto_code(code):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT r.id,r.name_ru,r.name_zh FROM auto_codes a JOIN regions r ON a.region_id=r.id WHERE a.code=?", (code,))
-    row = c.fetchone()
-    conn.close()
-    return row
+    idx = get_index()
+    if idx is not None:
+        return idx.region_by_auto_code.get(code)
+    return _fetchone(LOOKUP_SQL["region_by_auto_code"], (code,))
 
 def list_auto_codes_by_region(region_id):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT code FROM auto_codes WHERE region_id=? ORDER BY code", (region_id,))
-    rows = [r[0] for r in c.fetchall()]
-    conn.close()
-    return rows
+    idx = get_index()
+    if idx is not None:
+        return list(idx.auto_codes_by_region.get(region_id, []))
+    return [r[0] for r in get_read_conn().execute(LOOKUP_SQL["auto_codes_by_region"], (region_id,)).fetchall()]
 
 def find_city_by_phone_code(area_code):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT c.id,c.name_ru,c.name_zh,r.id,r.name_ru,r.name_zh,c.lat,c.lon FROM phone_codes p JOIN cities c ON p.city_id=c.id JOIN regions r ON p.region_id=r.id WHERE p.area_code=?", (area_code,))
-    row = c.fetchone()
-    conn.close()
-    return row
+    idx = get_index()
+    if idx is not None:
+        return idx.city_by_phone_code.get(area_code)
+    return _fetchone(LOOKUP_SQL["city_by_phone_code"], (area_code,))
 
 def list_phone_codes_by_city(city_id):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT area_code FROM phone_codes WHERE city_id=? ORDER BY area_code", (city_id,))
-    rows = [r[0] for r in c.fetchall()]
-    conn.close()
-    return rows
+    idx = get_index()
+    if idx is not None:
+        return list(idx.phone_codes_by_city.get(city_id, []))
+    return [r[0] for r in get_read_conn().execute(LOOKUP_SQL["phone_codes_by_city"], (city_id,)).fetchall()]
+
+# 批量查询：每组参数一条 IN (...) 语句（内存后端直接查索引），返回以参数为键的字典，未找到的键不出现
+def _in_params(values):
+    return ",".join("?" * len(values))
+
+def get_regions_by_ids(region_ids):
+    ids = list(set(region_ids))
+    if not ids:
+        return {}
+    idx = get_index()
+    if idx is not None:
+        return {rid: idx.regions[rid] for rid in ids if rid in idx.regions}
+    rows = get_read_conn().execute(f"SELECT id,name_ru,name_zh FROM regions WHERE id IN ({_in_params(ids)})", ids).fetchall()
+    return {row[0]: row for row in rows}
+
+def find_regions_by_auto_codes(codes):
+    codes = list(set(codes))
+    if not codes:
+        return {}
+    idx = get_index()
+    if idx is not None:
+        return {code: idx.region_by_auto_code[code] for code in codes if code in idx.region_by_auto_code}
+    rows = get_read_conn().execute(f"SELECT a.code,r.id,r.name_ru,r.name_zh FROM auto_codes a JOIN regions r ON a.region_id=r.id WHERE a.code IN ({_in_params(codes)}) ORDER BY a.id", codes).fetchall()
+    out = {}
+    for code, rid, name_ru, name_zh in rows:
+        out.setdefault(code, (rid, name_ru, name_zh))
+    return out
+
+def list_auto_codes_by_regions(region_ids):
+    ids = list(set(region_ids))
+    if not ids:
+        return {}
+    idx = get_index()
+    if idx is not None:
+        return {rid: list(idx.auto_codes_by_region.get(rid, [])) for rid in ids}
+    out = {rid: [] for rid in ids}
+    for rid, code in get_read_conn().execute(f"SELECT region_id,code FROM auto_codes WHERE region_id IN ({_in_params(ids)}) ORDER BY region_id,code", ids):
+        out[rid].append(code)
+    return out
+
+def find_cities_by_phone_codes(codes):
+    codes = list(set(codes))
+    if not codes:
+        return {}
+    idx = get_index()
+    if idx is not None:
+        return {code: idx.city_by_phone_code[code] for code in codes if code in idx.city_by_phone_code}
+    rows = get_read_conn().execute(f"SELECT p.area_code,c.id,c.name_ru,c.name_zh,r.id,r.name_ru,r.name_zh,c.lat,c.lon FROM phone_codes p JOIN cities c ON p.city_id=c.id JOIN regions r ON p.region_id=r.id WHERE p.area_code IN ({_in_params(codes)}) ORDER BY p.id", codes).fetchall()
+    out = {}
+    for row in rows:
+        out.setdefault(row[0], tuple(row[1:]))
+    return out
+
+def list_phone_codes_by_cities(city_ids):
+    ids = list(set(city_ids))
+    if not ids:
+        return {}
+    idx = get_index()
+    if idx is not None:
+        return {cid: list(idx.phone_codes_by_city.get(cid, [])) for cid in ids}
+    out = {cid: [] for cid in ids}
+    for cid, code in get_read_conn().execute(f"SELECT city_id,area_code FROM phone_codes WHERE city_id IN ({_in_params(ids)}) ORDER BY city_id,area_code", ids):
+        out[cid].append(code)
+    return out
+
+def get_cities_by_regions(region_ids):
+    ids = list(set(region_ids))
+    if not ids:
+        return {}
+    idx = get_index()
+    if idx is not None:
+        return {rid: idx.city_by_region[rid] for rid in ids if rid in idx.city_by_region}
+    out = {}
+    for rid, *city in get_read_conn().execute(f"SELECT region_id,id,name_ru,name_zh,lat,lon FROM cities WHERE region_id IN ({_in_params(ids)}) ORDER BY id", ids):
+        out.setdefault(rid, tuple(city))
+    return out
 
 def save_query(user_id, language, intent, raw_text, parsed_entities, result, created_at):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("INSERT INTO queries(user_id,language,intent,raw_text,parsed_entities,result,created_at) VALUES(?,?,?,?,?,?,?)", (user_id, language, intent, raw_text, parsed_entities, result, created_at))
-    conn.commit()
-    conn.close()
+    with write_conn() as conn:
+        conn.execute("INSERT INTO queries(user_id,language,intent,raw_text,parsed_entities,result,created_at) VALUES(?,?,?,?,?,?,?)", (user_id, language, intent, raw_text, parsed_entities, result, created_at))
+
+def save_queries(rows):
+    with write_conn() as conn:
+        conn.executemany("INSERT INTO queries(user_id,language,intent,raw_text,parsed_entities,result,created_at) VALUES(?,?,?,?,?,?,?)", rows)
+
+def get_file_id(content_key):
+    c = get_read_conn().cursor()
+    c.execute("SELECT file_id FROM tg_files WHERE content_key=?", (content_key,))
+    row = c.fetchone()
+    return row[0] if row else None
+
+def save_file_id(content_key, kind, file_id, created_at):
+    with write_conn() as conn:
+        conn.execute("INSERT OR REPLACE INTO tg_files(content_key,kind,file_id,created_at) VALUES(?,?,?,?)", (content_key, kind, file_id, created_at))
+
+def delete_file_id(content_key):
+    with write_conn() as conn:
+        conn.execute("DELETE FROM tg_files WHERE content_key=?", (content_key,))
+
+def get_geocode_cache(kind, lang, query, now):
+    # 返回 (result_json, expires_at)；result_json 为 None 表示缓存的“未找到”；无有效缓存时返回 None
+    c = get_read_conn().cursor()
+    c.execute("SELECT result,expires_at FROM geocode_cache WHERE kind=? AND lang=? AND query=? AND expires_at>?", (kind, lang, query, now))
+    return c.fetchone()
+
+def put_geocode_cache(kind, lang, query, result, expires_at):
+    with write_conn() as conn:
+        conn.execute("INSERT OR REPLACE INTO geocode_cache(kind,lang,query,result,expires_at) VALUES(?,?,?,?,?)", (kind, lang, query, result, expires_at))
+
+# 基准测试的查询组合：按线上比例混合城市名、车牌代码和电话区号查询
+BENCH_LOOKUPS = [
+    ("city_exact", ("москва",)), ("city_exact", ("казань",)), ("city_exact_zh", ("莫斯科",)),
+    ("city_alias", ("питер",)), ("city_prefix", _prefix_range("екатерин")),
+    ("region_by_auto_code", ("77",)), ("region_by_auto_code", ("199",)), ("region_by_auto_code", ("116",)),
+    ("auto_codes_by_region", (1,)), ("city_by_region", (1,)),
+    ("city_by_phone_code", ("495",)), ("city_by_phone_code", ("3435",)), ("phone_codes_by_city", (1,)),
+]
+
+def _fetchone_unpooled(sql, params):
+    # 连接池之前的做法：每次查询新建并关闭一个连接
+    conn = _open_read_conn()
+    try:
+        return conn.execute(sql, params).fetchone()
+    finally:
+        conn.close()
+
+def _save_query_unpooled(row):
+    conn = sqlite3.connect(DATA_DB_PATH)
+    try:
+        conn.execute("INSERT INTO queries(user_id,language,intent,raw_text,parsed_entities,result,created_at) VALUES(?,?,?,?,?,?,?)", row)
+        conn.commit()
+    finally:
+        conn.close()
+
+def bench(rounds=500, writes=300):
+    """
+    SQL 查询与查询日志写入的前后对比：每次新建连接（连接池之前）与按线程复用的连接池。
+    返回 {项目: (之前 次/秒, 之后 次/秒)}。写入的基准行在结束时删除。
+    """
+    import time
+    results = {}
+    for name, fetch in (("before", _fetchone_unpooled), ("after", _fetchone)):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for key, params in BENCH_LOOKUPS:
+                fetch(LOOKUP_SQL[key], params)
+        results.setdefault("lookups", []).append(rounds * len(BENCH_LOOKUPS) / (time.perf_counter() - start))
+    row = ("bench", "ru", "bench", "Москва", "{}", "{}", "1970-01-01T00:00:00")
+    try:
+        for name, save in (("before", _save_query_unpooled), ("after", lambda r: save_query(*r))):
+            start = time.perf_counter()
+            for _ in range(writes):
+                save(row)
+            results.setdefault("writes", []).append(writes / (time.perf_counter() - start))
+    finally:
+        with write_conn() as conn:
+            conn.execute("DELETE FROM queries WHERE user_id='bench'")
+    return {k: tuple(v) for k, v in results.items()}
+
+if __name__ == "__main__":
+    import sys
+    parser = argparse.ArgumentParser(description="Reference database tools")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("build-ref", help="build the read-only reference database at REF_DB_PATH")
+    sub.add_parser("explain", help="check that every SQL lookup statement is served by an index")
+    bn = sub.add_parser("bench", help="SQL lookup and query-log write throughput, per-query connections vs pooled")
+    bn.add_argument("--rounds", type=int, default=500)
+    bn.add_argument("--writes", type=int, default=300)
+    bn.add_argument("--min-speedup", type=float, default=1.0, help="fail unless pooled lookups are at least this many times faster than per-query connections in the same run")
+    bn.add_argument("--target", type=float, default=None, help="also fail below this many pooled lookups per second (off by default)")
+    args = parser.parse_args()
+    if args.cmd == "build-ref":
+        counts = build_reference_db()
+        print(f"Wrote {REF_DB_PATH} (v{SEED_DATA_VERSION}): " + ", ".join(f"{k}={v}" for k, v in counts.items()))
+    elif args.cmd == "explain":
+        init_schema()
+        seed_reference_data()
+        results = explain_lookups()
+        for name, plan, ok in results:
+            print(f"{'OK  ' if ok else 'FAIL'} {name}: {plan}")
+        close_conns()
+        sys.exit(0 if all(ok for _, _, ok in results) else 1)
+    elif args.cmd == "bench":
+        init_schema()
+        seed_reference_data()
+        results = bench(args.rounds, args.writes)
+        for name, (before, after) in results.items():
+            print(f"{name}: {before:,.0f}/s -> {after:,.0f}/s (x{after / before:.1f})")
+        before, after = results["lookups"]
+        ok = after >= before * args.min_speedup and (not args.target or after >= args.target)
+        print(f"{'OK' if ok else 'FAIL'}: pooled lookups x{after / before:.1f} (min x{args.min_speedup:g})" + (f", target {args.target:,.0f}/s" if args.target else ""))
+        close_conns()
+        sys.exit(0 if ok else 1)
@@ -0,0 +1,171 @@
+import sys
+import time
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import httpx
+
+from .config import HTTP_POOL_SIZE, MAP_FETCH_DEADLINE
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = "Mozilla/5.0"
+
+_client = None
+_executor = None
+_lock = threading.Lock()
+
+def get_client():
+    # 全局共享的 keep-alive 连接池，避免每张图片重新握手
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = httpx.Client(
+                    headers={"User-Agent": USER_AGENT},
+                    limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE),
+                    timeout=httpx.Timeout(10.0, connect=5.0),
+                    follow_redirects=True,
+                    trust_env=False,
+                )
+    return _client
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE, thread_name_prefix="fetch")
+    return _executor
+
+def fetch(url, timeout=10.0, headers=None):
+    resp = get_client().get(url, timeout=timeout, headers=headers)
+    resp.raise_for_status()
+    return resp.content
+
+def _fetch_chain(urls, deadline):
+    # 依次尝试同一面板的多个来源，每次请求的超时不超过剩余时间
+    for url in urls:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            return fetch(url, timeout=remaining)
+        except Exception as e:
+            logger.warning(f"Fetch failed for {url}: {e}")
+    return None
+
+def fetch_all(chains, deadline=None):
+    """
+    并行下载多组 URL。每组是同一资源的回退链，返回与 chains 对应的字节列表（失败为 None）。
+    所有请求共享一个总截止时间，超时未完成的组按失败处理。
+    """
+    if deadline is None:
+        deadline = MAP_FETCH_DEADLINE
+    until = time.monotonic() + deadline
+    futures = [_get_executor().submit(_fetch_chain, urls, until) for urls in chains]
+    wait(futures, timeout=max(0.0, until - time.monotonic()) + 0.05)
+    results = []
+    for fut in futures:
+        if fut.done() and not fut.cancelled() and fut.exception() is None:
+            results.append(fut.result())
+        else:
+            fut.cancel()
+            results.append(None)
+    return results
+
+def close():
+    global _client, _executor
+    with _lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+class _StubTileServer:
+    """本地 HTTP 桩：/tile?ms=延迟毫秒&status=状态码，返回固定字节（body），用于离线测量下载延迟。"""
+
+    def __init__(self, body=b"tile"):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        from urllib.parse import urlparse, parse_qs
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                q = parse_qs(urlparse(self.path).query)
+                time.sleep(int(q.get("ms", ["0"])[0]) / 1000.0)
+                status = int(q.get("status", ["200"])[0])
+                data = body if status == 200 else b"error"
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                except OSError:
+                    # 客户端已按截止时间放弃请求
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def url(self, ms=0, status=200):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/tile?ms={ms}&status={status}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+def check(delay_ms=300, panels=4):
+    """
+    对本地桩服务器测量 fetch_all：并行下载的总耗时应接近单个请求而不是逐个相加；
+    超过截止时间的请求按失败返回且不拖长总耗时；回退链在首个来源出错时使用下一个来源。
+    返回 [(检查项, 是否通过, 说明)]。
+    """
+    results = []
+    with _StubTileServer() as stub:
+        fetch_all([[stub.url()]], deadline=5)  # 预热连接池
+        start = time.monotonic()
+        for _ in range(panels):
+            _fetch_chain([stub.url(delay_ms)], time.monotonic() + 5)
+        serial = time.monotonic() - start
+        start = time.monotonic()
+        data = fetch_all([[stub.url(delay_ms)] for _ in range(panels)], deadline=5)
+        parallel = time.monotonic() - start
+        ok = all(d == b"tile" for d in data) and parallel < delay_ms / 1000.0 * 1.5
+        results.append(("parallel", ok, f"{panels} panels x {delay_ms} ms: serial {serial * 1000:.0f} ms, fetch_all {parallel * 1000:.0f} ms"))
+
+        deadline = delay_ms / 1000.0
+        start = time.monotonic()
+        data = fetch_all([[stub.url(delay_ms * 10)], [stub.url(delay_ms // 3)]], deadline=deadline)
+        elapsed = time.monotonic() - start
+        ok = data[0] is None and data[1] == b"tile" and elapsed < deadline + 0.2
+        results.append(("deadline", ok, f"deadline {deadline * 1000:.0f} ms: returned in {elapsed * 1000:.0f} ms, slow={data[0]!r} fast={data[1]!r}"))
+
+        start = time.monotonic()
+        data = fetch_all([[stub.url(status=503), stub.url()]], deadline=5)
+        elapsed = time.monotonic() - start
+        results.append(("fallback", data[0] == b"tile", f"503 then 200: {data[0]!r} in {elapsed * 1000:.0f} ms"))
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latency check of fetch_all against a local stub tile server")
+    parser.add_argument("--delay-ms", type=int, default=300, help="artificial per-request latency of the stub")
+    parser.add_argument("--panels", type=int, default=4)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+    results = check(args.delay_ms, args.panels)
+    for name, ok, detail in results:
+        print(f"{'OK  ' if ok else 'FAIL'} {name}: {detail}")
+    close()
+    sys.exit(0 if all(ok for _, ok, _ in results) else 1)
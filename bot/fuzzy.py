@@ -0,0 +1,171 @@
+import sys
+import sqlite3
+import argparse
+import threading
+
+from .config import CITY_FUZZY_THRESHOLD, CITY_FUZZY_MARGIN, CITY_FUZZY_LENGTH_RATIO
+from .db import _norm, get_read_conn
+
+# 俄文 -> 拉丁转写（接近 BGN/PCGN），用于匹配 "Novosibirsk"、"Nizhniy Novgorod" 等拉丁输入
+TRANSLIT = {
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ж": "zh", "з": "z",
+    "и": "i", "й": "y", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p",
+    "р": "r", "с": "s", "т": "t", "у": "u", "ф": "f", "х": "kh", "ц": "ts", "ч": "ch",
+    "ш": "sh", "щ": "shch", "ъ": "", "ы": "y", "ь": "", "э": "e", "ю": "yu", "я": "ya",
+}
+
+# 不同转写方案的常见差异统一成一种写法（两侧都做），如 Nizhniy/Nizhnij/Nizhny、Khabarovsk/Habarovsk
+_LATIN_FOLD = (("'", ""), ("kh", "h"), ("ij", "y"), ("iy", "y"), ("yy", "y"), ("j", "y"))
+
+def transliterate(s):
+    return "".join(TRANSLIT.get(ch, ch) for ch in s)
+
+def _fold_latin(s):
+    for a, b in _LATIN_FOLD:
+        s = s.replace(a, b)
+    return s
+
+def _key(s):
+    s = _norm(s).replace("-", " ")
+    return " ".join(_fold_latin(s).split())
+
+def trigrams(s):
+    # 与 pg_trgm 相同：前补两个空格、后补一个空格，短词也能产生足够的三元组
+    s = f"  {s} "
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+class CityMatcher:
+    """
+    城市名称的内存三元组（trigram）索引。每个城市以俄文名、中文名、别名及拉丁转写作为匹配键，
+    查询时按 Jaccard 相似度排序，用于拼写错误和拉丁转写输入的本地纠错。
+    """
+
+    def __init__(self, rows):
+        self.rows = []
+        self._keys = []
+        self._postings = {}
+        for cid, name_ru, name_zh, region_id, lat, lon, aliases in rows:
+            row_idx = len(self.rows)
+            self.rows.append((cid, name_ru, name_zh, region_id, lat, lon))
+            names = [name_ru, name_zh, transliterate(_norm(name_ru))] + (aliases or "").split(",")
+            seen = set()
+            for name in names:
+                key = _key(name)
+                if not key or key in seen:
+                    continue
+                seen.add(key)
+                grams = trigrams(key)
+                key_idx = len(self._keys)
+                self._keys.append((row_idx, len(grams), len(key)))
+                for g in grams:
+                    self._postings.setdefault(g, []).append(key_idx)
+
+    @classmethod
+    def from_db(cls, conn):
+        return cls(conn.execute("SELECT id,name_ru,name_zh,region_id,lat,lon,aliases FROM cities ORDER BY id").fetchall())
+
+    def _rank(self, key, threshold):
+        # [(行号, 相似度, 匹配键长度)]，按相似度降序；同一城市只保留最高分的匹配键
+        grams = trigrams(key)
+        shared = {}
+        for g in grams:
+            for key_idx in self._postings.get(g, ()):
+                shared[key_idx] = shared.get(key_idx, 0) + 1
+        best = {}
+        for key_idx, n in shared.items():
+            row_idx, size, length = self._keys[key_idx]
+            score = n / float(len(grams) + size - n)
+            if score >= threshold and score > best.get(row_idx, (0.0, 0))[0]:
+                best[row_idx] = (score, length)
+        return sorted(((row_idx, score, length) for row_idx, (score, length) in best.items()),
+                      key=lambda item: (-item[1], len(self.rows[item[0]][1] or ""), item[0]))
+
+    def search(self, text, limit=5, threshold=CITY_FUZZY_THRESHOLD):
+        """返回 [(城市行, 相似度)]，按相似度降序；同一城市只保留最高分的匹配键。"""
+        key = _key(text)
+        if not key:
+            return []
+        return [(self.rows[row_idx], score) for row_idx, score, _ in self._rank(key, threshold)[:limit]]
+
+    def best(self, text, threshold=CITY_FUZZY_THRESHOLD, margin=CITY_FUZZY_MARGIN, length_ratio=CITY_FUZZY_LENGTH_RATIO):
+        """
+        返回唯一可信的纠正结果，否则返回 None（由调用方回退到地理编码）。
+        除最低分外还要求：领先第二名至少 margin，且查询与匹配名称的长度比不低于 length_ratio，
+        未收录的相近城市（如 "Саранск" 与 "Саратов"）因此不会被纠正成别的城市。
+        """
+        key = _key(text)
+        if not key:
+            return None
+        ranked = self._rank(key, max(0.0, threshold - margin))
+        if not ranked or ranked[0][1] < threshold:
+            return None
+        row_idx, score, length = ranked[0]
+        if len(ranked) > 1 and score - ranked[1][1] < margin:
+            return None
+        if min(len(key), length) < length_ratio * max(len(key), length):
+            return None
+        return self.rows[row_idx]
+
+_matcher = None
+_matcher_lock = threading.Lock()
+
+def get_matcher():
+    global _matcher
+    m = _matcher
+    if m is not None:
+        return m
+    with _matcher_lock:
+        if _matcher is None:
+            _matcher = CityMatcher.from_db(get_read_conn())
+        return _matcher
+
+def invalidate_matcher():
+    global _matcher
+    with _matcher_lock:
+        _matcher = None
+
+# 纠错回归样例：(输入, 期望城市)；期望为 None 的是未收录但与已收录城市相近的名称，必须回退到地理编码
+CHECK_TYPOS = [
+    ("Новосибирк", "Новосибирск"),
+    ("Екатеринбур", "Екатеринбург"),
+    ("Yekaterinburg", "Екатеринбург"),
+    ("Nizhniy Novgorod", "Нижний Новгород"),
+    ("Krasnojarsk", "Красноярск"),
+    ("Habarovsk", "Хабаровск"),
+    ("Volgagrad", "Волгоград"),
+    ("Владивасток", "Владивосток"),
+    ("Мурманськ", "Мурманск"),
+    ("Тюмен", "Тюмень"),
+]
+CHECK_NEAR_MISSES = ["Саранск", "Саров", "Саратовка", "Тамбовка", "Владимировка", "Курганинск", "Краснокамск", "Краснознаменск", "Новгород"]
+
+def check():
+    """
+    在内存库中灌入参考数据后校验纠错结果，返回 [(名称, 是否通过, 说明)]。
+    相近名称用去掉该城市本身的索引检查，已收录的城市（如 Саранск）同样覆盖。
+    """
+    from .db import _create_reference_schema, _seed_into
+    conn = sqlite3.connect(":memory:")
+    _create_reference_schema(conn.cursor())
+    _seed_into(conn)
+    rows = conn.execute("SELECT id,name_ru,name_zh,region_id,lat,lon,aliases FROM cities ORDER BY id").fetchall()
+    conn.close()
+    matcher = CityMatcher(rows)
+    results = []
+    for text, expected in CHECK_TYPOS:
+        row = matcher.best(text)
+        got = row[1] if row else None
+        results.append((text, got == expected, f"-> {got}, expected {expected}"))
+    for text in CHECK_NEAR_MISSES:
+        row = CityMatcher([r for r in rows if _norm(r[1]) != _norm(text)]).best(text)
+        got = row[1] if row else None
+        results.append((text, got is None, f"-> {got}, expected no match"))
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check fuzzy city matching against known typos and near-miss names")
+    parser.parse_args()
+    results = check()
+    for name, ok, detail in results:
+        print(f"{'OK  ' if ok else 'FAIL'} {name}: {detail}")
+    sys.exit(0 if all(ok for _, ok, _ in results) else 1)
@@ -1,14 +1,207 @@
-import urllib.parse
-import urllib.request
+import sys
 import json
+import time
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+
+import httpx
+
+from .config import GEOCODE_CACHE_ITEMS, GEOCODE_CACHE_TTL, GEOCODE_NEGATIVE_TTL, NOMINATIM_URL, NOMINATIM_RATE, NOMINATIM_MAX_WAIT, NOMINATIM_RETRIES, NOMINATIM_TIMEOUT
+from .ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+class SingleFlight:
+    """同一 key 的并发调用只执行一次，其余调用方等待并共享结果（或异常）。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"event": threading.Event(), "result": None, "error": None}
+                self._calls[key] = call
+        if not leader:
+            call["event"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except BaseException as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call["event"].set()
+
+class NominatimBusy(Exception):
+    """Nominatim 暂时无法服务（限速排队已满、请求超时或重试后仍为 429/5xx），调用方应回复“繁忙”。"""
+
+class NominatimClient:
+    """
+    Nominatim 搜索客户端：全局令牌桶限速（默认 1 次/秒），相同请求合并，
+    429/5xx 按指数退避重试（遵循 Retry-After），共享 keep-alive 连接。
+    同步调用，供种子函数和工作线程使用（异步处理函数经 geocode_pool 调用）。
+    排队等待超过 max_wait 秒、请求超时或重试耗尽时抛出 NominatimBusy，不阻塞调用方。
+    """
+
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, base_url, rate=1.0, max_wait=10.0, retries=3, timeout=10.0):
+        self.base_url = base_url.rstrip("/")
+        self.bucket = TokenBucket(rate, burst=1)
+        self.max_wait = max_wait
+        self.retries = retries
+        self.timeout = timeout
+        self._flight = SingleFlight()
+        self._client = None
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retried = 0
+        self.rejected = 0
+
+    def _get_client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = httpx.Client(
+                        headers={"User-Agent": "rf-region-bot/1.0"},
+                        limits=httpx.Limits(max_connections=2, max_keepalive_connections=2),
+                        timeout=self.timeout,
+                        trust_env=False,
+                    )
+        return self._client
+
+    def search(self, params):
+        key = tuple(sorted(params.items()))
+        return self._flight.do(key, lambda: self._request("/search", params))
+
+    def _request(self, path, params):
+        delay = 1.0
+        for attempt in range(self.retries + 1):
+            if not self.bucket.acquire(self.max_wait):
+                self.rejected += 1
+                raise NominatimBusy("Nominatim rate limit queue is full")
+            self.requests += 1
+            try:
+                resp = self._get_client().get(self.base_url + path, params=params)
+            except httpx.TimeoutException as e:
+                raise NominatimBusy(f"Nominatim request timed out: {e}") from e
+            if resp.status_code not in self.RETRY_STATUS:
+                resp.raise_for_status()
+                return resp.json()
+            if attempt == self.retries:
+                raise NominatimBusy(f"Nominatim still returned {resp.status_code} after {self.retries} retries")
+            self.retried += 1
+            try:
+                wait = float(resp.headers.get("Retry-After", delay))
+            except ValueError:
+                wait = delay
+            logger.warning(f"Nominatim returned {resp.status_code}, retrying in {wait:.1f}s")
+            time.sleep(min(wait, 30.0))
+            delay *= 2
+
+    def close(self):
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+nominatim = NominatimClient(NOMINATIM_URL, NOMINATIM_RATE, NOMINATIM_MAX_WAIT, NOMINATIM_RETRIES, NOMINATIM_TIMEOUT)
+
+class GeocodeCache:
+    """
+    地理编码结果缓存：内存 LRU -> SQLite geocode_cache 表 -> 上游请求。
+    “未找到”同样缓存（较短 TTL），相同查询的并发请求合并为一次上游调用。
+    网络异常不缓存，直接抛给调用方。
+    """
+
+    def __init__(self, mem_items=1024, ttl=30 * 86400, negative_ttl=86400):
+        self.mem_items = mem_items
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._mem = OrderedDict()
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self.mem_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def _remember(self, key, value, expires_at):
+        with self._lock:
+            self._mem[key] = (value, expires_at)
+            self._mem.move_to_end(key)
+            while len(self._mem) > self.mem_items:
+                self._mem.popitem(last=False)
+
+    def get(self, kind, lang, query, fetch):
+        key = (kind, lang, query.strip().casefold())
+        now = time.time()
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry is not None and entry[1] > now:
+                self._mem.move_to_end(key)
+                self.mem_hits += 1
+                return entry[0]
+        return self._flight.do(key, lambda: self._load(key, fetch))
+
+    def _load(self, key, fetch):
+        from .db import get_geocode_cache, put_geocode_cache
+        now = time.time()
+        try:
+            row = get_geocode_cache(*key, now)
+        except Exception as e:
+            logger.warning(f"Geocode cache read failed: {e}")
+            row = None
+        if row is not None:
+            value = json.loads(row[0]) if row[0] is not None else None
+            with self._lock:
+                self.db_hits += 1
+            # 内存中沿用数据库记录的过期时间，不因读取而延长
+            self._remember(key, value, row[1])
+            return value
+        with self._lock:
+            self.misses += 1
+        value = fetch()
+        expires_at = now + (self.negative_ttl if value is None else self.ttl)
+        try:
+            put_geocode_cache(*key, json.dumps(value, ensure_ascii=False) if value is not None else None, expires_at)
+        except Exception as e:
+            logger.warning(f"Geocode cache write failed: {e}")
+        self._remember(key, value, expires_at)
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {"mem_hits": self.mem_hits, "db_hits": self.db_hits, "misses": self.misses, "mem_items": len(self._mem)}
+
+geocode_cache = GeocodeCache(GEOCODE_CACHE_ITEMS, GEOCODE_CACHE_TTL, GEOCODE_NEGATIVE_TTL)
 
 def geocode_city(name):
+    return geocode_cache.get("city", "ru", name, lambda: _geocode_city(name))
+
+def geocode_region_polygon(name):
+    value = geocode_cache.get("polygon", "ru", name, lambda: _geocode_region_polygon(name))
+    if value is not None:
+        # JSON 往返后 bbox 为列表，恢复为元组
+        value = dict(value, bbox=tuple(value["bbox"]))
+    return value
+
+def geocode_city_label(name, lang="en"):
+    return geocode_cache.get("label", lang, name, lambda: _geocode_city_label(name, lang))
+
+def _geocode_city(name):
     q = name.strip()
-    url = "https://nominatim.openstreetmap.org/search?format=json&addressdetails=1&accept-language=ru&limit=1&q=" + urllib.parse.quote(q)
-    req = urllib.request.Request(url, headers={"User-Agent": "rf-region-bot/1.0"})
-    with urllib.request.urlopen(req, timeout=10) as resp:
-        data = resp.read()
-    arr = json.loads(data.decode("utf-8"))
+    arr = nominatim.search({"format": "json", "addressdetails": "1", "accept-language": "ru", "limit": "1", "q": q})
     if not arr:
         return None
     it = arr[0]
@@ -19,13 +212,9 @@ def geocode_city(name):
     region_ru = addr.get("state") or addr.get("region") or addr.get("county")
     return {"city": city_ru, "region": region_ru, "lat": lat, "lon": lon}
 
-def geocode_region_polygon(name):
+def _geocode_region_polygon(name):
     q = name.strip()
-    url = "https://nominatim.openstreetmap.org/search?format=jsonv2&polygon_geojson=1&limit=1&accept-language=ru&q=" + urllib.parse.quote(q)
-    req = urllib.request.Request(url, headers={"User-Agent": "rf-region-bot/1.0"})
-    with urllib.request.urlopen(req, timeout=10) as resp:
-        data = resp.read()
-    arr = json.loads(data.decode("utf-8"))
+    arr = nominatim.search({"format": "jsonv2", "polygon_geojson": "1", "limit": "1", "accept-language": "ru", "q": q})
     if not arr:
         return None
     it = arr[0]
@@ -40,15 +229,133 @@ def geocode_region_polygon(name):
         maxlon = max([pt[0] for pt in geojson.get("coordinates", [[]])[0]]) if geojson else 0
     return {"geojson": geojson, "bbox": (minlon, minlat, maxlon, maxlat)}
 
-def geocode_city_label(name, lang="en"):
+def _geocode_city_label(name, lang="en"):
     q = name.strip()
-    url = "https://nominatim.openstreetmap.org/search?format=json&addressdetails=1&accept-language=" + lang + "&limit=1&q=" + urllib.parse.quote(q)
-    req = urllib.request.Request(url, headers={"User-Agent": "rf-region-bot/1.0"})
-    with urllib.request.urlopen(req, timeout=10) as resp:
-        data = resp.read()
-    arr = json.loads(data.decode("utf-8"))
+    arr = nominatim.search({"format": "json", "addressdetails": "1", "accept-language": lang, "limit": "1", "q": q})
     if not arr:
         return None
     it = arr[0]
     addr = it.get("address", {})
-    return addr.get("city") or addr.get("town") or addr.get("village") or q
\ No newline at end of file
+    return addr.get("city") or addr.get("town") or addr.get("village") or q
+class _FakeNominatim:
+    """
+    本地假 Nominatim：/search 返回一个固定结果并记录每次请求的时间与查询词。
+    查询词为 retry 时第一次返回 429 + Retry-After，之后正常返回。
+    """
+
+    def __init__(self, retry_after=2):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        from urllib.parse import urlparse, parse_qs
+        fake = self
+        self.retry_after = retry_after
+        self.log = []
+        self._lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                q = parse_qs(urlparse(self.path).query).get("q", [""])[0]
+                with fake._lock:
+                    first = all(seen != q for _, seen in fake.log)
+                    fake.log.append((time.monotonic(), q))
+                if q == "retry" and first:
+                    body = b"[]"
+                    self.send_response(429)
+                    self.send_header("Retry-After", str(fake.retry_after))
+                else:
+                    body = json.dumps([{"lat": "55.75", "lon": "37.62", "address": {"city": q, "state": "Москва"}}]).encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+def _concurrent(n, fn):
+    # n 个线程同时调用 fn(i)，返回结果列表（异常作为结果返回）
+    results = [None] * n
+    barrier = threading.Barrier(n)
+
+    def run(i):
+        barrier.wait()
+        try:
+            results[i] = fn(i)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+def check(callers=100, queries=4, rate=1.0):
+    """
+    对假 Nominatim 服务器检查 NominatimClient：callers 个并发调用方，
+    相同查询只发一次请求、不同查询之间的间隔不小于 1/rate、429 按 Retry-After 等待后重试、
+    排队超过 max_wait 时抛出 NominatimBusy。返回 [(检查项, 是否通过, 说明)]。
+    """
+    results = []
+    with _FakeNominatim() as fake:
+        client = NominatimClient(fake.url, rate=rate, max_wait=60, retries=3, timeout=10)
+        out = _concurrent(callers, lambda i: client.search({"format": "json", "q": "Москва"}))
+        ok = len(fake.log) == 1 and all(isinstance(r, list) and r == out[0] for r in out)
+        results.append(("single-flight", ok, f"{callers} identical concurrent calls -> {len(fake.log)} upstream request(s)"))
+
+        # 令牌桶为空后开始计时，避免把上一项的首个令牌算进去
+        time.sleep(1.0 / rate)
+        del fake.log[:]
+        start = time.monotonic()
+        out = _concurrent(callers, lambda i: client.search({"format": "json", "q": f"city-{i % queries}"}))
+        elapsed = time.monotonic() - start
+        times = [t for t, _ in fake.log]
+        gaps = [b - a for a, b in zip(times, times[1:])]
+        ok = len(fake.log) == queries and not any(isinstance(r, Exception) for r in out) and min(gaps) >= 1.0 / rate * 0.95
+        results.append(("pacing", ok, f"{callers} callers over {queries} queries -> {len(fake.log)} requests in {elapsed:.2f}s, min gap {min(gaps):.3f}s (limit {1.0 / rate:.3f}s)"))
+
+        del fake.log[:]
+        retried = client.retried
+        value = client.search({"format": "json", "q": "retry"})
+        times = [t for t, _ in fake.log]
+        gap = times[1] - times[0] if len(times) == 2 else 0.0
+        ok = len(times) == 2 and client.retried == retried + 1 and gap >= fake.retry_after * 0.95 and value and value[0]["address"]["city"] == "retry"
+        results.append(("retry-after", ok, f"429 with Retry-After: {fake.retry_after} -> retried after {gap:.2f}s"))
+
+        busy = NominatimClient(fake.url, rate=rate, max_wait=0.1, retries=0, timeout=10)
+        busy.search({"format": "json", "q": "busy-1"})
+        try:
+            busy.search({"format": "json", "q": "busy-2"})
+            ok, detail = False, "second request was not rejected"
+        except NominatimBusy:
+            ok, detail = True, "second request within 1/rate rejected with NominatimBusy"
+        results.append(("busy", ok, detail))
+        client.close()
+        busy.close()
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the Nominatim client against a local fake server")
+    parser.add_argument("--callers", type=int, default=100)
+    parser.add_argument("--queries", type=int, default=4, help="distinct queries in the pacing check (takes about queries/rate seconds)")
+    parser.add_argument("--rate", type=float, default=NOMINATIM_RATE)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+    results = check(args.callers, args.queries, args.rate)
+    for name, ok, detail in results:
+        print(f"{'OK  ' if ok else 'FAIL'} {name}: {detail}")
+    sys.exit(0 if all(ok for _, ok, _ in results) else 1)
@@ -0,0 +1,158 @@
+import io
+import os
+import time
+import random
+import argparse
+from PIL import Image, ImageDraw, ImageFilter
+
+from .config import MAP_IMAGE_FORMAT, MAP_IMAGE_QUALITY, MAP_PNG_COLORS, MAP_PNG_COMPRESS_LEVEL, MAP_WEBP_METHOD
+
+def _rgb(img):
+    # 地图都是不透明的：JPEG 不支持 alpha，PNG/WebP 去掉 alpha 通道后体积更小
+    return img if img.mode == "RGB" else img.convert("RGB")
+
+def _encode_png(img, fp, opts):
+    img = _rgb(img)
+    if opts["colors"]:
+        # FASTOCTREE 比默认的 MEDIANCUT 快一个数量级
+        img = img.quantize(max(2, min(256, opts["colors"])), method=Image.Quantize.FASTOCTREE)
+    img.save(fp, format="PNG", compress_level=opts["compress_level"])
+
+def _encode_jpeg(img, fp, opts):
+    # 质量 90 以上不做色度抽样，红色标记和文字边缘更清晰
+    _rgb(img).save(fp, format="JPEG", quality=opts["quality"], subsampling="4:2:0" if opts["quality"] < 90 else "4:4:4")
+
+def _encode_webp(img, fp, opts):
+    _rgb(img).save(fp, format="WEBP", quality=opts["quality"], method=opts["method"])
+
+# 格式 -> (编码函数, 文件扩展名, 默认参数)。新增格式只需在此注册
+ENCODERS = {
+    "png": (_encode_png, "png", {"colors": MAP_PNG_COLORS, "compress_level": MAP_PNG_COMPRESS_LEVEL}),
+    "jpeg": (_encode_jpeg, "jpg", {"quality": MAP_IMAGE_QUALITY}),
+    "webp": (_encode_webp, "webp", {"quality": MAP_IMAGE_QUALITY, "method": MAP_WEBP_METHOD}),
+}
+ALIASES = {"jpg": "jpeg"}
+
+def image_format(fmt=None):
+    fmt = (fmt or MAP_IMAGE_FORMAT).lower()
+    fmt = ALIASES.get(fmt, fmt)
+    if fmt not in ENCODERS:
+        raise ValueError(f"Unsupported map image format: {fmt}")
+    return fmt
+
+def image_ext(fmt=None):
+    return ENCODERS[image_format(fmt)][1]
+
+def encoder_settings(fmt=None, **overrides):
+    """返回 (格式, 参数)。参数决定输出字节，作为缓存键的一部分，换格式或质量后不会命中旧结果。"""
+    fmt = image_format(fmt)
+    opts = dict(ENCODERS[fmt][2])
+    opts.update((k, v) for k, v in overrides.items() if k in opts)
+    return fmt, opts
+
+def encode_image(img, fmt=None, **overrides):
+    """按 MAP_IMAGE_FORMAT（或 fmt）编码地图并返回字节；overrides 覆盖 quality/colors 等参数。"""
+    fmt, opts = encoder_settings(fmt, **overrides)
+    buf = io.BytesIO()
+    ENCODERS[fmt][0](img, buf, opts)
+    return buf.getvalue()
+
+def sniff_ext(data, default="png"):
+    # 按文件头判断实际格式（地图也可能是直接转发的 Yandex 静态图）
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if data[:3] == b"\xff\xd8\xff":
+        return "jpg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return default
+
+# ---- 基准测试 ----
+
+def _photo_fixture(size, seed):
+    # 类似卫星/地形底图：大尺度的平滑色块 + 细颗粒噪声，JPEG/WebP 的典型场景
+    rnd = random.Random(seed)
+    small = Image.new("RGB", (size[0] // 40, size[1] // 40))
+    small.putdata([(rnd.randint(40, 200), rnd.randint(80, 200), rnd.randint(40, 160)) for _ in range(small.size[0] * small.size[1])])
+    img = small.resize(size, Image.BICUBIC)
+    noise = Image.effect_noise(size, 24).convert("RGB")
+    img = Image.blend(img, noise, 0.15).filter(ImageFilter.SMOOTH)
+    d = ImageDraw.Draw(img)
+    for _ in range(12):
+        pts = [(rnd.randint(0, size[0]), rnd.randint(0, size[1])) for _ in range(6)]
+        d.line(pts, fill=(250, 230, 160), width=3)
+    return img
+
+def _flat_fixture(size, seed):
+    # 类似矢量地图瓦片：大面积纯色、道路线条和文字，PNG 调色板量化的典型场景
+    rnd = random.Random(seed)
+    img = Image.new("RGB", size, (242, 239, 233))
+    d = ImageDraw.Draw(img)
+    for _ in range(40):
+        x, y = rnd.randint(0, size[0]), rnd.randint(0, size[1])
+        d.rectangle([x, y, x + rnd.randint(20, 200), y + rnd.randint(20, 120)], fill=rnd.choice([(200, 225, 190), (170, 210, 240), (250, 250, 250), (225, 220, 210)]))
+    for _ in range(30):
+        pts = [(rnd.randint(0, size[0]), rnd.randint(0, size[1])) for _ in range(4)]
+        d.line(pts, fill=rnd.choice([(255, 255, 255), (250, 200, 120), (230, 150, 120)]), width=rnd.randint(2, 6))
+    for _ in range(25):
+        d.text((rnd.randint(0, size[0] - 80), rnd.randint(0, size[1] - 20)), "Москва 77", fill=(60, 60, 60))
+    return img
+
+def bench_fixtures(paths=(), size=(1200, 450)):
+    """基准图像集：合成的照片类与矢量类双窗地图（每类两张）+ paths 指定的真实底图。"""
+    from .maps import _compose_dual_image
+    fixtures = []
+    for kind, make in (("photo", _photo_fixture), ("flat", _flat_fixture)):
+        for seed in (1, 2):
+            half = (size[0] // 2, size[1])
+            left, right = make(half, seed), make(half, seed + 10)
+            fixtures.append((f"{kind}-{seed}", _compose_dual_image(left, right, "Московская область", "Москва")))
+    for path in paths:
+        img = Image.open(path)
+        img.load()
+        fixtures.append((os.path.basename(path), img.convert("RGB")))
+    return fixtures
+
+BENCH_VARIANTS = [
+    ("png", "png", {"colors": 0, "compress_level": 6}),
+    ("png-fast", "png", {"colors": 0, "compress_level": 1}),
+    ("png-256", "png", {"colors": 256, "compress_level": 6}),
+    ("png-64", "png", {"colors": 64, "compress_level": 6}),
+    ("jpeg-75", "jpeg", {"quality": 75}),
+    ("jpeg-85", "jpeg", {"quality": 85}),
+    ("jpeg-95", "jpeg", {"quality": 95}),
+    ("webp-75", "webp", {"quality": 75, "method": 4}),
+    ("webp-85-m0", "webp", {"quality": 85, "method": 0}),
+    ("webp-85", "webp", {"quality": 85, "method": 4}),
+]
+
+def bench(fixtures, rounds=5):
+    """对每种编码配置返回 [(名称, 平均毫秒, 平均字节)]；每张图取 rounds 次中最快的一次。"""
+    results = []
+    for name, fmt, opts in BENCH_VARIANTS:
+        total_ms = 0.0
+        total_bytes = 0
+        for _, img in fixtures:
+            best = None
+            for _ in range(rounds):
+                start = time.perf_counter()
+                data = encode_image(img, fmt, **opts)
+                elapsed = (time.perf_counter() - start) * 1000
+                best = elapsed if best is None else min(best, elapsed)
+            total_ms += best
+            total_bytes += len(data)
+        results.append((name, total_ms / len(fixtures), total_bytes // len(fixtures)))
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark map image encoders (encode time and byte size per format)")
+    parser.add_argument("images", nargs="*", help="extra base images to include in the fixture set")
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+    fixtures = bench_fixtures(args.images)
+    print(f"{len(fixtures)} fixtures: {', '.join(name for name, _ in fixtures)}")
+    results = bench(fixtures, args.rounds)
+    baseline_ms, baseline_bytes = results[0][1], results[0][2]
+    print(f"{'variant':<12}{'ms':>8}{'bytes':>10}{'time':>8}{'size':>8}")
+    for name, ms, size in results:
+        print(f"{name:<12}{ms:>8.1f}{size:>10}{ms / baseline_ms:>8.2f}{size / baseline_bytes:>8.2f}")
@@ -1,6 +1,8 @@
 import os
+import sys
 import asyncio
 import json
+import hashlib
 import datetime
 import argparse
 import logging
@@ -17,419 +19,223 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-from .config import TELEGRAM_BOT_TOKEN, ensure_dirs
-from .db import init_schema, seed_minimal, find_city_by_name, find_region_by_auto_code, list_auto_codes_by_region, find_city_by_phone_code, list_phone_codes_by_city, save_query, find_city_by_name_fuzzy
-from .nlp import detect_language, parse_intent
-from .reply_templates import format_auto_result, format_auto_region_only, format_phone_result, format_not_found, format_license_plate
+from .config import TELEGRAM_BOT_TOKEN, MAP_STAGE_TIMEOUT, VOICE_STAGE_TIMEOUT, USER_RATE, USER_BURST, USER_LIMITER_MAX_USERS, ensure_dirs
+from .db import init_schema, seed_reference_data, find_city_by_name, find_region_by_auto_code, list_auto_codes_by_region, find_city_by_name_fuzzy, get_index, close_conns, explain_lookups, get_file_id, save_file_id, delete_file_id
+from .nlp import detect_language, parse_intent, parse_intents
+from .pipeline import resolve, query_key
+from .reply_templates import format_busy, format_rate_limited
+from .ratelimit import UserRateLimiter, AsyncSingleFlight
+from .workers import PoolBusy, map_pool, tts_pool, pool_stats, shutdown_pools
+from .geocode import NominatimBusy
+from .querylog import log_query, query_log
 
 # 尝试导入telegram模块
 try:
     from telegram import InputFile
+    from telegram.error import BadRequest
     from telegram.ext import Application, CommandHandler, MessageHandler, filters
     TELEGRAM_AVAILABLE = True
 except ImportError:
     TELEGRAM_AVAILABLE = False
     logger.warning("Telegram模块未安装，语音发送功能不可用")
 
+# 每用户限流；相同查询（同语言、同查询项）并发到达时共享一次解析、地图渲染和语音合成
+user_limiter = UserRateLimiter(USER_RATE, USER_BURST, USER_LIMITER_MAX_USERS)
+inflight = AsyncSingleFlight()
+
 async def start(update, context):
     await update.message.reply_text("Введите город, код региона или телефонный код. 支持中文输入。")
 
+def _voice_key(reply, lang):
+    return hashlib.sha256(json.dumps(["voice", lang, reply], ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def _sent_file_id(msg):
+    for attr in ("photo", "voice", "audio", "document"):
+        media = getattr(msg, attr, None)
+        if isinstance(media, (list, tuple)):
+            media = media[-1] if media else None
+        if media is not None:
+            return media.file_id
+    return None
+
+async def _remember_file_id(content_key, kind, msg):
+    file_id = _sent_file_id(msg) if msg is not None else None
+    if content_key and file_id:
+        try:
+            await asyncio.to_thread(save_file_id, content_key, kind, file_id, datetime.datetime.utcnow().isoformat())
+        except Exception as e:
+            logger.error(f"Failed to store file_id: {e}")
+
+async def _run_stage(name, coro, timeout):
+    # 各阶段独立超时：超时或失败只跳过该阶段，不影响已发送的文本回复
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"{name} stage timed out after {timeout}s")
+    except PoolBusy as e:
+        logger.warning(f"{name} stage skipped: {e}")
+    except Exception as e:
+        logger.error(f"{name} stage failed: {e}", exc_info=True)
+    return None
+
+def _lookup_map(region_name, city_name, lat, lon):
+    # 计算缓存键可能首次解码底图、打开瓦片库，file_id 查询读 SQLite：都在工作线程中执行，不阻塞事件循环
+    from .maps import city_dual_map_key
+    key = city_dual_map_key(region_name, city_name, lat, lon) if lat is not None and lon is not None else None
+    return key, (get_file_id(key) if key else None)
+
+async def prepare_map(region_name, city_name, lat, lon):
+    # 优先复用 Telegram 已有的 file_id，否则渲染图片（渲染器内部先查地图缓存）
+    from .maps import render_city_dual_map
+    target = (region_name, city_name, lat, lon)
+    key, file_id = await asyncio.to_thread(_lookup_map, region_name, city_name, lat, lon)
+    if file_id:
+        return {"target": target, "key": key, "file_id": file_id}
+    img_bytes, key = await map_pool.run(render_city_dual_map, region_name, city_name, lat, lon)
+    return {"target": target, "key": key, "bytes": img_bytes}
+
+async def deliver_map(update, prepared):
+    if prepared.get("file_id"):
+        try:
+            await update.message.reply_photo(prepared["file_id"])
+            logger.info(f"Reused Telegram file_id for {prepared['key'][:12]}")
+            return
+        except BadRequest as e:
+            # file_id 失效时删除记录并重新渲染上传
+            logger.warning(f"Stale file_id rejected, re-uploading: {e}")
+            await asyncio.to_thread(delete_file_id, prepared["key"])
+            # 重新渲染与首次准备一样受阶段超时和执行器排队上限约束，失败时只跳过地图
+            prepared = await _run_stage("map", prepare_map(*prepared["target"]), MAP_STAGE_TIMEOUT)
+            if prepared is None:
+                return
+    img_bytes = prepared.get("bytes")
+    if not img_bytes:
+        logger.error("Map generation returned empty bytes")
+        return
+    from .imageenc import sniff_ext
+    # 文件名按实际格式（MAP_IMAGE_FORMAT 或直接转发的 Yandex 静态图）
+    filename = f"map.{sniff_ext(img_bytes)}"
+    try:
+        msg = await update.message.reply_photo(InputFile(img_bytes, filename=filename))
+        logger.info("Successfully sent map as photo")
+        await _remember_file_id(prepared["key"], "photo", msg)
+    except Exception as e:
+        logger.error(f"Failed to send map as photo: {e}")
+        try:
+            await update.message.reply_document(InputFile(img_bytes, filename=filename))
+            logger.info("Successfully sent map as document")
+        except Exception as e2:
+            logger.error(f"Failed to send map as document: {e2}")
+
+def _lookup_voice(reply, lang):
+    # file_id 查询与语音缓存的磁盘读取在工作线程中执行
+    from .tts import cached_clip
+    key = _voice_key(reply, lang)
+    file_id = get_file_id(key)
+    if file_id:
+        return key, file_id, None, None
+    return (key, None) + cached_clip(reply, lang)
+
+async def prepare_voice(reply, lang):
+    key, file_id, audio, filename = await asyncio.to_thread(_lookup_voice, reply, lang)
+    if file_id:
+        return {"reply": reply, "lang": lang, "key": key, "file_id": file_id}
+    from .tts import synthesize_clip
+    # 语音缓存未命中时在 TTS 执行器中拼接片段或合成，并编码为 OGG/Opus
+    if not audio:
+        audio, filename = await tts_pool.run(synthesize_clip, reply, lang)
+    return {"reply": reply, "lang": lang, "key": key, "audio": audio, "filename": filename}
+
+async def deliver_voice(update, prepared):
+    if prepared.get("file_id"):
+        try:
+            await update.message.reply_voice(prepared["file_id"])
+            logger.info(f"Reused Telegram file_id for {prepared['key'][:12]}")
+            return
+        except BadRequest as e:
+            logger.warning(f"Stale file_id rejected, re-uploading: {e}")
+            await asyncio.to_thread(delete_file_id, prepared["key"])
+            prepared = await _run_stage("voice", prepare_voice(prepared["reply"], prepared["lang"]), VOICE_STAGE_TIMEOUT)
+            if prepared is None:
+                return
+    audio = prepared.get("audio")
+    if not audio:
+        logger.error("Audio file not generated or missing")
+        return
+    try:
+        msg = await update.message.reply_voice(InputFile(audio, filename=prepared["filename"]))
+        logger.info("Successfully sent voice")
+        await _remember_file_id(prepared["key"], "voice", msg)
+    except Exception as e:
+        logger.error(f"Failed to send voice: {e}", exc_info=True)
+
+async def _prepare_stages(res, lang):
+    stages = [_run_stage("map", prepare_map(*target), MAP_STAGE_TIMEOUT) for target in res.maps]
+    if res.voice:
+        stages.append(_run_stage("voice", prepare_voice(res.reply, lang), VOICE_STAGE_TIMEOUT))
+    return await asyncio.gather(*stages)
+
+async def respond(update, lang, text, res, key=None):
+    """
+    发送 Resolution：地图渲染与语音合成作为独立阶段并行执行（各自超时），
+    期间先发出文本回复，之后按 地图 → 语音 的顺序发送，与原来的消息顺序一致。
+    给出 key 时，相同查询的并发请求共享同一组地图/语音准备结果。
+    """
+    if TELEGRAM_AVAILABLE and (res.maps or res.voice):
+        if key is None:
+            pending = asyncio.ensure_future(_prepare_stages(res, lang))
+        else:
+            pending = asyncio.ensure_future(inflight.do(("stages", key), lambda: _prepare_stages(res, lang)))
+    else:
+        if res.maps or res.voice:
+            logger.warning("Telegram模块不可用，跳过地图和语音发送")
+        pending = asyncio.gather()
+    try:
+        await update.message.reply_text(res.reply)
+    except Exception:
+        pending.cancel()
+        raise
+    prepared = await pending
+    for item in prepared[:len(res.maps)]:
+        if item:
+            await deliver_map(update, item)
+    if len(prepared) > len(res.maps) and prepared[-1]:
+        await deliver_voice(update, prepared[-1])
+    user_id = str(update.effective_user.id)
+    now = datetime.datetime.utcnow().isoformat()
+    await log_query(user_id, lang, res.intent, text, json.dumps(res.entities, ensure_ascii=False), json.dumps(res.result, ensure_ascii=False), now)
+
 async def handle_text(update, context):
     try:
         text = update.message.text or ""
         logger.info(f"Received message: {text}")
         
-        from .nlp import detect_language
         lang = detect_language(text)
         logger.info(f"Detected language: {lang}")
-        
+        allowed, notify = user_limiter.check(update.effective_user.id)
+        if not allowed:
+            # 超出限流：不做任何查询，每轮限流只提示一次
+            logger.warning(f"Rate limited user {update.effective_user.id}")
+            if notify:
+                await update.message.reply_text(format_rate_limited(lang))
+            return
         # 向用户显示检测到的语言信息
         lang_msg = "检测到中文" if lang == "zh" else "Русский язык обнаружен"
         await update.message.reply_text(lang_msg)
         
-        intent_data = parse_intent(text)
-        intent = intent_data.get("intent")
-        user_id = str(update.effective_user.id)
-        now = datetime.datetime.utcnow().isoformat()
-        if intent == "city_to_auto_code":
-            city_name = intent_data.get("city", "").strip()
-            city = find_city_by_name(city_name) or find_city_by_name_fuzzy(city_name)
-            if not city:
-                from .geocode import geocode_city
-                geo = await asyncio.to_thread(geocode_city, city_name)
-                if geo and geo.get("region"):
-                    from .db import find_region_by_name
-                    region_guess = find_region_by_name(geo["region"]) or find_region_by_name(city_name)
-                    if region_guess:
-                        region_id, region_ru, region_zh = region_guess
-                        codes = list_auto_codes_by_region(region_id)
-                        reply = format_auto_region_only(lang, region_ru, region_zh, codes)
-                        await update.message.reply_text(reply)
-                        from .maps import generate_city_dual_map
-                        try:
-                            img_bytes = await asyncio.to_thread(generate_city_dual_map, region_ru, geo.get("city"), geo.get("lat"), geo.get("lon"))
-                            if img_bytes:
-                                try:
-                                    await update.message.reply_photo(InputFile(img_bytes, filename="map.png"))
-                                    logger.info("Successfully sent map as photo")
-                                except Exception as e:
-                                    logger.error(f"Failed to send map as photo: {e}")
-                                    try:
-                                        await update.message.reply_document(InputFile(img_bytes, filename="map.png"))
-                                        logger.info("Successfully sent map as document")
-                                    except Exception as e2:
-                                        logger.error(f"Failed to send map as document: {e2}")
-                            else:
-                                logger.error("Map generation returned empty bytes")
-                        except Exception as e:
-                            logger.error(f"Error generating map: {e}", exc_info=True)
-                        # 生成并发送语音
-                        try:
-                            from .tts import synthesize
-                            audio_path = await asyncio.to_thread(synthesize, reply, lang)
-                            if audio_path and os.path.exists(audio_path):
-                                if TELEGRAM_AVAILABLE:
-                                    # 必须以二进制模式打开文件
-                                    with open(audio_path, 'rb') as audio_file:
-                                        await update.message.reply_voice(audio_file, filename=os.path.basename(audio_path))
-                                    logger.info("Successfully sent voice")
-                                else:
-                                    logger.warning("Telegram模块不可用，跳过语音发送")
-                                # 清理临时语音文件
-                                os.remove(audio_path)
-                            else:
-                                logger.error("Audio file not generated or missing")
-                        except Exception as e:
-                            logger.error(f"Failed to generate or send voice: {e}", exc_info=True)
-                        save_query(user_id, lang, intent, text, json.dumps(intent_data, ensure_ascii=False), json.dumps({"reply": reply}, ensure_ascii=False), now)
-                        return
-                await update.message.reply_text(format_not_found(lang))
-                save_query(user_id, lang, intent, text, json.dumps(intent_data, ensure_ascii=False), json.dumps({"found": False}, ensure_ascii=False), now)
-                return
-            city_id, city_ru, city_zh, region_id, lat, lon = city
-            codes = list_auto_codes_by_region(region_id)
-            from .db import get_region_by_id
-            region_row = get_region_by_id(region_id)
-            region_ru = region_row[1] if region_row else ""
-            region_zh = region_row[2] if region_row else ""
-            reply = format_auto_result(lang, city_ru, city_zh, region_ru, region_zh, codes)
-            await update.message.reply_text(reply)
-            from .maps import generate_city_dual_map
-            img_bytes = await asyncio.to_thread(generate_city_dual_map, region_ru or region_zh, city_ru, lat, lon)
-            try:
-                await update.message.reply_photo(InputFile(img_bytes, filename="map.png"))
-            except Exception as e:
-                logger.error(f"Failed to send map photo: {e}")
-                try:
-                    await update.message.reply_document(InputFile(img_bytes, filename="map.png"))
-                    logger.info(f"Successfully sent map document")
-                except Exception as e:
-                    logger.error(f"Failed to send map document: {e}")
-            try:
-                from .tts import synthesize
-                audio_path = await asyncio.to_thread(synthesize, reply, lang)
-                if audio_path and os.path.exists(audio_path):
-                    if TELEGRAM_AVAILABLE:
-                        with open(audio_path, 'rb') as audio_file:
-                            await update.message.reply_voice(audio_file, filename=os.path.basename(audio_path))
-                        logger.info("Successfully sent voice")
-                    else:
-                        logger.warning("Telegram模块不可用，跳过语音发送")
-                    # 清理临时语音文件
-                    os.remove(audio_path)
-                else:
-                    logger.warning("Voice synthesis failed or audio file not generated")
-            except Exception as e:
-                logger.error(f"Failed to generate or send voice: {e}")
-            save_query(user_id, lang, intent, text, json.dumps(intent_data, ensure_ascii=False), json.dumps({"reply": reply}, ensure_ascii=False), now)
-            return
-        if intent == "auto_code_to_region":
-            code = intent_data.get("code", "")
-            region = find_region_by_auto_code(code)
-            if not region:
-                await update.message.reply_text(format_not_found(lang))
-                save_query(user_id, lang, intent, text, json.dumps(intent_data, ensure_ascii=False), json.dumps({"found": False}, ensure_ascii=False), now)
-                return
-            region_id, region_ru, region_zh = region
-            codes = list_auto_codes_by_region(region_id)
-            reply = format_auto_region_only(lang, region_ru, region_zh, codes)
-            await update.message.reply_text(reply)
-            from .maps import generate_city_dual_map
-            from .db import get_city_by_region
-            city_row = get_city_by_region(region_id)
-            lat = city_row[3] if city_row else None
-            lon = city_row[4] if city_row else None
-            
-            # 生成并发送地图
-            try:
-                img_bytes = await asyncio.to_thread(generate_city_dual_map, region_ru, city_row[1] if city_row else None, lat, lon)
-                if img_bytes:
-                    if TELEGRAM_AVAILABLE:
-                        try:
-                            await update.message.reply_photo(InputFile(img_bytes, filename="map.png"))
-                            logger.info("Successfully sent map as photo")
-                        except Exception as e:
-                            logger.error(f"Failed to send map as photo: {e}")
-                            try:
-                                await update.message.reply_document(InputFile(img_bytes, filename="map.png"))
-                                logger.info("Successfully sent map as document")
-                            except Exception as e2:
-                                logger.error(f"Failed to send map as document: {e2}")
-                    else:
-                        logger.warning("Telegram模块不可用，跳过地图发送")
-                else:
-                    logger.error("Map generation returned empty bytes")
-            except Exception as e:
-                logger.error(f"Error generating map: {e}", exc_info=True)
-            
-            # 生成并发送语音
-            try:
-                from .tts import synthesize
-                audio_path = await asyncio.to_thread(synthesize, reply, lang)
-                if audio_path and os.path.exists(audio_path):
-                    if TELEGRAM_AVAILABLE:
-                        with open(audio_path, 'rb') as audio_file:
-                            await update.message.reply_voice(audio_file, filename=os.path.basename(audio_path))
-                        logger.info("Successfully sent voice")
-                    else:
-                        logger.warning("Telegram模块不可用，跳过语音发送")
-                    # 清理临时文件
-                    try:
-                        os.remove(audio_path)
-                        logger.info(f"Cleaned up temporary audio file: {audio_path}")
-                    except Exception as e:
-                        logger.error(f"Failed to clean up audio file: {e}")
-                else:
-                    logger.error("Failed to generate audio or file not found")
-            except Exception as e:
-                logger.error(f"Error in TTS process: {e}", exc_info=True)
-            save_query(user_id, lang, intent, text, json.dumps(intent_data, ensure_ascii=False), json.dumps({"reply": reply}, ensure_ascii=False), now)
-            return
-        if intent == "city_to_phone_code":
-            city_name = intent_data.get("city", "").strip()
-            city = find_city_by_name(city_name) or find_city_by_name_fuzzy(city_name)
-            if not city:
-                from .geocode import geocode_city
-                geo = await asyncio.to_thread(geocode_city, city_name)
-                if geo and geo.get("region"):
-                            from .db import find_region_by_name
-                            region_guess = find_region_by_name(geo["region"]) or find_region_by_name(city_name)
-                            if region_guess:
-                                region_id, region_ru, region_zh = region_guess
-                                from .db import get_city_by_region
-                                city_row = get_city_by_region(region_id)
-                                codes = list_phone_codes_by_city(city_row[0]) if city_row else []
-                                reply = format_phone_result(lang, geo.get("city"), None, region_ru, region_zh, codes or ["—"])
-                                await update.message.reply_text(reply)
-                                from .maps import generate_city_dual_map
-                try:
-                    img_bytes = await asyncio.to_thread(generate_city_dual_map, region_ru, geo.get("city"), geo.get("lat"), geo.get("lon"))
-                    if img_bytes:
-                        try:
-                            await update.message.reply_photo(InputFile(img_bytes, filename="map.png"))
-                            logger.info("Successfully sent map as photo")
-                        except Exception as e:
-                            logger.error(f"Failed to send map as photo: {e}")
-                            try:
-                                await update.message.reply_document(InputFile(img_bytes, filename="map.png"))
-                                logger.info("Successfully sent map as document")
-                            except Exception as e2:
-                                logger.error(f"Failed to send map as document: {e2}")
-                    else:
-                        logger.error("Map generation returned empty bytes")
-                except Exception as e:
-                    logger.error(f"Error generating map: {e}", exc_info=True)
-                # 生成并发送语音
-                try:
-                    from .tts import synthesize
-                    audio_path = await asyncio.to_thread(synthesize, reply, lang)
-                    if audio_path and os.path.exists(audio_path):
-                        if TELEGRAM_AVAILABLE:
-                            with open(audio_path, 'rb') as audio_file:
-                                await update.message.reply_voice(audio_file, filename=os.path.basename(audio_path))
-                            logger.info("Successfully sent voice")
-                        else:
-                            logger.warning("Telegram模块不可用，跳过语音发送")
-                        # 清理临时语音文件
-                        try:
-                            os.remove(audio_path)
-                            logger.info(f"Removed temporary audio file: {audio_path}")
-                        except Exception as e:
-                            logger.error(f"Failed to remove audio file: {e}")
-                    else:
-                        logger.error("Audio file not generated or missing")
-                except Exception as e:
-                    logger.error(f"Failed to generate or send voice: {e}", exc_info=True)
-                save_query(user_id, lang, intent, text, json.dumps(intent_data, ensure_ascii=False), json.dumps({"reply": reply}, ensure_ascii=False), now)
-                return
-                await update.message.reply_text(format_not_found(lang))
-                save_query(user_id, lang, intent, text, json.dumps(intent_data, ensure_ascii=False), json.dumps({"found": False}, ensure_ascii=False), now)
-                return
-            city_id, city_ru, city_zh, region_id, lat, lon = city
-            region_row = get_region_by_id(region_id)
-            region_ru = region_row[1] if region_row else ""
-            region_zh = region_row[2] if region_row else ""
-            codes = list_phone_codes_by_city(city_id)
-            reply = format_phone_result(lang, city_ru, city_zh, region_ru, region_zh, codes)
-            await update.message.reply_text(reply)
-            
-            # 生成并发送地图
-            from .maps import generate_city_dual_map
-            try:
-                img_bytes = await asyncio.to_thread(generate_city_dual_map, region_ru, city_ru, lat, lon)
-                if img_bytes:
-                    try:
-                        await update.message.reply_photo(InputFile(img_bytes, filename="map.png"))
-                        logger.info("Successfully sent map as photo")
-                    except Exception as e:
-                        logger.error(f"Failed to send map as photo: {e}")
-                        try:
-                            await update.message.reply_document(InputFile(img_bytes, filename="map.png"))
-                            logger.info("Successfully sent map as document")
-                        except Exception as e2:
-                            logger.error(f"Failed to send map as document: {e2}")
-                else:
-                    logger.error("Map generation returned empty bytes")
-            except Exception as e:
-                logger.error(f"Error generating map: {e}", exc_info=True)
-            
-            # 生成并发送语音
-            try:
-                from .tts import synthesize
-                audio_path = await asyncio.to_thread(synthesize, reply, lang)
-                if audio_path and os.path.exists(audio_path):
-                    if TELEGRAM_AVAILABLE:
-                        with open(audio_path, 'rb') as audio_file:
-                            await update.message.reply_voice(audio_file, filename=os.path.basename(audio_path))
-                        logger.info("Successfully sent voice")
-                    else:
-                        logger.warning("Telegram模块不可用，跳过语音发送")
-                    # 清理临时语音文件
-                    os.remove(audio_path)
-                else:
-                    logger.error("Audio file not generated or missing")
-            except Exception as e:
-                logger.error(f"Failed to generate or send voice: {e}", exc_info=True)
-            save_query(user_id, lang, intent, text, json.dumps(intent_data, ensure_ascii=False), json.dumps({"reply": reply}, ensure_ascii=False), now)
-            return
-        if intent == "phone_code_to_city":
-            code = intent_data.get("code", "")
-            row = find_city_by_phone_code(code)
-            if not row:
-                await update.message.reply_text(format_not_found(lang))
-                save_query(user_id, lang, intent, text, json.dumps(intent_data, ensure_ascii=False), json.dumps({"found": False}, ensure_ascii=False), now)
-                return
-            city_id, city_ru, city_zh, region_id, region_ru, region_zh, lat, lon = row
-            codes = list_phone_codes_by_city(city_id)
-            reply = format_phone_result(lang, city_ru, city_zh, region_ru, region_zh, codes)
-            await update.message.reply_text(reply)
-            from .maps import generate_city_dual_map
-            
-            # 生成并发送地图
-            try:
-                img_bytes = await asyncio.to_thread(generate_city_dual_map, region_ru, city_ru, lat, lon)
-                if img_bytes:
-                    try:
-                        await update.message.reply_photo(InputFile(img_bytes, filename="map.png"))
-                        logger.info("Successfully sent map as photo")
-                    except Exception as e:
-                        logger.error(f"Failed to send map as photo: {e}")
-                        try:
-                            await update.message.reply_document(InputFile(img_bytes, filename="map.png"))
-                            logger.info("Successfully sent map as document")
-                        except Exception as e2:
-                            logger.error(f"Failed to send map as document: {e2}")
-                else:
-                    logger.error("Map generation returned empty bytes")
-            except Exception as e:
-                logger.error(f"Error generating map: {e}", exc_info=True)
-            
-            # 生成并发送语音
-            try:
-                from .tts import synthesize
-                audio_path = await asyncio.to_thread(synthesize, reply, lang)
-                if audio_path and os.path.exists(audio_path):
-                    if TELEGRAM_AVAILABLE:
-                        with open(audio_path, 'rb') as audio_file:
-                            await update.message.reply_voice(audio_file, filename=os.path.basename(audio_path))
-                        logger.info("Successfully sent voice")
-                    else:
-                        logger.warning("Telegram模块不可用，跳过语音发送")
-                    # 清理临时语音文件
-                    os.remove(audio_path)
-                else:
-                    logger.error("Audio file not generated or missing")
-            except Exception as e:
-                logger.error(f"Failed to generate or send voice: {e}", exc_info=True)
-            save_query(user_id, lang, intent, text, json.dumps(intent_data, ensure_ascii=False), json.dumps({"reply": reply}, ensure_ascii=False), now)
-            return
-        
-        # 处理车牌号码查询
-        if intent == "license_plate":
-            plate = intent_data.get("plate", "")
-            region_code = intent_data.get("region_code", "")
-            region = find_region_by_auto_code(region_code)
-            
-            if not region:
-                await update.message.reply_text(format_not_found(lang))
-                save_query(user_id, lang, intent, text, json.dumps(intent_data, ensure_ascii=False), json.dumps({"found": False}, ensure_ascii=False), now)
-                return
-            
-            region_id, region_ru, region_zh = region
-            reply = format_license_plate(lang, plate, region_ru, region_zh)
-            await update.message.reply_text(reply)
-            
-            # 生成地图
-            from .maps import generate_city_dual_map
-            from .db import get_city_by_region
-            city_row = get_city_by_region(region_id)
-            lat = city_row[3] if city_row else None
-            lon = city_row[4] if city_row else None
-            
-            try:
-                img_bytes = await asyncio.to_thread(generate_city_dual_map, region_ru, city_row[1] if city_row else None, lat, lon)
-                if img_bytes:
-                    try:
-                        await update.message.reply_photo(InputFile(img_bytes, filename="map.png"))
-                        logger.info("Successfully sent map as photo")
-                    except Exception as e:
-                        logger.error(f"Failed to send map as photo: {e}")
-                        try:
-                            await update.message.reply_document(InputFile(img_bytes, filename="map.png"))
-                            logger.info("Successfully sent map as document")
-                        except Exception as e2:
-                            logger.error(f"Failed to send map as document: {e2}")
-                else:
-                    logger.error("Map generation returned empty bytes")
-            except Exception as e:
-                logger.error(f"Error generating map: {e}", exc_info=True)
-            
-            # 生成语音播报
-            try:
-                from .tts import synthesize
-                audio_path = await asyncio.to_thread(synthesize, reply, lang)
-                if audio_path and os.path.exists(audio_path):
-                    if TELEGRAM_AVAILABLE:
-                        await update.message.reply_voice(InputFile(audio_path))
-                        logger.info("Successfully sent voice")
-                    else:
-                        logger.warning("Telegram模块不可用，跳过语音发送")
-                    # 清理临时语音文件
-                    os.remove(audio_path)
-                else:
-                    logger.error("Audio file not generated or missing")
-            except Exception as e:
-                logger.error(f"Failed to generate or send voice: {e}", exc_info=True)
-            
-            save_query(user_id, lang, intent, text, json.dumps(intent_data, ensure_ascii=False), json.dumps({"reply": reply}, ensure_ascii=False), now)
+        items = parse_intents(text)
+        key = query_key(items, lang)
+        try:
+            res = await inflight.do(("resolve", key), lambda: resolve(text, lang, items))
+        except (PoolBusy, NominatimBusy) as e:
+            # 地理编码排队已满、Nominatim 限速排队已满或超时：快速回复“繁忙”，不再排队等待
+            logger.warning(f"Rejecting message, {e}")
+            await update.message.reply_text(format_busy(lang))
             return
-        
-        await update.message.reply_text(format_not_found(lang))
-        save_query(user_id, lang, intent, text, json.dumps(intent_data, ensure_ascii=False), json.dumps({"found": False}, ensure_ascii=False), now)
+        await respond(update, lang, text, res, key)
     except Exception as e:
         logger.error(f"Unexpected error in handle_text: {e}", exc_info=True)
         try:
-            from .nlp import detect_language
             lang = detect_language(getattr(update.message, "text", "") or "")
             msg = "服务暂不可用，请稍后再试" if lang == "zh" else "Сервис недоступен, попробуйте позже"
             await update.message.reply_text(msg)
@@ -439,12 +245,10 @@ async def handle_text(update, context):
 def run_bot():
     ensure_dirs()
     init_schema()
-    from .db import seed_full_regions, seed_auto_codes_full, seed_phone_codes_capitals, seed_cities_full
-    seed_full_regions()
-    seed_auto_codes_full()
-    seed_phone_codes_capitals()
-    seed_cities_full()
-    seed_minimal()
+    # 参考数据版本未变化时不做任何写入
+    seed_reference_data()
+    # 预先构建内存索引，避免首条消息承担构建开销
+    get_index()
     
     # 只有在非自检模式下才导入telegram模块
     try:
@@ -460,7 +264,24 @@ def run_bot():
         req = HTTPXRequest(connection_pool_size=8, pool_timeout=5.0, read_timeout=10.0, write_timeout=10.0, connect_timeout=5.0, proxy={})
         get_updates_req = HTTPXRequest(connection_pool_size=8, pool_timeout=5.0, read_timeout=15.0, write_timeout=10.0, connect_timeout=5.0, proxy={})
         from telegram.ext import Application, CommandHandler, MessageHandler, filters
-        app = Application.builder().token(TELEGRAM_BOT_TOKEN).request(req).get_updates_request(get_updates_req).build()
+        async def on_shutdown(app):
+            # 停止前写完队列中的查询日志
+            await query_log.stop()
+            from .map_cache import map_cache
+            logger.info(f"Map cache stats: {map_cache.stats()}")
+            from .tts import voice_cache, pyttsx3_worker
+            logger.info(f"Voice cache stats: {voice_cache.stats()}")
+            from .audio import voice_encoder
+            logger.info(f"Voice encoder stats: {voice_encoder.stats()}")
+            pyttsx3_worker.stop()
+            from . import fetch
+            fetch.close()
+            from .geocode import nominatim
+            nominatim.close()
+            logger.info(f"Worker pool stats: {pool_stats()}")
+            logger.info(f"Rate limiter: {user_limiter.stats()}, coalesced queries: {inflight.stats()}")
+            shutdown_pools()
+        app = Application.builder().token(TELEGRAM_BOT_TOKEN).request(req).get_updates_request(get_updates_req).post_shutdown(on_shutdown).build()
         app.add_handler(CommandHandler("start", start))
         app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
         async def on_error(update, context):
@@ -476,6 +297,7 @@ def run_bot():
         app.add_error_handler(on_error)
         logger.info("Starting bot...")
         app.run_polling()
+        close_conns()
     except ImportError as e:
         logger.warning(f"Telegram dependencies not installed: {e}")
         logger.info("Bot can only run in self-test mode without telegram dependencies")
@@ -483,7 +305,8 @@ def run_bot():
 def run_selftest():
     ensure_dirs()
     init_schema()
-    seed_minimal()
+    seed_reference_data()
+    get_index()
     samples = [
         "莫斯科车牌代码",
         "199 是哪个地区",
@@ -499,6 +322,13 @@ def run_selftest():
     ]
     print("Starting self-test...")
     print("=" * 60)
+
+    # SQL 后端（LOOKUP_BACKEND=sql）所用查询语句的计划必须命中索引，与当前后端无关
+    print("\nQuery plans of the SQL lookup statements")
+    print("-" * 40)
+    plans = explain_lookups()
+    for name, plan, ok in plans:
+        print(f"{'✓' if ok else '✗'} {name}: {plan}")
     
     for s in samples:
         print(f"\nTest input: '{s}'")
@@ -559,13 +389,14 @@ def run_selftest():
     
     print("\n" + "=" * 60)
     print("Self-test completed!")
+    return all(ok for _, _, ok in plans)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--selftest", action="store_true")
     args = parser.parse_args()
     if args.selftest:
-        run_selftest()
+        sys.exit(0 if run_selftest() else 1)
     else:
         if not TELEGRAM_BOT_TOKEN:
             print("Missing TELEGRAM_BOT_TOKEN")
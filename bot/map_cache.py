@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from .imageenc import image_ext
+from .config import MAP_IMG_DIR, MAP_CACHE_MEM_ITEMS, MAP_CACHE_MEM_MB, MAP_CACHE_DISK_MB, MAP_CACHE_MAX_AGE_DAYS
+
+class MapCache:
+    """
+    渲染结果的两级缓存：内存 LRU（编码后的字节）+ 磁盘目录（按输入哈希命名）。
+    磁盘层按文件年龄和总大小淘汰，多个进程可共享同一目录。
+    """
+
+    def __init__(self, directory, mem_items=256, mem_bytes=64 * 1024 * 1024, disk_bytes=512 * 1024 * 1024, max_age=30 * 86400, ext="png"):
+        self.directory = directory
+        self.mem_items = mem_items
+        self.mem_bytes = mem_bytes
+        self.disk_bytes = disk_bytes
+        self.max_age = max_age
+        self.ext = ext
+        self._mem = OrderedDict()
+        self._mem_size = 0
+        self._disk_size = None
+        self._lock = threading.Lock()
+        self.mem_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(*parts):
+        raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.{self.ext}")
+
+    def _remember(self, key, data):
+        old = self._mem.pop(key, None)
+        if old is not None:
+            self._mem_size -= len(old)
+        self._mem[key] = data
+        self._mem_size += len(data)
+        while self._mem and (len(self._mem) > self.mem_items or self._mem_size > self.mem_bytes):
+            _, dropped = self._mem.popitem(last=False)
+            self._mem_size -= len(dropped)
+
+    def get(self, key):
+        with self._lock:
+            data = self._mem.get(key)
+            if data is not None:
+                self._mem.move_to_end(key)
+                self.mem_hits += 1
+                return data
+        path = self._path(key)
+        try:
+            st = os.stat(path)
+            if self.max_age and time.time() - st.st_mtime > self.max_age:
+                os.remove(path)
+                raise FileNotFoundError(path)
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        # 更新访问时间，磁盘淘汰按最近使用排序
+        try:
+            os.utime(path, (time.time(), st.st_mtime))
+        except OSError:
+            pass
+        with self._lock:
+            self.disk_hits += 1
+            self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        if not data:
+            return
+        with self._lock:
+            self._remember(key, data)
+            self.stores += 1
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            return
+        with self._lock:
+            if self._disk_size is not None:
+                self._disk_size += len(data)
+            need_evict = self._disk_size is None or self._disk_size > self.disk_bytes
+        if need_evict:
+            self.evict()
+
+    def evict(self):
+        now = time.time()
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if name.endswith(".tmp") and now - st.st_mtime < 60:
+                    continue
+                if name.endswith(".tmp") or (self.max_age and now - st.st_mtime > self.max_age):
+                    self._unlink(path)
+                    continue
+                entries.append((st.st_atime, st.st_size, path))
+                total += st.st_size
+        if total > self.disk_bytes:
+            # 超出容量时从最久未访问的文件开始删除，直到降到 90%
+            entries.sort()
+            target = self.disk_bytes * 0.9
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                if self._unlink(path):
+                    total -= size
+        with self._lock:
+            self._disk_size = total
+
+    def _unlink(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            return False
+        with self._lock:
+            self.evictions += 1
+        return True
+
+    def stats(self):
+        with self._lock:
+            lookups = self.mem_hits + self.disk_hits + self.misses
+            return {
+                "mem_hits": self.mem_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.mem_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "mem_items": len(self._mem),
+                "mem_bytes": self._mem_size,
+                "disk_bytes": self._disk_size,
+            }
+
+map_cache = MapCache(
+    os.path.join(MAP_IMG_DIR, "cache"),
+    mem_items=MAP_CACHE_MEM_ITEMS,
+    mem_bytes=MAP_CACHE_MEM_MB * 1024 * 1024,
+    disk_bytes=MAP_CACHE_DISK_MB * 1024 * 1024,
+    max_age=MAP_CACHE_MAX_AGE_DAYS * 86400,
+    ext=image_ext(),
+)
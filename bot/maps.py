@@ -1,9 +1,14 @@
 import io
 import math
-import urllib.request
-import urllib.parse
+import time
 from PIL import Image, ImageDraw, ImageFont
 from .geocode import geocode_region_polygon, geocode_city_label
+from .map_cache import map_cache
+from .config import MAP_RENDERER, MAP_FETCH_DEADLINE
+from .fetch import fetch, fetch_all
+from .tiles import get_tile_store, tile_xy, decode_image
+from .basemap import get_base_layer, render_context_panel
+from .imageenc import encode_image, encoder_settings
 
 def _get_font(size):
     for name in [
@@ -38,15 +43,11 @@ def generate_region_map(region_name, city_name=None, lat=None, lon=None):
         dy = (maxlat - minlat) * 1.08
         try:
             url = f"https://static-maps.yandex.ru/1.x/?ll={cx},{cy}&spn={dx},{dy}&l=map&size={w},{h}&lang=ru_RU"
-            req = urllib.request.Request(url, headers={"User-Agent": "Mozilla/5.0"})
-            with urllib.request.urlopen(req, timeout=8) as resp:
-                base = Image.open(io.BytesIO(resp.read())).convert("RGBA")
+            base = Image.open(io.BytesIO(fetch(url, timeout=8))).convert("RGBA")
         except Exception:
             try:
                 url = f"https://static-maps.yandex.ru/1.x/?bbox={minlon},{minlat}~{maxlon},{maxlat}&l=map&size={w},{h}&lang=ru_RU"
-                req = urllib.request.Request(url, headers={"User-Agent": "Mozilla/5.0"})
-                with urllib.request.urlopen(req, timeout=8) as resp:
-                    base = Image.open(io.BytesIO(resp.read())).convert("RGBA")
+                base = Image.open(io.BytesIO(fetch(url, timeout=8))).convert("RGBA")
             except Exception:
                 base = None
         if base is None:
@@ -92,17 +93,11 @@ def generate_region_map(region_name, city_name=None, lat=None, lon=None):
         font2 = _get_font(24)
         title = region_name if not city_name else f"{region_name} / {city_name}"
         d.text((10, 10), title, font=font2, fill=(10,10,10,255))
-        composed = Image.alpha_composite(base, overlay).convert("RGB")
-        buf = io.BytesIO()
-        composed.save(buf, format="PNG")
-        buf.seek(0)
-        return buf.getvalue()
+        return encode_image(Image.alpha_composite(base, overlay))
     if lat is not None and lon is not None:
         try:
             url = f"https://static-maps.yandex.ru/1.x/?ll={lon},{lat}&z=6&size=650,450&l=map&pt={lon},{lat},pm2rdm"
-            req = urllib.request.Request(url, headers={"User-Agent": "Mozilla/5.0"})
-            with urllib.request.urlopen(req, timeout=8) as resp:
-                data = resp.read()
+            data = fetch(url, timeout=8)
             return data
         except Exception:
             pass
@@ -113,18 +108,13 @@ def generate_region_map(region_name, city_name=None, lat=None, lon=None):
     d.rectangle([40, 90, 760, 460], outline=(40, 80, 180), width=6)
     d.text((50, 30), title, font=font, fill=(10, 10, 10))
     d.ellipse([390, 265, 410, 285], fill=(200, 60, 60))
-    buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    buf.seek(0)
-    return buf.getvalue()
+    return encode_image(img)
 
 def generate_full_russia_map(region_name, city_name=None, lat=None, lon=None):
     if lat is not None and lon is not None:
         try:
             url = f"https://static-maps.yandex.ru/1.x/?ll={lon},{lat}&z=3&size=650,450&l=map&pt={lon},{lat},pm2rdm"
-            req = urllib.request.Request(url, headers={"User-Agent": "Mozilla/5.0"})
-            with urllib.request.urlopen(req, timeout=8) as resp:
-                base = Image.open(io.BytesIO(resp.read())).convert("RGBA")
+            base = Image.open(io.BytesIO(fetch(url, timeout=8))).convert("RGBA")
         except Exception:
             base = None
         if base is not None:
@@ -137,20 +127,14 @@ def generate_full_russia_map(region_name, city_name=None, lat=None, lon=None):
             title = region_name if not city_name else f"{region_name} / {city_name}"
             d.rectangle([0,0,base.size[0],28], fill=(255,255,255,220))
             d.text((8,6), title, font=font, fill=(0,0,0,255))
-            composed = Image.alpha_composite(base, overlay).convert("RGB")
-            out = io.BytesIO()
-            composed.save(out, format="PNG")
-            out.seek(0)
-            return out.getvalue()
+            return encode_image(Image.alpha_composite(base, overlay))
     return generate_region_map(region_name, city_name, lat, lon)
 
 def generate_russia_location_map(region_name, city_name=None, lat=None, lon=None):
     if lat is not None and lon is not None:
         try:
             url = f"https://static-maps.yandex.ru/1.x/?ll={lon},{lat}&z=3&size=650,450&l=map&pt={lon},{lat},pm2rdm"
-            req = urllib.request.Request(url, headers={"User-Agent": "Mozilla/5.0"})
-            with urllib.request.urlopen(req, timeout=8) as resp:
-                base = Image.open(io.BytesIO(resp.read())).convert("RGBA")
+            base = Image.open(io.BytesIO(fetch(url, timeout=8))).convert("RGBA")
         except Exception:
             base = None
         if base is not None:
@@ -160,20 +144,14 @@ def generate_russia_location_map(region_name, city_name=None, lat=None, lon=None
             title = region_name if not city_name else f"{region_name} / {city_name}"
             d.rectangle([0,0,base.size[0],28], fill=(255,255,255,220))
             d.text((8,6), title, font=font, fill=(0,0,0,255))
-            composed = Image.alpha_composite(base, overlay).convert("RGB")
-            out = io.BytesIO()
-            composed.save(out, format="PNG")
-            out.seek(0)
-            return out.getvalue()
+            return encode_image(Image.alpha_composite(base, overlay))
     return generate_region_map(region_name, city_name, lat, lon)
 
 def generate_city_focus_map(region_name, city_name=None, lat=None, lon=None):
     if lat is not None and lon is not None:
         try:
             url = f"https://static-maps.yandex.ru/1.x/?ll={lon},{lat}&z=10&size=700,450&l=map&pt={lon},{lat},pm2rdm"
-            req = urllib.request.Request(url, headers={"User-Agent": "Mozilla/5.0"})
-            with urllib.request.urlopen(req, timeout=8) as resp:
-                base = Image.open(io.BytesIO(resp.read())).convert("RGBA")
+            base = Image.open(io.BytesIO(fetch(url, timeout=8))).convert("RGBA")
         except Exception:
             base = None
         if base is not None:
@@ -183,52 +161,96 @@ def generate_city_focus_map(region_name, city_name=None, lat=None, lon=None):
             title = region_name if not city_name else f"{region_name} / {city_name}"
             d.rectangle([0,0,base.size[0],32], fill=(255,255,255,230))
             d.text((10,7), title, font=font, fill=(0,0,0,255))
-            composed = Image.alpha_composite(base, overlay).convert("RGB")
-            out = io.BytesIO()
-            composed.save(out, format="PNG")
-            out.seek(0)
-            return out.getvalue()
+            return encode_image(Image.alpha_composite(base, overlay))
     return generate_russia_location_map(region_name, city_name, lat, lon)
 
+def _local_store(lat, lon, zooms):
+    if MAP_RENDERER == "yandex" or lat is None or lon is None:
+        return None
+    store = get_tile_store()
+    if store is None or not all(store.covers(lat, lon, z) for z in zooms):
+        return None
+    return store
+
+def _dual_sources(lat, lon):
+    # 左侧全国面板优先使用预渲染底图，其次本地瓦片；右侧城市面板使用本地瓦片或 Yandex
+    store = _local_store(lat, lon, (11,))
+    if MAP_RENDERER != "yandex" and get_base_layer() is not None:
+        left = "base"
+    elif _local_store(lat, lon, (3,)) is not None:
+        left = "tiles"
+    else:
+        left = "yandex"
+    right = "tiles" if store is not None else "yandex"
+    return left, right
+
+def city_dual_map_key(region_name, city_name=None, lat=None, lon=None):
+    return map_cache.key("city_dual", _dual_sources(lat, lon), encoder_settings(), region_name, city_name, lat, lon)
+
 def generate_city_dual_map(region_name, city_name=None, lat=None, lon=None):
+    return render_city_dual_map(region_name, city_name, lat, lon)[0]
+
+def render_city_dual_map(region_name, city_name=None, lat=None, lon=None):
+    """
+    返回 (图片字节, 内容键)。内容键仅在结果可复用（完整渲染）时给出，否则为 None。
+    """
     if lat is None or lon is None:
-        return generate_city_focus_map(region_name, city_name, lat, lon)
+        return generate_city_focus_map(region_name, city_name, lat, lon), None
+    key = city_dual_map_key(region_name, city_name, lat, lon)
+    data = map_cache.get(key)
+    if data is not None:
+        return data, key
+    data, complete = _render_city_dual_map(region_name, city_name, lat, lon)
+    # 只缓存两个面板都成功下载的结果，占位图/降级图不入缓存
+    if complete:
+        map_cache.put(key, data)
+        return data, key
+    return data, None
+
+def _render_city_dual_map(region_name, city_name, lat, lon):
+    left_src, right_src = _dual_sources(lat, lon)
     base_left = None
     base_right = None
-    try:
-        u1 = f"https://static-maps.yandex.ru/1.x/?ll={lon},{lat}&z=3&size=650,450&l=map&pt={lon},{lat},pm2rdm"
-        r1 = urllib.request.Request(u1, headers={"User-Agent": "Mozilla/5.0"})
-        with urllib.request.urlopen(r1, timeout=8) as resp:
-            base_left = Image.open(io.BytesIO(resp.read())).convert("RGBA")
-    except Exception:
-        base_left = None
-    try:
-        u2 = f"https://static-maps.yandex.ru/1.x/?ll={lon},{lat}&z=11&size=650,450&l=map&pt={lon},{lat},pm2rdm"
-        r2 = urllib.request.Request(u2, headers={"User-Agent": "Mozilla/5.0"})
-        with urllib.request.urlopen(r2, timeout=8) as resp:
-            base_right = Image.open(io.BytesIO(resp.read())).convert("RGBA")
-    except Exception:
-        base_right = None
+    if left_src == "base":
+        base_left = render_context_panel(lat, lon, (600, 450))
+    elif left_src == "tiles":
+        base_left = get_tile_store().render(lat, lon, 3, (600, 450))
+    if right_src == "tiles":
+        base_right = get_tile_store().render(lat, lon, 11, (600, 450))
+    # 只下载本地无法提供的面板，两个面板并行下载，共享同一个总时限
+    chains = []
+    if base_left is None:
+        chains.append([f"https://static-maps.yandex.ru/1.x/?ll={lon},{lat}&z=3&size=650,450&l=map&pt={lon},{lat},pm2rdm"])
+    if base_right is None:
+        chains.append([f"https://static-maps.yandex.ru/1.x/?ll={lon},{lat}&z=11&size=650,450&l=map&pt={lon},{lat},pm2rdm"])
+    fetched = [decode_image(data) for data in fetch_all(chains)] if chains else []
+    if base_left is None:
+        base_left = fetched.pop(0)
+    if base_right is None:
+        base_right = fetched.pop(0)
     if base_left is None and base_right is None:
-        return generate_city_focus_map(region_name, city_name, lat, lon)
+        return generate_city_focus_map(region_name, city_name, lat, lon), False
+    complete = base_left is not None and base_right is not None
     if base_left is None:
         base_left = base_right
     if base_right is None:
         base_right = base_left
-    canvas = Image.new("RGBA", (1200, 450), (255, 255, 255, 255))
-    canvas.paste(base_left.resize((600, 450)), (0, 0))
-    canvas.paste(base_right.resize((600, 450)), (600, 0))
-    overlay = Image.new("RGBA", canvas.size, (0,0,0,0))
-    d = ImageDraw.Draw(overlay, "RGBA")
+    return _compose_dual(base_left, base_right, region_name, city_name), complete
+
+def _compose_dual_image(left, right, region_name, city_name, title_y=7):
+    # 直接在 RGB 画布上以 RGBA 模式混合绘制标题栏，省去整幅透明图层、alpha_composite 和 RGBA->RGB 转换
+    canvas = Image.new("RGB", (1200, 450), (255, 255, 255))
+    canvas.paste(left if left.size == (600, 450) else left.resize((600, 450)), (0, 0))
+    canvas.paste(right if right.size == (600, 450) else right.resize((600, 450)), (600, 0))
+    d = ImageDraw.Draw(canvas, "RGBA")
     font = _get_font(22)
     title = region_name if not city_name else f"{region_name} / {city_name}"
     d.rectangle([0,0,1200,36], fill=(255,255,255,230))
-    d.text((10,7), title, font=font, fill=(0,0,0,255))
-    composed = Image.alpha_composite(canvas, overlay).convert("RGB")
-    out = io.BytesIO()
-    composed.save(out, format="PNG")
-    out.seek(0)
-    return out.getvalue()
+    d.text((10,title_y), title, font=font, fill=(0,0,0,255))
+    return canvas
+
+def _compose_dual(left, right, region_name, city_name, title_y=7):
+    return encode_image(_compose_dual_image(left, right, region_name, city_name, title_y))
 
 def generate_federation_detail_map(region_name, city_name=None, lat=None, lon=None):
     base = None
@@ -238,63 +260,36 @@ def generate_federation_detail_map(region_name, city_name=None, lat=None, lon=No
     if cx is None or cy is None:
         cx = 37.6173
         cy = 55.7558
-    try:
-        url = f"https://static-maps.yandex.ru/1.x/?ll={cx},{cy}&z=3&size=700,450&l=map&pt={cx},{cy},pm2rdm"
-        req = urllib.request.Request(url, headers={"User-Agent": "Mozilla/5.0"})
-        with urllib.request.urlopen(req, timeout=10) as resp:
-            base = Image.open(io.BytesIO(resp.read())).convert("RGBA")
-    except Exception:
+    z = 6 if city_name or (lat is not None and lon is not None) else 4
+    store = _local_store(cy, cx, (3, z))
+    if store is not None:
+        return _compose_dual(store.render(cy, cx, 3, (600, 450)), store.render(cy, cx, z, (600, 450)), region_name, city_name, title_y=6)
+    deadline = time.monotonic() + MAP_FETCH_DEADLINE
+    url = f"https://static-maps.yandex.ru/1.x/?ll={cx},{cy}&z=3&size=700,450&l=map&pt={cx},{cy},pm2rdm"
+    osm = f"https://staticmap.openstreetmap.de/staticmap.php?center={cy},{cx}&zoom=3&size=700x450&maptype=mapnik&markers={cy},{cx},lightred1"
+    url2 = f"https://static-maps.yandex.ru/1.x/?ll={cx},{cy}&z={z}&size=700,450&l=map&pt={cx},{cy},pm2rdm"
+    osm2 = f"https://staticmap.openstreetmap.de/staticmap.php?center={cy},{cx}&zoom={z}&size=700x450&maptype=mapnik&markers={cy},{cx},lightred1"
+    # 每个面板按 Yandex -> OSM 静态图 的顺序回退，两个面板并行
+    raw_base, raw_inset = fetch_all([[url, osm], [url2, osm2]])
+    base = decode_image(raw_base)
+    inset = decode_image(raw_inset)
+    if base is None:
         try:
-            osm = f"https://staticmap.openstreetmap.de/staticmap.php?center={cy},{cx}&zoom=3&size=700x450&maptype=mapnik&markers={cy},{cx},lightred1"
-            req = urllib.request.Request(osm, headers={"User-Agent": "Mozilla/5.0"})
-            with urllib.request.urlopen(req, timeout=10) as resp:
-                base = Image.open(io.BytesIO(resp.read())).convert("RGBA")
+            base = _tile_fallback(cy, cx, 3, (700, 450), deadline - time.monotonic())
         except Exception:
-            try:
-                img = _tile_fallback(cy, cx, 3, (700, 450))
-                base = img.convert("RGBA")
-            except Exception:
-                base = Image.new("RGBA", (700, 450), (230, 240, 250, 255))
-    z = 6 if city_name or (lat is not None and lon is not None) else 4
-    try:
-        url2 = f"https://static-maps.yandex.ru/1.x/?ll={cx},{cy}&z={z}&size=700,450&l=map&pt={cx},{cy},pm2rdm"
-        req2 = urllib.request.Request(url2, headers={"User-Agent": "Mozilla/5.0"})
-        with urllib.request.urlopen(req2, timeout=10) as resp:
-            inset = Image.open(io.BytesIO(resp.read())).convert("RGBA")
-    except Exception:
+            base = Image.new("RGBA", (700, 450), (230, 240, 250, 255))
+    if inset is None:
         try:
-            osm2 = f"https://staticmap.openstreetmap.de/staticmap.php?center={cy},{cx}&zoom={z}&size=700x450&maptype=mapnik&markers={cy},{cx},lightred1"
-            req2 = urllib.request.Request(osm2, headers={"User-Agent": "Mozilla/5.0"})
-            with urllib.request.urlopen(req2, timeout=10) as resp:
-                inset = Image.open(io.BytesIO(resp.read())).convert("RGBA")
+            inset = _tile_fallback(cy, cx, z, (700, 450), deadline - time.monotonic())
         except Exception:
-            try:
-                img = _tile_fallback(cy, cx, z, (700, 450))
-                inset = img.convert("RGBA")
-            except Exception:
-                inset = Image.new("RGBA", (700, 450), (220, 235, 245, 255))
-    canvas = Image.new("RGBA", (1200, 450), (255, 255, 255, 255))
-    base_resized = base.resize((600, 450))
-    inset_resized = inset.resize((600, 450))
-    canvas.paste(base_resized, (0, 0))
-    canvas.paste(inset_resized, (600, 0))
-    overlay = Image.new("RGBA", canvas.size, (0, 0, 0, 0))
-    d = ImageDraw.Draw(overlay, "RGBA")
-    font = _get_font(22)
-    title = region_name if not city_name else f"{region_name} / {city_name}"
-    d.rectangle([0, 0, 1200, 36], fill=(255, 255, 255, 230))
-    d.text((10, 6), title, font=font, fill=(0, 0, 0, 255))
-    composed = Image.alpha_composite(canvas, overlay).convert("RGB")
-    out = io.BytesIO()
-    composed.save(out, format="PNG")
-    out.seek(0)
-    return out.getvalue()
+            inset = Image.new("RGBA", (700, 450), (220, 235, 245, 255))
+    return _compose_dual(base, inset, region_name, city_name, title_y=6)
 
-def _tile_fallback(lat, lon, z, size):
+def _tile_fallback(lat, lon, z, size, deadline=None):
     ts = 256
     n = 2 ** z
-    x = int((lon + 180.0) / 360.0 * n)
-    y = int((1.0 - math.log(math.tan(math.radians(lat)) + 1.0 / math.cos(math.radians(lat))) / math.pi) / 2.0 * n)
+    fx, fy = tile_xy(lat, lon, z)
+    x, y = int(fx), int(fy)
     urls = []
     for dy in [-1, 0, 1]:
         for dx in [-1, 0, 1]:
@@ -302,14 +297,14 @@ def _tile_fallback(lat, lon, z, size):
             ty = max(0, min(n - 1, y + dy))
             urls.append((dx + 1, dy + 1, f"https://tile.openstreetmap.org/{z}/{tx}/{ty}.png"))
     canvas = Image.new("RGBA", (ts * 3, ts * 3), (235, 240, 250, 255))
-    for ox, oy, u in urls:
-        try:
-            req = urllib.request.Request(u, headers={"User-Agent": "Mozilla/5.0"})
-            with urllib.request.urlopen(req, timeout=10) as resp:
-                img = Image.open(io.BytesIO(resp.read())).convert("RGBA")
+    if deadline is None or deadline > 0:
+        tiles = fetch_all([[u] for _, _, u in urls], deadline)
+    else:
+        tiles = [None] * len(urls)
+    for (ox, oy, _), data in zip(urls, tiles):
+        img = decode_image(data)
+        if img is not None:
             canvas.paste(img, (ox * ts, oy * ts))
-        except Exception:
-            pass
     cxp = ts * 1.5
     cyp = ts * 1.5
     out = canvas.resize(size)
@@ -1,49 +1,153 @@
 import re
+import sys
+import time
+import argparse
+
+# 以下正则与关键词表在导入时编译一次，parse_intent 对文本只做一次关键词扫描和一次数字扫描
+_CJK_RE = re.compile(r"[\u4e00-\u9fff]")
+_CYRILLIC_RE = re.compile(r"[А-Яа-яЁё]")
+# 完整车牌号码格式 (俄罗斯车牌格式: А123ВЕ199)，分组为末尾的 2-3 位地区代码
+_PLATE_PATTERN = r"(?P<plate>[АВЕКМНОРСТУХABEKMHOPCTYX]\d{3}[АВЕКМНОРСТУХABEKMHOPCTYX]{2}(?P<region>\d{2,3}))"
+_PLATE_RE = re.compile(_PLATE_PATTERN)
+_DIGITS_RE = re.compile(r"\d+")
+# 多项查询：一次 finditer 同时找出全部车牌和车牌之外的数字串
+_ITEMS_RE = re.compile(rf"{_PLATE_PATTERN}|\d+")
+# 单条消息最多解析的查询项数
+MAX_ITEMS = 50
+
+PHONE, AUTO, CITY_HINT, REGION_HINT = 1, 2, 4, 8
+KEYWORDS = {
+    PHONE: ["电话", "区号", "area code", "телефон", "код города", "телефонный код"],
+    AUTO: ["车牌", "车牌代码", "region code", "автокод", "номер региона", "код региона"],
+    CITY_HINT: ["город", "телефон", "код города", "телефонный код"],
+    REGION_HINT: ["регион", "номер региона", "код региона"],
+}
+
+def _build_keyword_matcher(groups):
+    # 所有关键词合并为一个多模式匹配器（零宽前瞻可报告重叠匹配）。同一起点只报告最长的关键词，
+    # 因此每个关键词的标志位预先并上它所包含的全部关键词的标志位。
+    flags = {}
+    for flag, words in groups.items():
+        for w in words:
+            flags[w] = flags.get(w, 0) | flag
+    closed = {w: 0 for w in flags}
+    for w in flags:
+        for sub, flag in flags.items():
+            if sub in w:
+                closed[w] |= flag
+    pattern = "|".join(re.escape(w) for w in sorted(flags, key=len, reverse=True))
+    return re.compile(f"(?=({pattern}))"), closed
+
+_KEYWORD_RE, _KEYWORD_FLAGS = _build_keyword_matcher(KEYWORDS)
+
+# 提取城市名时删除的短语及非文字字符（一次 sub 完成）
+_NAME_CHARS = r"[^\w\sА-Яа-яЁё\u4e00-\u9fff-]"
+_PHONE_NAME_RE = re.compile(rf"телефон(?:ный)?\s*код|код\s*города|{_NAME_CHARS}")
+_AUTO_NAME_RE = re.compile(rf"номер\s*региона|код\s*региона|{_NAME_CHARS}")
+_CITY_NAME_RE = re.compile(rf"какой\s*регион|какой\s*город|{_NAME_CHARS}")
 
 def detect_language(text):
-    if re.search(r"[\u4e00-\u9fff]", text):
+    if _CJK_RE.search(text):
         return "zh"
-    if re.search(r"[А-Яа-яЁё]", text):
+    if _CYRILLIC_RE.search(text):
         return "ru"
     return "ru"
 
+def _keyword_flags(t):
+    flags = 0
+    for word in _KEYWORD_RE.findall(t):
+        flags |= _KEYWORD_FLAGS[word]
+    return flags
+
+def _code_intent(flags, run):
+    # 按关键词标志判断一个数字串是电话区号还是车牌地区代码；长度不足时返回 None
+    # （与旧实现的 \d{3,4} / \d{2,3} / \d{2,4} 取第一个匹配等价）
+    if flags & PHONE:
+        return {"intent": "phone_code_to_city", "code": run[:4]} if len(run) >= 3 else None
+    if flags & AUTO:
+        return {"intent": "auto_code_to_region", "code": run[:3]} if len(run) >= 2 else None
+    if len(run) < 2:
+        return None
+    d = run[:4]
+    if flags & CITY_HINT:
+        return {"intent": "phone_code_to_city", "code": d}
+    if flags & REGION_HINT:
+        return {"intent": "auto_code_to_region", "code": d}
+    if len(d) == 4:
+        return {"intent": "phone_code_to_city", "code": d}
+    if len(d) == 2:
+        return {"intent": "auto_code_to_region", "code": d}
+    return {"intent": "phone_code_to_city", "code": d}
+
+def _plate_intent(m):
+    return {"intent": "license_plate", "plate": m.group("plate"), "region_code": m.group("region")}
+
 def parse_intent(text):
+    plate_match = _PLATE_RE.search(text.upper())
+    if plate_match:
+        return _plate_intent(plate_match)
     t = text.strip().lower()
-    # 检测完整车牌号码格式 (俄罗斯车牌格式: А123ВЕ199)
-    license_plate_pattern = r"[АВЕКМНОРСТУХABEKMHOPCTYX]\d{3}[АВЕКМНОРСТУХABEKMHOPCTYX]{2}\d{2,3}"
-    license_plate_match = re.search(license_plate_pattern, text.upper())
-    if license_plate_match:
-        plate = license_plate_match.group()
-        # 提取车牌中的区域代码（最后2-3位数字）
-        region_code = re.search(r"\d{2,3}$", plate).group()
-        return {"intent": "license_plate", "plate": plate, "region_code": region_code}
-    
-    if any(k in t for k in ["电话", "区号", "area code", "телефон", "код города", "телефонный код"]):
-        digits = re.findall(r"\d{3,4}", t)
-        if digits:
-            return {"intent": "phone_code_to_city", "code": digits[0]}
-        name = re.sub(r"(телефон(ный)?\s*код|код\s*города)", "", t)
-        name = re.sub(r"[^\w\sА-Яа-яЁё\u4e00-\u9fff-]", "", name)
-        return {"intent": "city_to_phone_code", "city": name}
-    if any(k in t for k in ["车牌", "车牌代码", "region code", "автокод", "номер региона", "код региона"]):
-        digits = re.findall(r"\d{2,3}", t)
-        if digits:
-            return {"intent": "auto_code_to_region", "code": digits[0]}
-        name = re.sub(r"(номер\s*региона|код\s*региона)", "", t)
-        name = re.sub(r"[^\w\sА-Яа-яЁё\u4e00-\u9fff-]", "", name)
-        return {"intent": "city_to_auto_code", "city": name}
-    digits = re.findall(r"\d{2,4}", t)
-    if digits:
-        d = digits[0]
-        if any(k in t for k in ["город", "телефон", "код города", "телефонный код"]):
-            return {"intent": "phone_code_to_city", "code": d}
-        if any(k in t for k in ["регион", "номер региона", "код региона"]):
-            return {"intent": "auto_code_to_region", "code": d}
-        if len(d) == 4:
-            return {"intent": "phone_code_to_city", "code": d}
-        if len(d) == 2:
-            return {"intent": "auto_code_to_region", "code": d}
-        return {"intent": "phone_code_to_city", "code": d}
-    name = re.sub(r"(какой\s*регион|какой\s*город)", "", t)
-    name = re.sub(r"[^\w\sА-Яа-яЁё\u4e00-\u9fff-]", "", name)
-    return {"intent": "city_to_auto_code", "city": name}
\ No newline at end of file
+    flags = _keyword_flags(t)
+    for run in _DIGITS_RE.findall(t):
+        item = _code_intent(flags, run)
+        if item:
+            return item
+    if flags & PHONE:
+        return {"intent": "city_to_phone_code", "city": _PHONE_NAME_RE.sub("", t)}
+    if flags & AUTO:
+        return {"intent": "city_to_auto_code", "city": _AUTO_NAME_RE.sub("", t)}
+    return {"intent": "city_to_auto_code", "city": _CITY_NAME_RE.sub("", t)}
+
+def parse_intents(text, limit=MAX_ITEMS):
+    """
+    解析消息中的全部查询项（去重，保持出现顺序，最多 limit 项）。
+    有车牌时只返回车牌（与 parse_intent 一致，忽略编号等其他数字）；否则每个有效数字串各为一项。
+    少于两项时返回 [parse_intent(text)]，单项消息的结果与 parse_intent 完全相同。
+    """
+    plates, runs = [], []
+    for m in _ITEMS_RE.finditer(text.upper()):
+        if m.group("plate"):
+            plates.append(m)
+        else:
+            runs.append(m.group())
+    if plates:
+        items = [_plate_intent(m) for m in plates]
+    else:
+        flags = _keyword_flags(text.strip().lower()) if len(runs) > 1 else 0
+        items = [item for item in (_code_intent(flags, run) for run in runs) if item]
+    unique = []
+    for item in items:
+        if item not in unique:
+            unique.append(item)
+    if len(unique) < 2:
+        return [parse_intent(text)]
+    return unique[:limit]
+
+# 基准测试语料：线上常见的查询形式
+BENCH_QUERIES = [
+    "莫斯科车牌代码", "199 是哪个地区", "圣彼得堡电话区号", "812 对应哪个城市", "Екатеринбург номер региона",
+    "495", "Казань код региона", "А123ВЕ199", "M345AB777", "车牌号码 А567КМ123",
+    "Москва", "Новосибирск", "77", "код региона 116", "какой регион 154", "телефонный код Самары",
+    "телефонный код 3843", "код города Тюмень", "какой город 3452", "номер региона Краснодар",
+    "автокод 61", "Ростов-на-Дону автокод", "region code 78", "area code 8332", "喀山车牌", "新西伯利亚 电话",
+    "78 регион", "какой город у кода 4012?", "Владивосток!", "город 423", "8552", "Нижний Тагил телефонный код",
+    "о123мр750 чей номер", "чей номер х777хх77", "Сочи, какой регион?", "伏尔加格勒的区号是多少", "车牌 50",
+    "телефон 8622", "регион 05", "код 35",
+]
+
+def bench(rounds=2000):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for q in BENCH_QUERIES:
+            parse_intent(q)
+    elapsed = time.perf_counter() - start
+    return rounds * len(BENCH_QUERIES) / elapsed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Intent parser microbenchmark")
+    parser.add_argument("--rounds", type=int, default=2000)
+    parser.add_argument("--target", type=float, default=None, help="fail below this many queries per second (off by default: absolute rates depend on the machine)")
+    args = parser.parse_args()
+    qps = bench(args.rounds)
+    print(f"parse_intent: {qps:,.0f} queries/s ({1e6 / qps:.2f} us/query)" + (f", target {args.target:,.0f}" if args.target else ""))
+    sys.exit(0 if not args.target or qps >= args.target else 1)
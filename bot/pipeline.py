@@ -0,0 +1,172 @@
+import json
+import asyncio
+import logging
+
+from .config import MULTI_QUERY_MAX_MAPS, LOOKUP_BACKEND
+from .db import (
+    find_city_by_name, find_city_by_name_fuzzy, find_region_by_name, find_region_by_auto_code, get_region_by_id,
+    get_city_by_region, list_auto_codes_by_region, find_city_by_phone_code, list_phone_codes_by_city,
+)
+from .nlp import parse_intents
+from .batch import resolve_intents
+from .workers import geocode_pool
+from .reply_templates import format_auto_result, format_auto_region_only, format_phone_result, format_not_found, format_license_plate, format_combined
+
+logger = logging.getLogger(__name__)
+
+class Resolution:
+    """
+    一条消息的解析结果。回复文本、地图和语音由调用方作为相互独立的阶段发送。
+    maps 为 [(region_name, city_name, lat, lon)]；voice 为 False 时不生成语音。
+    """
+
+    def __init__(self, intent, entities, reply, maps=(), voice=True, result=None):
+        self.intent = intent
+        self.entities = entities
+        self.reply = reply
+        self.maps = list(maps)
+        self.voice = voice
+        self.result = result if result is not None else {"reply": reply}
+
+def _not_found(lang, intent, entities):
+    return Resolution(intent, entities, format_not_found(lang), voice=False, result={"found": False})
+
+def _region_map(region_id, region_name):
+    city_row = get_city_by_region(region_id)
+    return (region_name, city_row[1] if city_row else None, city_row[3] if city_row else None, city_row[4] if city_row else None)
+
+async def _lookup(fn, *args):
+    # 内存索引的查询是微秒级，直接在事件循环中执行；LOOKUP_BACKEND=sql 时每次查询都读 SQLite，
+    # 整组查询放到工作线程中执行，不阻塞事件循环
+    if LOOKUP_BACKEND != "memory":
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+def _find_city(data):
+    city_name = data.get("city", "").strip()
+    return find_city_by_name(city_name) or find_city_by_name_fuzzy(city_name)
+
+def _guess_region(data, geo):
+    return find_region_by_name(geo["region"]) or find_region_by_name(data.get("city", "").strip())
+
+# 以下查询函数都是同步的，由 _lookup 调度。城市类查询在参考库中找不到城市时返回 None，
+# 由 resolve 地理编码后交给对应的 *_geo 函数按所属地区回复
+
+def _city_to_auto_code(lang, data):
+    city = _find_city(data)
+    if not city:
+        return None
+    city_id, city_ru, city_zh, region_id, lat, lon = city
+    region_row = get_region_by_id(region_id)
+    region_ru = region_row[1] if region_row else ""
+    region_zh = region_row[2] if region_row else ""
+    reply = format_auto_result(lang, city_ru, city_zh, region_ru, region_zh, list_auto_codes_by_region(region_id))
+    return Resolution("city_to_auto_code", data, reply, [(region_ru or region_zh, city_ru, lat, lon)])
+
+def _city_to_auto_code_geo(lang, data, geo):
+    region_guess = _guess_region(data, geo)
+    if not region_guess:
+        return _not_found(lang, "city_to_auto_code", data)
+    region_id, region_ru, region_zh = region_guess
+    reply = format_auto_region_only(lang, region_ru, region_zh, list_auto_codes_by_region(region_id))
+    return Resolution("city_to_auto_code", data, reply, [(region_ru, geo.get("city"), geo.get("lat"), geo.get("lon"))])
+
+def _city_to_phone_code(lang, data):
+    city = _find_city(data)
+    if not city:
+        return None
+    city_id, city_ru, city_zh, region_id, lat, lon = city
+    region_row = get_region_by_id(region_id)
+    region_ru = region_row[1] if region_row else ""
+    region_zh = region_row[2] if region_row else ""
+    reply = format_phone_result(lang, city_ru, city_zh, region_ru, region_zh, list_phone_codes_by_city(city_id))
+    return Resolution("city_to_phone_code", data, reply, [(region_ru, city_ru, lat, lon)])
+
+def _city_to_phone_code_geo(lang, data, geo):
+    region_guess = _guess_region(data, geo)
+    if not region_guess:
+        return _not_found(lang, "city_to_phone_code", data)
+    region_id, region_ru, region_zh = region_guess
+    city_row = get_city_by_region(region_id)
+    codes = list_phone_codes_by_city(city_row[0]) if city_row else []
+    reply = format_phone_result(lang, geo.get("city"), None, region_ru, region_zh, codes or ["—"])
+    return Resolution("city_to_phone_code", data, reply, [(region_ru, geo.get("city"), geo.get("lat"), geo.get("lon"))])
+
+def _auto_code_to_region(lang, data):
+    region = find_region_by_auto_code(data.get("code", ""))
+    if not region:
+        return _not_found(lang, "auto_code_to_region", data)
+    region_id, region_ru, region_zh = region
+    reply = format_auto_region_only(lang, region_ru, region_zh, list_auto_codes_by_region(region_id))
+    return Resolution("auto_code_to_region", data, reply, [_region_map(region_id, region_ru)])
+
+def _phone_code_to_city(lang, data):
+    row = find_city_by_phone_code(data.get("code", ""))
+    if not row:
+        return _not_found(lang, "phone_code_to_city", data)
+    city_id, city_ru, city_zh, region_id, region_ru, region_zh, lat, lon = row
+    reply = format_phone_result(lang, city_ru, city_zh, region_ru, region_zh, list_phone_codes_by_city(city_id))
+    return Resolution("phone_code_to_city", data, reply, [(region_ru, city_ru, lat, lon)])
+
+def _license_plate(lang, data):
+    region = find_region_by_auto_code(data.get("region_code", ""))
+    if not region:
+        return _not_found(lang, "license_plate", data)
+    region_id, region_ru, region_zh = region
+    reply = format_license_plate(lang, data.get("plate", ""), region_ru, region_zh)
+    return Resolution("license_plate", data, reply, [_region_map(region_id, region_ru)])
+
+# 意图 -> (本地查询, 地理编码后的回退查询或 None)
+RESOLVERS = {
+    "city_to_auto_code": (_city_to_auto_code, _city_to_auto_code_geo),
+    "city_to_phone_code": (_city_to_phone_code, _city_to_phone_code_geo),
+    "auto_code_to_region": (_auto_code_to_region, None),
+    "phone_code_to_city": (_phone_code_to_city, None),
+    "license_plate": (_license_plate, None),
+}
+
+def _multi_map_targets(results, limit):
+    # 多项查询的地图按地区去重：同一地区只渲染一次，最多 limit 张
+    targets = {}
+    for r in results:
+        region = r.get("region")
+        city = r.get("city")
+        if not r.get("found") or not region or region["id"] in targets or not isinstance(city, dict):
+            continue
+        targets[region["id"]] = (region["name_ru"] or region["name_zh"], city["name_ru"], city["lat"], city["lon"])
+        if len(targets) >= limit:
+            break
+    return list(targets.values())
+
+def _resolve_multi(lang, items):
+    # 一条消息包含多个车牌/代码：一次批量查询，合并为一条回复。合并回复可达数千字，
+    # 朗读既占用语音线程又只会产生一次性的缓存条目，因此不生成语音
+    results = resolve_intents(items)
+    reply = format_combined(lang, results)
+    found = sum(1 for r in results if r.get("found"))
+    return Resolution("multi", items, reply, _multi_map_targets(results, MULTI_QUERY_MAX_MAPS), voice=False, result={"reply": reply, "found": found})
+
+def query_key(items, lang):
+    """相同查询的合并键：回复语言 + parse_intents 解析出的查询项（已归一化大小写和标点）。"""
+    return json.dumps([lang, items], ensure_ascii=False, sort_keys=True)
+
+async def resolve(text, lang, items=None):
+    """解析消息并完成数据查询（必要时地理编码），返回 Resolution。items 为已解析的 parse_intents 结果。"""
+    if items is None:
+        items = parse_intents(text)
+    if len(items) > 1:
+        return await _lookup(_resolve_multi, lang, items)
+    data = items[0]
+    intent = data.get("intent")
+    if intent not in RESOLVERS:
+        return _not_found(lang, intent, data)
+    local, after_geocode = RESOLVERS[intent]
+    res = await _lookup(local, lang, data)
+    if res is not None:
+        return res
+    # 本地找不到城市时，用地理编码得到所属地区
+    from .geocode import geocode_city
+    geo = await geocode_pool.run(geocode_city, data.get("city", "").strip())
+    if not geo or not geo.get("region"):
+        return _not_found(lang, intent, data)
+    return await _lookup(after_geocode, lang, data, geo)
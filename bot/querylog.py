@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import time
+
+from .config import QUERY_LOG_BATCH_SIZE, QUERY_LOG_FLUSH_MS, QUERY_LOG_QUEUE_SIZE, QUERY_LOG_POLICY
+from .db import save_queries
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+class QueryLogWriter:
+    """
+    查询日志的异步批量写入器。
+    处理函数只把记录放进有界队列；后台任务每 batch_size 条或每 flush_interval_ms 毫秒
+    用一次 executemany 事务落盘。队列满时按 policy 丢弃（drop）或等待（block）。
+    """
+
+    def __init__(self, batch_size=100, flush_interval_ms=500, max_queue=10000, policy="drop"):
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = max(1, int(flush_interval_ms)) / 1000.0
+        self.max_queue = max(1, int(max_queue))
+        self.policy = policy
+        self._queue = None
+        self._task = None
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.flushes = 0
+        self.failed = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def put(self, record):
+        self.start()
+        if self.policy == "block":
+            await self._queue.put(record)
+        else:
+            try:
+                self._queue.put_nowait(record)
+            except asyncio.QueueFull:
+                self.dropped += 1
+                logger.warning("Query log queue full, dropping record")
+                return False
+        self.enqueued += 1
+        return True
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        t0 = time.perf_counter()
+        try:
+            await asyncio.to_thread(save_queries, batch)
+            self.written += len(batch)
+        except Exception as e:
+            self.failed += len(batch)
+            logger.error(f"Failed to flush {len(batch)} query log records: {e}", exc_info=True)
+        ms = (time.perf_counter() - t0) * 1000.0
+        self.flushes += 1
+        self.last_flush_ms = ms
+        self.max_flush_ms = max(self.max_flush_ms, ms)
+        self.total_flush_ms += ms
+
+    async def stop(self):
+        if self._task is None:
+            return
+        # 哨兵排在已入队记录之后，后台任务写完之前的所有记录再退出
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+        logger.info(f"Query log writer stopped: {self.stats()}")
+
+    def stats(self):
+        return {
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "written": self.written,
+            "failed": self.failed,
+            "flushes": self.flushes,
+            "last_flush_ms": round(self.last_flush_ms, 3),
+            "max_flush_ms": round(self.max_flush_ms, 3),
+            "avg_flush_ms": round(self.total_flush_ms / self.flushes, 3) if self.flushes else 0.0,
+        }
+
+query_log = QueryLogWriter(QUERY_LOG_BATCH_SIZE, QUERY_LOG_FLUSH_MS, QUERY_LOG_QUEUE_SIZE, QUERY_LOG_POLICY)
+
+async def log_query(user_id, language, intent, raw_text, parsed_entities, result, created_at):
+    return await query_log.put((user_id, language, intent, raw_text, parsed_entities, result, created_at))
@@ -0,0 +1,114 @@
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+
+class TokenBucket:
+    """
+    线程安全的令牌桶。rate 为每秒补充的令牌数，burst 为桶容量。
+    reserve() 预约一个令牌并返回需要等待的秒数（令牌可预支为负数，后来者依次排队）；
+    等待时间超过 max_wait 时不预约，返回 None。
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, max_wait=None):
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            wait = (1 - self._tokens) / self.rate
+            if max_wait is not None and wait > max_wait:
+                return None
+            self._tokens -= 1
+            return wait
+
+    def try_acquire(self):
+        return self.reserve(max_wait=0) is not None
+
+    def acquire(self, max_wait=None):
+        wait = self.reserve(max_wait)
+        if wait is None:
+            return False
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+class UserRateLimiter:
+    """
+    按用户的令牌桶限流（rate 为每秒补充的请求数，burst 为突发上限；rate <= 0 时不限流）。
+    最多保留 max_users 个最近活跃用户的桶，淘汰的用户下次重新获得满桶。
+    check() 返回 (是否放行, 是否需要提示)：同一轮限流中只提示一次，避免刷屏消息再换来刷屏回复。
+    """
+
+    def __init__(self, rate, burst, max_users=10000):
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        self.max_users = max(1, int(max_users))
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.limited = 0
+
+    def check(self, user_id):
+        if self.rate <= 0:
+            return True, False
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                entry = self._users[user_id] = [TokenBucket(self.rate, self.burst), False]
+                if len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+            else:
+                self._users.move_to_end(user_id)
+            if entry[0].try_acquire():
+                entry[1] = False
+                self.allowed += 1
+                return True, False
+            notify = not entry[1]
+            entry[1] = True
+            self.limited += 1
+            return False, notify
+
+    def stats(self):
+        with self._lock:
+            return {"users": len(self._users), "allowed": self.allowed, "limited": self.limited}
+
+class AsyncSingleFlight:
+    """
+    asyncio 版的请求合并：同一 key 的并发调用只运行一次 fn()，其余调用方等待并共享结果（或异常）。
+    共享任务独立于调用方运行，某个调用方超时或被取消不会影响其他等待者。
+    """
+
+    def __init__(self):
+        self._tasks = {}
+        self.leaders = 0
+        self.shared = 0
+
+    def _forget(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+
+    async def do(self, key, fn):
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._tasks[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+            self.leaders += 1
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+    def stats(self):
+        return {"inflight": len(self._tasks), "leaders": self.leaders, "shared": self.shared}
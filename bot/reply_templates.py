@@ -18,7 +18,44 @@ def format_not_found(lang):
         return "未找到匹配结果"
     return "Ничего не найдено"
 
+def format_busy(lang):
+    if lang == "zh":
+        return "服务繁忙，请稍后再试"
+    return "Сервис перегружен, попробуйте чуть позже"
+
+def format_rate_limited(lang):
+    if lang == "zh":
+        return "请求过于频繁，请稍后再试"
+    return "Слишком много запросов, подождите немного"
+
 def format_license_plate(lang, plate, region_ru, region_zh):
     if lang == "zh":
         return f"车牌号码：{plate}\n所属区域：{region_zh or region_ru}"
-    return f"Номерной знак: {plate}\nРегион: {region_ru or region_zh}"
\ No newline at end of file
+    return f"Номерной знак: {plate}\nРегион: {region_ru or region_zh}"
+
+
+def format_result(lang, result):
+    # 将 batch.resolve_intents 的单项结果格式化为文本，多项查询的合并回复逐项使用；
+    # 每项以用户输入的车牌/代码/城市名开头，便于对应到各自的查询
+    label = result.get("plate") or result.get("code") or (result.get("city") if isinstance(result.get("city"), str) else "")
+    body = _format_result_body(lang, result)
+    if not label:
+        return body
+    return f"{label}:\n{body}" if result.get("found") else f"{label}: {body}"
+
+def _format_result_body(lang, result):
+    intent = result.get("intent")
+    if not result.get("found"):
+        return format_not_found(lang)
+    region = result.get("region") or {}
+    city = result.get("city") or {}
+    if intent == "license_plate":
+        return format_license_plate(lang, result["plate"], region.get("name_ru"), region.get("name_zh"))
+    if intent == "auto_code_to_region":
+        return format_auto_region_only(lang, region.get("name_ru"), region.get("name_zh"), result.get("auto_codes", []))
+    if intent in ("phone_code_to_city", "city_to_phone_code"):
+        return format_phone_result(lang, city.get("name_ru"), city.get("name_zh"), region.get("name_ru"), region.get("name_zh"), result.get("phone_codes", []))
+    return format_auto_result(lang, city.get("name_ru"), city.get("name_zh"), region.get("name_ru"), region.get("name_zh"), result.get("auto_codes", []))
+
+def format_combined(lang, results):
+    return "\n\n".join(format_result(lang, r) for r in results)
@@ -0,0 +1,246 @@
+import io
+import os
+import sys
+import math
+import time
+import shutil
+import sqlite3
+import tempfile
+import argparse
+import threading
+from collections import OrderedDict
+from PIL import Image, ImageDraw
+
+from .config import MAP_TILES_PATH, MAP_TILE_CACHE
+
+TILE_SIZE = 256
+BACKGROUND = (235, 240, 250, 255)
+
+def tile_xy(lat, lon, z):
+    # Web Mercator：经纬度 -> 瓦片坐标（浮点，整数部分为瓦片号）
+    n = 2 ** z
+    lat = max(-85.0511, min(85.0511, lat))
+    x = (lon + 180.0) / 360.0 * n
+    y = (1.0 - math.log(math.tan(math.radians(lat)) + 1.0 / math.cos(math.radians(lat))) / math.pi) / 2.0 * n
+    return x, y
+
+def pixel_xy(lat, lon, z):
+    x, y = tile_xy(lat, lon, z)
+    return x * TILE_SIZE, y * TILE_SIZE
+
+def decode_image(data):
+    if not data:
+        return None
+    try:
+        return Image.open(io.BytesIO(data)).convert("RGBA")
+    except Exception:
+        return None
+
+def draw_marker(img, x, y):
+    # 在透明小图层上绘制再合成，半透明光圈才能与底图混合
+    r = 52
+    mark = Image.new("RGBA", (2 * r + 1, 2 * r + 1), (0, 0, 0, 0))
+    d = ImageDraw.Draw(mark)
+    d.ellipse([0, 0, 2 * r, 2 * r], fill=(255, 0, 0, 60))
+    d.ellipse([r - 22, r - 22, r + 22, r + 22], fill=(255, 0, 0, 180))
+    d.ellipse([r - 6, r - 6, r + 6, r + 6], fill=(255, 255, 255, 255))
+    left, top = int(round(x)) - r, int(round(y)) - r
+    box = (max(0, left), max(0, top), min(img.size[0], left + mark.size[0]), min(img.size[1], top + mark.size[1]))
+    if box[0] >= box[2] or box[1] >= box[3]:
+        return
+    src = mark.crop((box[0] - left, box[1] - top, box[2] - left, box[3] - top))
+    img.alpha_composite(src, (box[0], box[1]))
+
+class TileStore:
+    """
+    MBTiles（SQLite）本地瓦片库的只读访问，带解码后瓦片的 LRU 缓存。
+    MBTiles 使用 TMS 行号，读取时做 y 翻转。
+    """
+
+    def __init__(self, path, cache_tiles=256):
+        self.path = path
+        self.cache_tiles = cache_tiles
+        self._local = threading.local()
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.zooms = set(r[0] for r in self._conn().execute("SELECT DISTINCT zoom_level FROM tiles"))
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro&immutable=1", uri=True, check_same_thread=False)
+            self._local.conn = conn
+        return conn
+
+    def tile_bytes(self, z, x, y):
+        row = self._conn().execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+            (z, x, (2 ** z - 1) - y),
+        ).fetchone()
+        return row[0] if row else None
+
+    def tile(self, z, x, y):
+        key = (z, x, y)
+        with self._lock:
+            img = self._cache.get(key)
+            if img is not None or key in self._cache:
+                self._cache.move_to_end(key)
+                return img
+        data = self.tile_bytes(z, x, y)
+        img = Image.open(io.BytesIO(data)).convert("RGBA") if data else None
+        with self._lock:
+            self._cache[key] = img
+            while len(self._cache) > self.cache_tiles:
+                self._cache.popitem(last=False)
+        return img
+
+    def covers(self, lat, lon, z):
+        if z not in self.zooms:
+            return False
+        x, y = tile_xy(lat, lon, z)
+        return self.tile_bytes(z, int(x), int(y)) is not None
+
+    def render(self, lat, lon, z, size, marker=True):
+        # 以 (lat, lon) 为中心拼接 size 大小的视图，缺失瓦片用背景色填充
+        w, h = size
+        n = 2 ** z
+        cx, cy = pixel_xy(lat, lon, z)
+        left = int(round(cx - w / 2.0))
+        top = int(round(cy - h / 2.0))
+        out = Image.new("RGBA", (w, h), BACKGROUND)
+        for ty in range(top // TILE_SIZE, (top + h - 1) // TILE_SIZE + 1):
+            if ty < 0 or ty >= n:
+                continue
+            for tx in range(left // TILE_SIZE, (left + w - 1) // TILE_SIZE + 1):
+                img = self.tile(z, tx % n, ty)
+                if img is not None:
+                    out.paste(img, (tx * TILE_SIZE - left, ty * TILE_SIZE - top))
+        if marker:
+            draw_marker(out, cx - left, cy - top)
+        return out
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_tile_store():
+    global _store
+    if not MAP_TILES_PATH or not os.path.exists(MAP_TILES_PATH):
+        return None
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = TileStore(MAP_TILES_PATH, MAP_TILE_CACHE)
+    return _store
+
+def build_fixture_tileset(path, min_zoom=3, max_zoom=11, bbox=(36.0, 55.0, 39.0, 56.8)):
+    # 生成离线测试用的小型瓦片库：每块瓦片为带网格和坐标的纯色图
+    minlon, minlat, maxlon, maxlat = bbox
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+    conn.execute("CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)")
+    conn.execute("CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)")
+    conn.executemany("INSERT INTO metadata VALUES (?,?)", [
+        ("name", "fixture"), ("format", "png"),
+        ("minzoom", str(min_zoom)), ("maxzoom", str(max_zoom)),
+        ("bounds", f"{minlon},{minlat},{maxlon},{maxlat}"),
+    ])
+    count = 0
+    for z in range(min_zoom, max_zoom + 1):
+        n = 2 ** z
+        x0, y0 = tile_xy(maxlat, minlon, z)
+        x1, y1 = tile_xy(minlat, maxlon, z)
+        rows = []
+        for x in range(max(0, int(x0) - 1), min(n - 1, int(x1) + 1) + 1):
+            for y in range(max(0, int(y0) - 1), min(n - 1, int(y1) + 1) + 1):
+                img = Image.new("RGB", (TILE_SIZE, TILE_SIZE), ((x * 53) % 200 + 40, (y * 97) % 200 + 40, (z * 31) % 200 + 40))
+                d = ImageDraw.Draw(img)
+                d.rectangle([0, 0, TILE_SIZE - 1, TILE_SIZE - 1], outline=(255, 255, 255))
+                d.text((8, 8), f"{z}/{x}/{y}", fill=(0, 0, 0))
+                buf = io.BytesIO()
+                img.save(buf, format="PNG")
+                rows.append((z, x, (n - 1) - y, buf.getvalue()))
+        conn.executemany("INSERT INTO tiles VALUES (?,?,?,?)", rows)
+        count += len(rows)
+    conn.commit()
+    conn.close()
+    return count
+
+# 基准测试的城市坐标（均在默认测试瓦片库范围内）
+BENCH_POINTS = [(55.7558, 37.6173), (55.6500, 37.4500), (55.8500, 37.8500)]
+BENCH_BBOX = (37.2, 55.5, 38.0, 56.0)
+
+def bench(path, latency_ms=150, rounds=10):
+    """
+    对比双窗城市地图的两条渲染路径，返回 [(路径, 平均毫秒, 最快毫秒, 是否完整渲染)]。
+    tiles：两个面板都由本地 TileStore 拼接；yandex：两个面板经 fetch_all 并行下载，
+    请求由 bot.fetch 的本地桩服务器响应并模拟 latency_ms 的网络延迟。均不经过地图缓存。
+    """
+    from . import maps
+    from .fetch import _StubTileServer, fetch_all
+    store = TileStore(path)
+    # 桩服务器返回与 Yandex 静态图同尺寸的图片，下载后同样需要解码
+    buf = io.BytesIO()
+    store.render(BENCH_POINTS[0][0], BENCH_POINTS[0][1], 11, (650, 450)).convert("RGB").save(buf, format="PNG")
+    saved = (maps.MAP_RENDERER, maps.get_tile_store, maps.get_base_layer, maps.fetch_all)
+    results = []
+    with _StubTileServer(buf.getvalue()) as stub:
+        try:
+            maps.get_tile_store = lambda: store
+            maps.get_base_layer = lambda: None
+            maps.fetch_all = lambda chains, deadline=None: fetch_all([[stub.url(latency_ms)] for _ in chains], deadline)
+            fetch_all([[stub.url()]], deadline=5)  # 预热连接池
+            for renderer in ("tiles", "yandex"):
+                maps.MAP_RENDERER = "auto" if renderer == "tiles" else "yandex"
+                times = []
+                complete = True
+                for _ in range(rounds):
+                    for lat, lon in BENCH_POINTS:
+                        start = time.perf_counter()
+                        _, ok = maps._render_city_dual_map("Москва", "Москва", lat, lon)
+                        times.append((time.perf_counter() - start) * 1000)
+                        complete = complete and ok and maps._dual_sources(lat, lon) == ((renderer,) * 2)
+                results.append((renderer, sum(times) / len(times), min(times), complete))
+        finally:
+            maps.MAP_RENDERER, maps.get_tile_store, maps.get_base_layer, maps.fetch_all = saved
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local MBTiles tile store tools")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    fx = sub.add_parser("fixture", help="generate a small synthetic tileset for offline testing")
+    fx.add_argument("path")
+    fx.add_argument("--min-zoom", type=int, default=3)
+    fx.add_argument("--max-zoom", type=int, default=11)
+    fx.add_argument("--bbox", default="36.0,55.0,39.0,56.8", help="minlon,minlat,maxlon,maxlat")
+    bn = sub.add_parser("bench", help="time the dual city map from local tiles vs downloaded panels (stub server latency)")
+    bn.add_argument("path", nargs="?", help="MBTiles covering z3 and z11 around Moscow (default: a temporary fixture)")
+    bn.add_argument("--latency-ms", type=int, default=150, help="simulated per-request latency of the static map server")
+    bn.add_argument("--rounds", type=int, default=10)
+    args = parser.parse_args()
+    if args.cmd == "fixture":
+        n = build_fixture_tileset(args.path, args.min_zoom, args.max_zoom, tuple(float(v) for v in args.bbox.split(",")))
+        print(f"Wrote {n} tiles to {args.path}")
+    elif args.cmd == "bench":
+        import logging
+        from .fetch import close
+        logging.disable(logging.WARNING)
+        tmp = None
+        path = args.path
+        if path is None:
+            tmp = tempfile.mkdtemp()
+            path = os.path.join(tmp, "bench.mbtiles")
+            build_fixture_tileset(path, 3, 11, BENCH_BBOX)
+        try:
+            results = bench(path, args.latency_ms, args.rounds)
+        finally:
+            close()
+            if tmp:
+                shutil.rmtree(tmp, ignore_errors=True)
+        print(f"{len(BENCH_POINTS)} points x {args.rounds} rounds, stub latency {args.latency_ms} ms")
+        print(f"{'path':<8}{'mean ms':>10}{'best ms':>10}{'complete':>10}")
+        for name, mean_ms, best_ms, complete in results:
+            print(f"{name:<8}{mean_ms:>10.1f}{best_ms:>10.1f}{str(complete):>10}")
+        print(f"tiles/yandex: {results[0][1] / results[1][1]:.2f}x")
+        sys.exit(0 if all(complete for *_, complete in results) else 1)
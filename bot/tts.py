@@ -1,8 +1,17 @@
+import io
 import os
+import sys
 import time
+import queue
 import logging
+import argparse
+import tempfile
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
 
-from .config import TTS_AUDIO_DIR
+from .config import TTS_AUDIO_DIR, VOICE_STAGE_TIMEOUT, TTS_CACHE_MEM_ITEMS, TTS_CACHE_MEM_MB, TTS_CACHE_DISK_MB, TTS_CACHE_MAX_AGE_DAYS
+from .map_cache import MapCache
+from .audio import voice_encoder
 
 # 初始化可用引擎列表
 ENGINES = {}
@@ -21,6 +30,171 @@ except ImportError:
     ENGINES['pyttsx3'] = False
     logging.warning("pyttsx3 模块未安装")
 
+# 各来源输出的音频格式（用作发送时的文件扩展名），按查找缓存时的优先级排列；bank 为 voicebank 片段拼接
+ENGINE_EXT = {"bank": "wav", "gtts": "mp3", "pyttsx3": "wav"}
+
+# 合成结果缓存：回复文本高度重复，同一 (引擎, 语言, 文本) 只合成一次，文件长期保留并按 LRU/容量淘汰
+voice_cache = MapCache(
+    os.path.join(TTS_AUDIO_DIR, "cache"),
+    mem_items=TTS_CACHE_MEM_ITEMS,
+    mem_bytes=TTS_CACHE_MEM_MB * 1024 * 1024,
+    disk_bytes=TTS_CACHE_DISK_MB * 1024 * 1024,
+    max_age=TTS_CACHE_MAX_AGE_DAYS * 86400,
+    ext="audio",
+)
+
+def normalize_text(text):
+    # 只用于缓存键：仅空白不同的回复共用同一段语音
+    return " ".join((text or "").split())
+
+def _clip_format():
+    # 缓存按实际发送的格式区分：能编码时只缓存 OGG/Opus，否则缓存引擎原始输出
+    return "ogg" if voice_encoder.available() else "raw"
+
+def clip_key(engine, lang, text, fmt=None):
+    return MapCache.key("tts", engine, fmt or _clip_format(), lang, normalize_text(text))
+
+def _clip_name(engine, fmt):
+    return f"voice.{'ogg' if fmt == 'ogg' else ENGINE_EXT[engine]}"
+
+def cached_clip(text, lang="ru"):
+    """按来源优先级查找已缓存的语音，返回 (音频字节, 文件名)；未命中返回 (None, None)。"""
+    fmt = _clip_format()
+    for engine in ENGINE_EXT:
+        data = voice_cache.get(clip_key(engine, lang, text, fmt))
+        if data:
+            return data, _clip_name(engine, fmt)
+    return None, None
+
+def synthesize_clip(text, lang="ru"):
+    """
+    返回 (音频字节, 文件名)：先查缓存，其次用片段库拼接，最后调用 TTS 引擎；
+    能编码时转为 OGG/Opus 后写入缓存。合成失败返回 (None, None)。
+    """
+    from .voicebank import assemble_clip
+    data, filename = cached_clip(text, lang)
+    if data:
+        return data, filename
+    source, _ = assemble_clip(text, lang)
+    if source:
+        engine, encoded = "bank", voice_encoder.encode(source) if voice_encoder.available() else None
+    else:
+        engine, encoded, source = _synthesize(text, lang, voice_encoder)
+        if not source:
+            return None, None
+    # 编码失败时发送原始音频，但不缓存，下次重新尝试编码
+    fmt = "ogg" if encoded else "raw"
+    data = encoded or source
+    if fmt == _clip_format():
+        voice_cache.put(clip_key(engine, lang, text, fmt), data)
+    return data, _clip_name(engine, fmt)
+
+def _find_voice(voices, lang):
+    for v in voices:
+        if lang == "zh":
+            if "zh" in str(v.languages).lower() or "Chinese" in v.name:
+                return v.id
+        elif "ru" in str(v.languages).lower() or "Russian" in v.name:  # 默认俄语
+            return v.id
+    return None
+
+class Pyttsx3Worker:
+    """
+    独占一个 pyttsx3 引擎的常驻线程。pyttsx3 引擎不是线程安全的，这里只在该线程内初始化和使用：
+    语速只设置一次，每种语言的 voice 只在首次使用时查找一次。
+    其他线程通过 synthesize() 提交任务并等待生成的文件路径；任务失败后引擎会在下一个任务前重新初始化。
+    """
+
+    def __init__(self, driver=None, timeout=None):
+        self.driver = driver
+        self.timeout = timeout
+        self._jobs = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._engine = None
+        self._default_voice = None
+        self._voices = {}
+        self.inits = 0
+        self.jobs = 0
+        self.failed = 0
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="pyttsx3-worker", daemon=True)
+                self._thread.start()
+
+    def synthesize(self, text, lang, fpath):
+        """提交一个合成任务并等待完成，返回 fpath；超时或失败时抛出异常。"""
+        fut = Future()
+        self._ensure_thread()
+        self._jobs.put((text, lang, fpath, fut))
+        try:
+            return fut.result(self.timeout)
+        except FutureTimeout:
+            # 尚未开始的任务直接取消，不再占用引擎线程；已在合成的任务无法中断，
+            # 引擎返回后由工作线程删除它写出的文件（调用方此时已放弃该文件）
+            if not fut.cancel():
+                fut.add_done_callback(lambda _: _remove_quietly(fpath))
+            raise
+
+    def _loop(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            text, lang, fpath, fut = job
+            if not fut.set_running_or_notify_cancel():
+                continue
+            try:
+                fut.set_result(self._run(text, lang, fpath))
+            except BaseException as e:
+                self.failed += 1
+                self._engine = None
+                fut.set_exception(e)
+        self._engine = None
+
+    def _get_engine(self):
+        if self._engine is None:
+            engine = pyttsx3.init(self.driver)
+            # 设置语速
+            try:
+                rate = engine.getProperty('rate')
+                engine.setProperty('rate', max(120, rate - 40))
+            except Exception:
+                pass
+            self._default_voice = engine.getProperty('voice')
+            self._voices = {}
+            self._engine = engine
+            self.inits += 1
+        return self._engine
+
+    def _run(self, text, lang, fpath):
+        engine = self._get_engine()
+        if lang not in self._voices:
+            try:
+                self._voices[lang] = _find_voice(engine.getProperty('voices'), lang)
+            except Exception:
+                self._voices[lang] = None
+        # 没有对应语言的 voice 时恢复默认值，避免沿用上一个任务的语言
+        voice = self._voices[lang] or self._default_voice
+        if voice:
+            engine.setProperty('voice', voice)
+        engine.save_to_file(text, fpath)
+        engine.runAndWait()
+        self.jobs += 1
+        return fpath
+
+    def stop(self, wait=False):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and thread.is_alive():
+            self._jobs.put(None)
+            if wait:
+                thread.join()
+
+pyttsx3_worker = Pyttsx3Worker(timeout=VOICE_STAGE_TIMEOUT)
+
 def synthesize(text, lang="ru"):
     """
     合成语音并保存为文件。
@@ -33,82 +207,100 @@ def synthesize(text, lang="ru"):
     Returns:
         合成的音频文件路径，如果失败则返回 None
     """
+    engine, _, source = _synthesize(text, lang)
+    if not source:
+        return None
+    fpath = os.path.join(TTS_AUDIO_DIR, f"tts_{engine}_{int(time.time()*1000)}.{ENGINE_EXT[engine]}")
+    with open(fpath, "wb") as f:
+        f.write(source)
+    return fpath
+
+def _gtts_to(fp, text, lang):
+    # gTTS 语言代码: 'zh-CN' 或 'zh-TW' for Chinese, 'ru' for Russian
+    gtts_lang = 'zh-CN' if lang == 'zh' else 'ru'
+    gTTS(text=text, lang=gtts_lang).write_to_fp(fp)
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def _pyttsx3_to(fp, text, lang):
+    # pyttsx3 只能输出到文件：交给常驻的引擎线程合成，读出后删除临时文件
+    fname = f"tts_pyttsx3_{int(time.time()*1000)}_{threading.get_ident()}.wav"
+    fpath = os.path.join(TTS_AUDIO_DIR, fname)
+    try:
+        pyttsx3_worker.synthesize(text, lang, fpath)
+        with open(fpath, "rb") as f:
+            fp.write(f.read())
+    finally:
+        _remove_quietly(fpath)
+
+def _synthesize(text, lang, encoder=None):
+    """
+    按 gTTS → pyttsx3 的顺序合成。给出 encoder 时引擎输出边产生边送入编码器。
+    返回 (引擎名, 编码后的字节或 None, 引擎原始输出)，全部失败时为 (None, None, None)。
+    """
     os.makedirs(TTS_AUDIO_DIR, exist_ok=True)
     
     # 记录要合成的文本信息
     logging.info(f"准备合成语音 (语言: {lang}), 文本长度: {len(text)}")
     logging.info(f"文本内容预览: {text[:100]}...")
 
-    # 尝试 gTTS
-    if ENGINES.get('gtts'):
+    # 优先 gTTS，失败则回退到 pyttsx3 (本地 TTS)
+    for engine, produce in (("gtts", _gtts_to), ("pyttsx3", _pyttsx3_to)):
+        if not ENGINES.get(engine):
+            continue
         try:
-            logging.info(f"正在使用 gTTS 合成语音 ({lang})...")
-            # gTTS 语言代码: 'zh-CN' 或 'zh-TW' for Chinese, 'ru' for Russian
-            gtts_lang = 'zh-CN' if lang == 'zh' else 'ru'
-            
-            tts = gTTS(text=text, lang=gtts_lang)
-            fname = f"tts_gtts_{int(time.time()*1000)}.mp3"
-            fpath = os.path.join(TTS_AUDIO_DIR, fname)
-            
-            tts.save(fpath)
-            
-            if os.path.exists(fpath) and os.path.getsize(fpath) > 0:
-                logging.info(f"gTTS 语音文件生成成功: {fpath}")
-                return fpath
+            logging.info(f"正在使用 {engine} 合成语音 ({lang})...")
+            if encoder is not None:
+                encoded, source = encoder.encode_stream(lambda fp: produce(fp, text, lang))
             else:
-                logging.warning("gTTS 生成文件为空")
+                buf = io.BytesIO()
+                produce(buf, text, lang)
+                encoded, source = None, buf.getvalue()
+            if source:
+                logging.info(f"{engine} 语音生成成功: {len(source)} 字节")
+                return engine, encoded, source
+            logging.warning(f"{engine} 生成的音频为空")
         except Exception as e:
-            logging.error(f"gTTS 合成失败: {e}", exc_info=True)
+            logging.error(f"{engine} 合成失败: {e}", exc_info=True)
             # 继续尝试下一个引擎
     
-    # 回退到 pyttsx3
-    if ENGINES.get('pyttsx3'):
-        try:
-            logging.info(f"正在使用 pyttsx3 合成语音 ({lang})...")
-            engine = pyttsx3.init()
-            
-            # 设置语速
-            try:
-                rate = engine.getProperty('rate')
-                engine.setProperty('rate', max(120, rate - 40))
-            except Exception:
-                pass
-            
-            # 设置语音
-            try:
-                voices = engine.getProperty('voices')
-                target_voice = None
-                if lang == "zh":
-                    for v in voices:
-                        if "zh" in str(v.languages).lower() or "Chinese" in v.name:
-                            target_voice = v.id
-                            break
-                else:  # 默认俄语
-                    for v in voices:
-                        if "ru" in str(v.languages).lower() or "Russian" in v.name:
-                            target_voice = v.id
-                            break
-                if target_voice:
-                    engine.setProperty('voice', target_voice)
-            except Exception:
-                pass
-            
-            fname = f"tts_pyttsx3_{int(time.time()*1000)}.wav"
-            fpath = os.path.join(TTS_AUDIO_DIR, fname)
-            
-            engine.save_to_file(text, fpath)
-            engine.runAndWait()
-            
-            if os.path.exists(fpath) and os.path.getsize(fpath) > 0:
-                logging.info(f"pyttsx3 语音文件生成成功: {fpath}")
-                return fpath
-            else:
-                logging.error(f"pyttsx3 语音文件生成失败或为空")
-                return None
-                
-        except Exception as e:
-            logging.error(f"pyttsx3 语音合成过程中发生错误: {e}", exc_info=True)
-            return None
-    
     logging.error("没有可用的语音合成引擎或所有引擎均失败")
-    return None
+    return None, None, None
+
+def bench_pyttsx3(n=20, lang="ru", driver=None):
+    """
+    pyttsx3 吞吐基准：每段语音新建一个引擎（旧实现）与常驻 worker 复用一个引擎，各合成 n 段。
+    返回 {模式: 每秒段数}。
+    """
+    texts = [f"Город: Москва\nКоды региона: {77 + i}" if lang == "ru" else f"城市：莫斯科\n车牌代码：{77 + i}" for i in range(n)]
+    out_dir = tempfile.mkdtemp(prefix="tts_bench_")
+    results = {}
+    start = time.perf_counter()
+    for i, text in enumerate(texts):
+        # 每次都用新的 worker，相当于旧实现中每次调用 pyttsx3.init() 并扫描语音列表
+        worker = Pyttsx3Worker(driver)
+        worker.synthesize(text, lang, os.path.join(out_dir, f"cold_{i}.wav"))
+        worker.stop(wait=True)
+    results["engine_per_clip"] = n / (time.perf_counter() - start)
+    worker = Pyttsx3Worker(driver)
+    start = time.perf_counter()
+    for i, text in enumerate(texts):
+        worker.synthesize(text, lang, os.path.join(out_dir, f"warm_{i}.wav"))
+    results["long_lived_worker"] = n / (time.perf_counter() - start)
+    worker.stop()
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="pyttsx3 throughput benchmark: a new engine per clip vs the long-lived worker")
+    parser.add_argument("-n", type=int, default=20, help="number of clips per mode")
+    parser.add_argument("--lang", default="ru", choices=["ru", "zh"])
+    parser.add_argument("--driver", default=None, help="pyttsx3 driver name (default: platform default)")
+    args = parser.parse_args()
+    if not ENGINES.get('pyttsx3'):
+        sys.exit("pyttsx3 is not installed")
+    for mode, rate in bench_pyttsx3(args.n, args.lang, args.driver).items():
+        print(f"{mode}: {rate:.2f} clips/s ({1000 / rate:.0f} ms/clip)")
@@ -0,0 +1,319 @@
+import io
+import os
+import json
+import wave
+import time
+import hashlib
+import argparse
+import threading
+from array import array
+
+from .config import TTS_FRAGMENT_DIR, TTS_FRAGMENTS
+from .nlp import _PLATE_RE
+from .reply_templates import format_auto_result, format_auto_region_only, format_phone_result, format_license_plate, format_not_found
+
+# 回复由少量固定短语拼成：标签、地区/城市名、数字。离线预先合成每个短语（PCM WAV 片段），
+# 请求时按回复文本拼接，整条回复都能覆盖时不再调用 TTS 引擎。
+MANIFEST = "index.json"
+# 标签与取值、同一行多个取值之间的分隔符（与 reply_templates 一致）
+LABEL_SEP = {"ru": ": ", "zh": "："}
+VALUE_SEP = ", "
+# 拼接时插入的停顿（毫秒）：词之间、取值之间、行之间、多项回复的段落之间
+PAUSE_MS = {"word": 40, "value": 180, "line": 350, "section": 600}
+# 片段首尾静音的裁剪阈值（16 位采样的绝对值）
+SILENCE_THRESHOLD = 300
+
+_RU_UNITS = ["ноль", "один", "два", "три", "четыре", "пять", "шесть", "семь", "восемь", "девять"]
+_RU_TEENS = ["десять", "одиннадцать", "двенадцать", "тринадцать", "четырнадцать", "пятнадцать", "шестнадцать", "семнадцать", "восемнадцать", "девятнадцать"]
+_RU_TENS = ["", "", "двадцать", "тридцать", "сорок", "пятьдесят", "шестьдесят", "семьдесят", "восемьдесят", "девяносто"]
+_RU_HUNDREDS = ["", "сто", "двести", "триста", "четыреста", "пятьсот", "шестьсот", "семьсот", "восемьсот", "девятьсот"]
+_RU_THOUSANDS = ["", "тысяча", "две тысячи", "три тысячи", "четыре тысячи", "пять тысяч", "шесть тысяч", "семь тысяч", "восемь тысяч", "девять тысяч"]
+_ZH_DIGITS = "零一二三四五六七八九"
+_ZH_UNITS = ((1000, "千"), (100, "百"), (10, "十"))
+# 车牌字母的俄语读法（拉丁字母按同形的西里尔字母读）
+_RU_LETTERS = {"А": "а", "В": "вэ", "Е": "е", "К": "ка", "М": "эм", "Н": "эн", "О": "о", "Р": "эр", "С": "эс", "Т": "тэ", "У": "у", "Х": "ха"}
+_LATIN_TO_CYRILLIC = str.maketrans("ABEKMHOPCTYX", "АВЕКМНОРСТУХ")
+
+def number_words(digits, lang):
+    """数字串的读法（短语列表）。以 0 开头或超过 4 位的按单个数字读。"""
+    if lang == "zh":
+        return _number_words_zh(digits)
+    if (len(digits) > 1 and digits[0] == "0") or len(digits) > 4:
+        return [_RU_UNITS[int(d)] for d in digits]
+    n = int(digits)
+    if n == 0:
+        return [_RU_UNITS[0]]
+    words = []
+    thousands, n = divmod(n, 1000)
+    hundreds, n = divmod(n, 100)
+    if thousands:
+        words.append(_RU_THOUSANDS[thousands])
+    if hundreds:
+        words.append(_RU_HUNDREDS[hundreds])
+    if 10 <= n < 20:
+        words.append(_RU_TEENS[n - 10])
+    else:
+        tens, units = divmod(n, 10)
+        if tens:
+            words.append(_RU_TENS[tens])
+        if units:
+            words.append(_RU_UNITS[units])
+    return words
+
+def _number_words_zh(digits):
+    if (len(digits) > 1 and digits[0] == "0") or len(digits) > 4:
+        return [_ZH_DIGITS[int(d)] for d in digits]
+    n = int(digits)
+    if n == 0:
+        return [_ZH_DIGITS[0]]
+    words = []
+    pending_zero = False
+    for value, unit in _ZH_UNITS:
+        d = n // value % 10
+        if d:
+            if pending_zero:
+                words.append(_ZH_DIGITS[0])
+                pending_zero = False
+            # 十五 而不是 一十五；一百一十 保留“一”
+            if not (value == 10 and d == 1 and not words):
+                words.append(_ZH_DIGITS[d])
+            words.append(unit)
+        elif words:
+            pending_zero = True
+    if n % 10:
+        if pending_zero:
+            words.append(_ZH_DIGITS[0])
+        words.append(_ZH_DIGITS[n % 10])
+    return words
+
+def plate_words(plate, lang):
+    """车牌读法：字母逐个读，三位号码与地区代码按数字读；只支持俄语。"""
+    if lang != "ru":
+        return None
+    plate = plate.upper().translate(_LATIN_TO_CYRILLIC)
+    words = [_RU_LETTERS[plate[0]]]
+    words += number_words(plate[1:4], lang)
+    words += [_RU_LETTERS[ch] for ch in plate[4:6]]
+    words += number_words(plate[6:], lang)
+    return words
+
+def _split_reply(text, lang):
+    # 回复 -> [(停顿类型, 短语)]，短语为片段库中的键；None 表示该部分无法用片段表示
+    sep = LABEL_SEP.get(lang)
+    if sep is None:
+        return None
+    out = []
+    for si, section in enumerate(text.strip().split("\n\n")):
+        for li, line in enumerate(section.strip().split("\n")):
+            pause = "section" if si and not li else "line" if li else None
+            label, found, rest = line.strip().partition(sep)
+            parts = [label] + (rest.split(VALUE_SEP) if found else [])
+            for pi, part in enumerate(parts):
+                words = _phrase_words(part.strip(), lang)
+                if not words:
+                    return None
+                for wi, word in enumerate(words):
+                    if wi:
+                        out.append(("word", word))
+                    elif pi:
+                        out.append(("value", word))
+                    else:
+                        out.append((pause, word))
+                    pause = None
+    return out
+
+def _phrase_words(part, lang):
+    if not part:
+        return None
+    if part.isdigit():
+        return number_words(part, lang)
+    if _PLATE_RE.fullmatch(part.upper()):
+        return plate_words(part, lang)
+    return [part]
+
+def template_phrases(lang):
+    """reply_templates 中会被朗读的固定短语（标签及整行文本），用占位值渲染模板后提取。"""
+    mark = "\x00"
+    samples = [
+        format_auto_result(lang, mark, mark, mark, mark, [mark]),
+        format_auto_region_only(lang, mark, mark, [mark]),
+        format_phone_result(lang, mark, mark, mark, mark, [mark]),
+        format_license_plate(lang, mark, mark, mark),
+        format_not_found(lang),
+    ]
+    phrases = set()
+    for line in "\n".join(samples).split("\n"):
+        label = line.partition(LABEL_SEP[lang])[0]
+        if label and mark not in label:
+            phrases.add(label)
+    return phrases
+
+def vocabulary(lang, conn=None):
+    """某语言片段库需要的全部短语：模板标签、地区/城市名（与模板相同的 名称_语言 or 另一名称 规则）、数字读法。"""
+    from .db import get_read_conn
+    conn = conn or get_read_conn()
+    phrases = template_phrases(lang)
+    for table in ("regions", "cities"):
+        for name_ru, name_zh in conn.execute(f"SELECT name_ru,name_zh FROM {table}"):
+            name = (name_zh or name_ru) if lang == "zh" else (name_ru or name_zh)
+            if name:
+                phrases.add(name)
+    for n in range(10000):
+        phrases.update(number_words(str(n), lang))
+    if lang == "ru":
+        phrases.update(_RU_LETTERS.values())
+    return phrases
+
+def _fragment_name(lang, phrase):
+    return f"{lang}_{hashlib.sha1(phrase.encode('utf-8')).hexdigest()[:16]}.wav"
+
+def trim_silence(frames, sampwidth, nchannels, threshold=SILENCE_THRESHOLD):
+    # 去掉引擎在片段首尾留下的静音，停顿统一由拼接时插入
+    if sampwidth != 2:
+        return frames
+    samples = array("h", frames)
+    start, end = 0, len(samples)
+    while start < end and abs(samples[start]) < threshold:
+        start += 1
+    while end > start and abs(samples[end - 1]) < threshold:
+        end -= 1
+    if start >= end:
+        return frames
+    start -= start % nchannels
+    end += (-end) % nchannels
+    return samples[start:end].tobytes()
+
+def build_bank(out_dir=TTS_FRAGMENT_DIR, langs=("ru", "zh"), driver=None):
+    """用 pyttsx3（离线引擎，输出 WAV）合成全部片段并写入 out_dir，返回 {语言: 片段数}。"""
+    from .tts import Pyttsx3Worker
+    os.makedirs(out_dir, exist_ok=True)
+    worker = Pyttsx3Worker(driver)
+    manifest = {"params": None, "fragments": {}}
+    counts = {}
+    try:
+        for lang in langs:
+            entries = manifest["fragments"][lang] = {}
+            for phrase in sorted(vocabulary(lang)):
+                name = _fragment_name(lang, phrase)
+                path = os.path.join(out_dir, name)
+                worker.synthesize(phrase, lang, path)
+                with wave.open(path, "rb") as w:
+                    params = [w.getnchannels(), w.getsampwidth(), w.getframerate()]
+                    frames = w.readframes(w.getnframes())
+                if manifest["params"] is None:
+                    manifest["params"] = params
+                elif params != manifest["params"]:
+                    raise ValueError(f"fragment {phrase!r} has audio params {params}, expected {manifest['params']}")
+                with wave.open(path, "wb") as w:
+                    w.setnchannels(params[0])
+                    w.setsampwidth(params[1])
+                    w.setframerate(params[2])
+                    w.writeframes(trim_silence(frames, params[1], params[0]))
+                entries[phrase] = name
+            counts[lang] = len(entries)
+    finally:
+        worker.stop(wait=True)
+    tmp = os.path.join(out_dir, MANIFEST + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp, os.path.join(out_dir, MANIFEST))
+    return counts
+
+class FragmentBank:
+    """已构建的片段库：清单在首次使用时读入，片段按需读取后常驻内存。"""
+
+    def __init__(self, directory, manifest):
+        self.directory = directory
+        self.nchannels, self.sampwidth, self.framerate = manifest["params"]
+        self.fragments = manifest["fragments"]
+        self._frames = {}
+        self._lock = threading.Lock()
+        self.assembled = 0
+        self.uncovered = 0
+
+    @classmethod
+    def load(cls, directory):
+        try:
+            with open(os.path.join(directory, MANIFEST), encoding="utf-8") as f:
+                return cls(directory, json.load(f))
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _read(self, name):
+        with self._lock:
+            frames = self._frames.get(name)
+        if frames is None:
+            with wave.open(os.path.join(self.directory, name), "rb") as w:
+                frames = w.readframes(w.getnframes())
+            with self._lock:
+                self._frames[name] = frames
+        return frames
+
+    def _silence(self, ms):
+        return b"\x00" * (self.framerate * ms // 1000 * self.sampwidth * self.nchannels)
+
+    def assemble(self, text, lang):
+        """拼接整条回复的 WAV 字节；有任何部分不在片段库中时返回 None。"""
+        entries = self.fragments.get(lang)
+        tokens = _split_reply(text, lang) if entries else None
+        if not tokens or any(phrase not in entries for _, phrase in tokens):
+            self.uncovered += 1
+            return None
+        chunks = []
+        for pause, phrase in tokens:
+            if pause:
+                chunks.append(self._silence(PAUSE_MS[pause]))
+            chunks.append(self._read(entries[phrase]))
+        buf = io.BytesIO()
+        with wave.open(buf, "wb") as w:
+            w.setnchannels(self.nchannels)
+            w.setsampwidth(self.sampwidth)
+            w.setframerate(self.framerate)
+            w.writeframes(b"".join(chunks))
+        self.assembled += 1
+        return buf.getvalue()
+
+_bank = None
+_bank_lock = threading.Lock()
+
+def get_bank():
+    global _bank
+    if _bank is None:
+        with _bank_lock:
+            if _bank is None:
+                _bank = FragmentBank.load(TTS_FRAGMENT_DIR) or False
+    return _bank or None
+
+def assemble_clip(text, lang="ru"):
+    """用片段库拼接语音，返回 (WAV 字节, 文件名)；未启用、未构建或无法覆盖时返回 (None, None)。"""
+    bank = get_bank() if TTS_FRAGMENTS != "off" else None
+    audio = bank.assemble(text, lang) if bank is not None else None
+    return (audio, "voice.wav") if audio else (None, None)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or try the pre-synthesized TTS fragment bank")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    # 片段库总是写入/读取 TTS_FRAGMENT_DIR（与机器人加载的位置一致），换目录请设置该环境变量
+    p_build = sub.add_parser("build", help="synthesize every label, place name and number word with pyttsx3 into TTS_FRAGMENT_DIR")
+    p_build.add_argument("--lang", nargs="+", default=["ru", "zh"], choices=["ru", "zh"])
+    p_build.add_argument("--driver", default=None, help="pyttsx3 driver name (default: platform default)")
+    p_say = sub.add_parser("say", help="assemble one reply from the bank into a WAV file")
+    p_say.add_argument("text")
+    p_say.add_argument("--lang", default="ru", choices=["ru", "zh"])
+    p_say.add_argument("-o", "--out", default="reply.wav", help="WAV file to write")
+    args = parser.parse_args()
+    if args.cmd == "build":
+        from .db import init_schema, seed_reference_data
+        init_schema()
+        seed_reference_data()
+        start = time.perf_counter()
+        counts = build_bank(TTS_FRAGMENT_DIR, args.lang, args.driver)
+        print(f"Wrote {sum(counts.values())} fragments to {TTS_FRAGMENT_DIR} {counts} in {time.perf_counter() - start:.1f}s")
+    else:
+        bank = FragmentBank.load(TTS_FRAGMENT_DIR)
+        audio = bank.assemble(args.text.replace("\\n", "\n"), args.lang) if bank else None
+        if not audio:
+            raise SystemExit("reply is not covered by the fragment bank (or the bank is not built)")
+        with open(args.out, "wb") as f:
+            f.write(audio)
+        print(f"Wrote {args.out} ({len(audio)} bytes)")
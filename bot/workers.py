@@ -0,0 +1,100 @@
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from .config import (
+    MAP_POOL_KIND, MAP_POOL_WORKERS, MAP_POOL_QUEUE,
+    GEOCODE_POOL_WORKERS, GEOCODE_POOL_QUEUE,
+    TTS_POOL_KIND, TTS_POOL_WORKERS, TTS_POOL_QUEUE,
+)
+
+class PoolBusy(Exception):
+    """执行器的排队已满，调用方应快速失败（例如回复“繁忙”）而不是继续排队。"""
+
+class WorkerPool:
+    """
+    按负载类型划分的有界执行器。kind 为 thread（I/O 为主）或 process（CPU 为主，函数与参数需可 pickle）。
+    同时在途（执行中 + 排队）的任务数达到 workers + queue 时 run() 直接抛出 PoolBusy。
+    在途计数在底层任务真正结束时才减少，调用方超时取消不会让计数提前归还。
+    """
+
+    def __init__(self, name, workers, queue, kind="thread"):
+        self.name = name
+        self.workers = max(1, int(workers))
+        self.queue = max(0, int(queue))
+        self.kind = kind
+        self._executor = None
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.peak = 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    if self.kind == "process":
+                        # spawn 避免在已有线程的进程中 fork
+                        self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+                    else:
+                        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix=f"{self.name}-pool")
+        return self._executor
+
+    def _done(self, fut):
+        with self._lock:
+            self._inflight -= 1
+            if fut.cancelled() or fut.exception() is not None:
+                self.failed += 1
+            else:
+                self.completed += 1
+
+    async def run(self, fn, *args):
+        with self._lock:
+            if self._inflight >= self.workers + self.queue:
+                self.rejected += 1
+                raise PoolBusy(f"{self.name} pool is full ({self._inflight} in flight)")
+            self._inflight += 1
+            self.submitted += 1
+            self.peak = max(self.peak, self._inflight)
+        try:
+            fut = self._get_executor().submit(fn, *args)
+        except Exception:
+            with self._lock:
+                self._inflight -= 1
+            raise
+        fut.add_done_callback(self._done)
+        return await asyncio.wrap_future(fut)
+
+    def queue_depth(self):
+        with self._lock:
+            return max(0, self._inflight - self.workers)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "kind": self.kind, "workers": self.workers, "queue": self.queue,
+                "inflight": self._inflight, "queued": max(0, self._inflight - self.workers), "peak": self.peak,
+                "submitted": self.submitted, "completed": self.completed, "failed": self.failed, "rejected": self.rejected,
+            }
+
+    def shutdown(self, wait=False):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+map_pool = WorkerPool("map", MAP_POOL_WORKERS, MAP_POOL_QUEUE, MAP_POOL_KIND)
+geocode_pool = WorkerPool("geocode", GEOCODE_POOL_WORKERS, GEOCODE_POOL_QUEUE)
+tts_pool = WorkerPool("tts", TTS_POOL_WORKERS, TTS_POOL_QUEUE, TTS_POOL_KIND)
+POOLS = (map_pool, geocode_pool, tts_pool)
+
+def pool_stats():
+    return {pool.name: pool.stats() for pool in POOLS}
+
+def shutdown_pools():
+    for pool in POOLS:
+        pool.shutdown()